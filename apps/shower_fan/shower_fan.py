@@ -1,20 +1,833 @@
+import asyncio
+import csv
+import functools
+import io
+import json
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from datetime import datetime, timedelta
+
 import appdaemon.plugins.hass.hassapi as hass
 
 DEBUG = "DEBUG"
 DEFAULT_FAN_DELAYED_OFF_MINUTES = 5
 DEFAULT_HUMIDITY_RELATIVE_HIGH = 20
 DEFAULT_HUMIDITY_RELATIVE_LOW = 10
+DEFAULT_FAN_RESYNC_MINUTES = 15
+DEFAULT_HUMIDITY_SLOPE_SAMPLES = 5
+DEFAULT_STATE_SENSOR_PUBLISH = "changes"
+DEFAULT_STATE_SENSOR_COALESCE_SECONDS = 0
+DEFAULT_FAN_COMMAND_BATCH_SECONDS = 0
+DEFAULT_SNAPSHOT_COALESCE_SECONDS = 5
+DEFAULT_METRICS_PUBLISH_MINUTES = 0
+DEFAULT_TRACE_SIZE = 200
+DEFAULT_FAN_PERCENTAGE_MIN = 30
+DEFAULT_REFERENCE_HUMIDITY_AGGREGATE = "median"
+DEFAULT_REFERENCE_HUMIDITY_STALE_MINUTES = 0
+DEFAULT_FAN_PERCENTAGE_INTERVAL_SECONDS = 60
+DEFAULT_TRIGGER_RUN_ON_MINUTES = 5
+DEFAULT_SENSOR_HOLD_MINUTES = 10
+DRYING_TIMEOUT_SECONDS = 3600
+# a timeout callback this close to its deadline counts as on time
+TIMEOUT_TOLERANCE_SECONDS = 1
+# drying speeds are multiples of this, so small humidity changes send nothing
+FAN_PERCENTAGE_STEP = 10
+# a learned drying timeout allows this many times the usual drying time
+DRYING_TIMEOUT_FACTOR = 2
+# weight of the latest drying time in the learned average
+DRYING_TIME_SMOOTHING = 0.3
+
+# Home Assistant states of a sensor without a reading, recognised without
+# raising and catching a ValueError
+NON_NUMERIC_STATES = frozenset((None, "", "unavailable", "unknown", "none"))
+
+# fired with optional `name`, `format` (json or csv) and `path` data
+TRACE_DUMP_EVENT = "shower_fan_dump_trace"
+
+REFERENCE_HUMIDITY_MEDIAN = "median"
+REFERENCE_HUMIDITY_TRIMMED_MEAN = "trimmed_mean"
+# share of readings dropped from each end for the trimmed mean
+REFERENCE_HUMIDITY_TRIM = 0.2
+
+HUMIDITY_COMPARISON_RELATIVE = "relative"
+HUMIDITY_COMPARISON_ABSOLUTE = "absolute"
+HUMIDITY_COMPARISON_DEW_POINT = "dew_point"
+# thresholds in the units each comparison works in: % RH, g/m³ and °C
+DEFAULT_HUMIDITY_THRESHOLDS = {
+    HUMIDITY_COMPARISON_RELATIVE: (
+        DEFAULT_HUMIDITY_RELATIVE_HIGH,
+        DEFAULT_HUMIDITY_RELATIVE_LOW,
+    ),
+    HUMIDITY_COMPARISON_ABSOLUTE: (4, 2),
+    HUMIDITY_COMPARISON_DEW_POINT: (6, 3),
+}
+
+# range and spacing (°C) of the tabulated saturation values; temperatures
+# outside it are clamped to its ends
+PSYCHROMETRIC_MIN = -40.0
+PSYCHROMETRIC_MAX = 60.0
+PSYCHROMETRIC_STEP = 0.5
+
+STATE_SENSOR_PUBLISH_ALWAYS = "always"
+STATE_SENSOR_PUBLISH_CHANGES = "changes"
 
 CONFIG_REFERENCE_HUMIDITY_SENSOR = "reference_humidity_sensor"
+CONFIG_REFERENCE_HUMIDITY_AGGREGATE = "reference_humidity_aggregate"
+CONFIG_REFERENCE_HUMIDITY_STALE_MINUTES = "reference_humidity_stale_minutes"
 CONFIG_HUMIDITY_SENSOR = "humidity_sensor"
 CONFIG_HUMIDITY_RELATIVE_HIGH = "humidity_relative_high"
 CONFIG_HUMIDITY_RELATIVE_LOW = "humidity_relative_low"
+CONFIG_HUMIDITY_COMPARISON = "humidity_comparison"
+CONFIG_TEMPERATURE_SENSOR = "temperature_sensor"
+CONFIG_REFERENCE_TEMPERATURE_SENSOR = "reference_temperature_sensor"
+CONFIG_HUMIDITY_SLOPE_HIGH = "humidity_slope_high"
+CONFIG_HUMIDITY_SLOPE_SAMPLES = "humidity_slope_samples"
 CONFIG_QUIET_SWITCH = "quiet_switch"
+CONFIG_QUIET_HOURS = "quiet_hours"
 CONFIG_FAN = "fan"
 CONFIG_FAN_OFF_DELAY_MINUTES = "fan_off_delay_minutes"
+CONFIG_TRIGGER_ENTITIES = "trigger_entities"
+CONFIG_TRIGGER_RUN_ON_MINUTES = "trigger_run_on_minutes"
+CONFIG_SENSOR_HOLD_MINUTES = "sensor_hold_minutes"
+CONFIG_FAN_RESYNC_MINUTES = "fan_resync_minutes"
+CONFIG_STATE_SENSOR_PUBLISH = "state_sensor_publish"
+CONFIG_STATE_SENSOR_COALESCE_SECONDS = "state_sensor_coalesce_seconds"
+CONFIG_FAN_COMMAND_BATCH_SECONDS = "fan_command_batch_seconds"
+CONFIG_SNAPSHOT_FILE = "snapshot_file"
+CONFIG_SNAPSHOT_COALESCE_SECONDS = "snapshot_coalesce_seconds"
+CONFIG_METRICS_PUBLISH_MINUTES = "metrics_publish_minutes"
+CONFIG_METRICS_FILE = "metrics_file"
+CONFIG_TRACE_SIZE = "trace_size"
+CONFIG_TRACE_DIRECTORY = "trace_directory"
+CONFIG_DRYING_TIMEOUT_MINUTES = "drying_timeout_minutes"
+CONFIG_DRYING_PREDICTION = "drying_prediction"
+CONFIG_FAN_PERCENTAGE_GAIN = "fan_percentage_gain"
+CONFIG_FAN_PERCENTAGE_MIN = "fan_percentage_min"
+CONFIG_FAN_PERCENTAGE_INTERVAL_SECONDS = "fan_percentage_interval_seconds"
+CONFIG_BATHROOMS = "bathrooms"
+CONFIG_NAME = "name"
+
+
+def _to_float(value):
+    try:
+        if value in NON_NUMERIC_STATES:
+            return None
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    # nan fails every comparison and inf overflows the trend's running sums
+    return number if math.isfinite(number) else None
+
+
+def _entities(value):
+    """An entity argument that may be one entity or a list, as a list."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "on", "1")
+    return bool(value)
+
+
+def _seconds_of_day(value):
+    try:
+        parts = [int(part) for part in str(value).split(":")]
+    except ValueError:
+        parts = []
+    if not 2 <= len(parts) <= 3:
+        raise ValueError(f"Invalid time of day '{value}', expected HH:MM[:SS]")
+    hours, minutes, seconds = (parts + [0])[:3]
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def _seconds_of_week(moment):
+    return (
+        moment.weekday() * 86400
+        + moment.hour * 3600
+        + moment.minute * 60
+        + moment.second
+        + moment.microsecond / 1e6
+    )
+
+
+def _replace_file(path, text):
+    # written aside and renamed, so a crash never leaves half a file
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as file:
+        file.write(text)
+    os.replace(temporary, path)
+
+
+_TABLE_TEMPERATURES = [
+    PSYCHROMETRIC_MIN + i * PSYCHROMETRIC_STEP
+    for i in range(
+        round((PSYCHROMETRIC_MAX - PSYCHROMETRIC_MIN) / PSYCHROMETRIC_STEP) + 1
+    )
+]
+# saturation vapour pressure over water (hPa), Magnus formula
+_SATURATION_PRESSURE = array(
+    "d", (6.112 * math.exp(17.62 * t / (243.12 + t)) for t in _TABLE_TEMPERATURES)
+)
+# water vapour density at saturation (g/m³)
+_SATURATION_DENSITY = array(
+    "d",
+    (
+        216.7 * pressure / (273.15 + t)
+        for t, pressure in zip(_TABLE_TEMPERATURES, _SATURATION_PRESSURE)
+    ),
+)
+
+
+def _interpolate(table, temperature):
+    position = (temperature - PSYCHROMETRIC_MIN) / PSYCHROMETRIC_STEP
+    if position <= 0:
+        return table[0]
+    index = int(position)
+    if index >= len(table) - 1:
+        return table[-1]
+    low = table[index]
+    return low + (table[index + 1] - low) * (position - index)
+
+
+def absolute_humidity(relative_humidity, temperature):
+    """Water vapour density (g/m³) of air at `relative_humidity` % and °C."""
+    return relative_humidity / 100 * _interpolate(_SATURATION_DENSITY, temperature)
+
+
+def dew_point(relative_humidity, temperature):
+    """Dew point (°C) of air at `relative_humidity` % and `temperature` °C."""
+    pressure = relative_humidity / 100 * _interpolate(_SATURATION_PRESSURE, temperature)
+    # the saturation pressure rises with temperature, so the table inverts
+    index = bisect_left(_SATURATION_PRESSURE, pressure)
+    if index == 0:
+        return PSYCHROMETRIC_MIN
+    if index == len(_SATURATION_PRESSURE):
+        return PSYCHROMETRIC_MAX
+    low = _SATURATION_PRESSURE[index - 1]
+    high = _SATURATION_PRESSURE[index]
+    return _TABLE_TEMPERATURES[index - 1] + PSYCHROMETRIC_STEP * (pressure - low) / (
+        high - low
+    )
+
+
+HUMIDITY_CONVERSIONS = {
+    HUMIDITY_COMPARISON_RELATIVE: None,
+    HUMIDITY_COMPARISON_ABSOLUTE: absolute_humidity,
+    HUMIDITY_COMPARISON_DEW_POINT: dew_point,
+}
+
+
+class SensorReading:
+    """Last good value of a numeric sensor, when it was read and since when the
+    sensor has had no reading."""
+
+    __slots__ = ("value", "updated", "down_since")
+
+    def __init__(self):
+        self.value = None
+        self.updated = None
+        self.down_since = None
+
+    def update(self, state, now):
+        """Parses `state`; returns whether it was a number."""
+        value = _to_float(state)
+        if value is None:
+            if self.down_since is None:
+                self.down_since = now
+            return False
+        self.value = value
+        self.updated = now
+        self.down_since = None
+        return True
+
+    def age(self, now):
+        return None if self.updated is None else now - self.updated
+
+
+class HumidityTrend:
+    """Ring buffer of the last `size` (timestamp, humidity) samples.
+
+    Running sums of the least-squares fit are updated as samples enter and leave
+    the buffer, so `add` and `slope` are O(1) and memory is fixed at two arrays.
+    """
+
+    # timestamps are kept relative to an origin that is moved forward (and the
+    # sums recomputed) this often, to bound float error from add/subtract drift
+    REBASE_SECONDS = 86400
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array("d", [0.0]) * size
+        self.values = array("d", [0.0]) * size
+        self.count = 0
+        self.next = 0
+        self.origin = None
+        self.sum_t = self.sum_h = self.sum_tt = self.sum_th = 0.0
+
+    def add(self, timestamp, humidity):
+        if self.origin is None:
+            self.origin = timestamp
+        t = timestamp - self.origin
+
+        if self.count == self.size:
+            old_t = self.times[self.next]
+            old_h = self.values[self.next]
+            self.sum_t -= old_t
+            self.sum_h -= old_h
+            self.sum_tt -= old_t * old_t
+            self.sum_th -= old_t * old_h
+        else:
+            self.count += 1
+
+        self.times[self.next] = t
+        self.values[self.next] = humidity
+        self.sum_t += t
+        self.sum_h += humidity
+        self.sum_tt += t * t
+        self.sum_th += t * humidity
+        self.next = (self.next + 1) % self.size
+
+        if t > self.REBASE_SECONDS:
+            self._rebase()
+
+    def slope(self):
+        """Humidity change per second over the buffered samples, or None."""
+        n = self.count
+        if n < 2:
+            return None
+        denominator = n * self.sum_tt - self.sum_t * self.sum_t
+        if denominator <= 0:
+            return None
+        return (n * self.sum_th - self.sum_t * self.sum_h) / denominator
+
+    def samples(self):
+        """The buffered (timestamp, humidity) pairs, oldest first."""
+        oldest = self.next if self.count == self.size else 0
+        for k in range(self.count):
+            i = (oldest + k) % self.size
+            yield self.origin + self.times[i], self.values[i]
+
+    def _rebase(self):
+        oldest = self.next if self.count == self.size else 0
+        shift = self.times[oldest]
+        self.origin += shift
+        self.sum_t = self.sum_h = self.sum_tt = self.sum_th = 0.0
+        for i in range(self.count):
+            t = self.times[i] - shift
+            h = self.values[i]
+            self.times[i] = t
+            self.sum_t += t
+            self.sum_h += h
+            self.sum_tt += t * t
+            self.sum_th += t * h
+
+
+class ReferenceHumidity:
+    """Latest reading of each reference sensor, combined into one value.
+
+    Readings are kept sorted as they arrive, so a new reading is a bisect
+    removal and insertion and the median or trimmed mean is read off the
+    sorted list. Sensors that have not reported for `stale_seconds` are left
+    out, using the arrival times already recorded, but the latest to report is
+    always kept. Home Assistant sends no event for an unchanged reading, so
+    this only suits sensors that report a change, or are forced to update,
+    more often than that; a sensor going `unavailable` is dropped regardless.
+    """
+
+    def __init__(self, aggregate=REFERENCE_HUMIDITY_MEDIAN, stale_seconds=0):
+        if aggregate not in (
+            REFERENCE_HUMIDITY_MEDIAN,
+            REFERENCE_HUMIDITY_TRIMMED_MEAN,
+        ):
+            raise ValueError(f"Unknown reference humidity aggregate '{aggregate}'")
+        self.aggregate = aggregate
+        self.stale_seconds = stale_seconds
+        self.readings = {}
+        self.values = []
+        self.oldest = None
+
+    def update(self, sensor, timestamp, value):
+        """Records `value` (None for unavailable) as the sensor's reading."""
+        old = self.readings.pop(sensor, None)
+        if old is not None:
+            del self.values[bisect_left(self.values, old[1])]
+        if value is not None:
+            self.readings[sensor] = (timestamp, value)
+            insort(self.values, value)
+        if self.oldest is None or (old is not None and old[0] == self.oldest):
+            self.oldest = min((t for t, _ in self.readings.values()), default=None)
+
+    def value(self, now=None):
+        if (
+            self.stale_seconds > 0
+            and self.oldest is not None
+            and len(self.readings) > 1
+        ):
+            cutoff = now - self.stale_seconds
+            if self.oldest < cutoff:
+                latest = max(self.readings, key=lambda sensor: self.readings[sensor][0])
+                for sensor, (timestamp, _) in list(self.readings.items()):
+                    if timestamp < cutoff and sensor != latest:
+                        self.update(sensor, timestamp, None)
+
+        values = self.values
+        n = len(values)
+        if n == 0:
+            return None
+        if self.aggregate == REFERENCE_HUMIDITY_MEDIAN:
+            middle = n // 2
+            if n % 2:
+                return values[middle]
+            return (values[middle - 1] + values[middle]) / 2
+        trim = max(1, int(n * REFERENCE_HUMIDITY_TRIM)) if n >= 3 else 0
+        kept = values[trim : n - trim]
+        return sum(kept) / len(kept)
+
+
+class QuietHours:
+    """Weekly quiet windows, kept as the sorted times of the week they change.
+
+    A window is `{"start": "21:00", "end": "07:00", "days": ["fri", "sat"]}`,
+    with `days` naming the days it starts on (every day if left out), or the
+    shorthand `"21:00-07:00"`. A window ending at or before its start runs into
+    the next day. Overlapping windows are merged, so every boundary is a change.
+    """
+
+    DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+    DAY_SECONDS = 86400
+    WEEK_SECONDS = 7 * DAY_SECONDS
+
+    def __init__(self, windows):
+        intervals = []
+        for window in windows:
+            if isinstance(window, str):
+                start, _, end = window.partition("-")
+                days = self.DAYS
+            else:
+                start, end = window["start"], window["end"]
+                days = window.get("days") or self.DAYS
+            if isinstance(days, str):
+                days = days.replace(",", " ").split()
+            start = _seconds_of_day(start)
+            length = (_seconds_of_day(end) - start) % self.DAY_SECONDS
+            for day in days:
+                day = str(day).strip().lower()[:3]
+                if day not in self.DAYS:
+                    raise ValueError(f"Unknown quiet hours day '{day}'")
+                begin = self.DAYS.index(day) * self.DAY_SECONDS + start
+                finish = begin + (length or self.DAY_SECONDS)
+                if finish > self.WEEK_SECONDS:
+                    # Sunday night runs into Monday morning
+                    intervals.append((0, finish - self.WEEK_SECONDS))
+                    finish = self.WEEK_SECONDS
+                intervals.append((begin, finish))
+
+        merged = []
+        for begin, finish in sorted(intervals):
+            if merged and begin <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], finish)
+            else:
+                merged.append([begin, finish])
+        # the week's ends are not boundaries: quiet carries over them
+        self.quiet_at_week_start = bool(merged) and merged[0][0] == 0
+        self.boundaries = array(
+            "d",
+            (t for interval in merged for t in interval if 0 < t < self.WEEK_SECONDS),
+        )
+
+    def is_quiet(self, seconds):
+        """Whether it is quiet `seconds` into the week (Monday 00:00 is 0)."""
+        crossed = bisect_right(self.boundaries, seconds)
+        return self.quiet_at_week_start != (crossed % 2 == 1)
+
+    def next_change(self, seconds):
+        """Seconds into the week of the next boundary after `seconds`, past the
+        week's end if it is next week; None if it never changes."""
+        if not self.boundaries:
+            return None
+        index = bisect_right(self.boundaries, seconds)
+        if index < len(self.boundaries):
+            return self.boundaries[index]
+        return self.boundaries[0] + self.WEEK_SECONDS
+
+
+class DecayFit:
+    """Fit of `excess = exp(a + b * t)` to excess humidity since its last peak.
+
+    Running least-squares sums of `ln(excess)` are updated per sample, so `add`
+    and `predict` are O(1). A new peak restarts the fit: the decay is only
+    modelled once humidity has started to fall.
+    """
+
+    MIN_SAMPLES = 3
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.origin = None
+        self.peak = None
+        self.count = 0
+        self.sum_t = self.sum_y = self.sum_tt = self.sum_ty = 0.0
+
+    def add(self, timestamp, excess):
+        if excess <= 0:
+            return
+        if self.peak is None or excess >= self.peak:
+            self.reset()
+            self.origin = timestamp
+            self.peak = excess
+        t = timestamp - self.origin
+        y = math.log(excess)
+        self.count += 1
+        self.sum_t += t
+        self.sum_y += y
+        self.sum_tt += t * t
+        self.sum_ty += t * y
+
+    def predict(self, excess):
+        """When the fitted curve falls to `excess`, or None if it is not falling."""
+        n = self.count
+        if n < self.MIN_SAMPLES:
+            return None
+        denominator = n * self.sum_tt - self.sum_t * self.sum_t
+        if denominator <= 0:
+            return None
+        b = (n * self.sum_ty - self.sum_t * self.sum_y) / denominator
+        if b >= 0:
+            return None
+        a = (self.sum_y - b * self.sum_t) / n
+        return self.origin + (math.log(excess) - a) / b
+
+
+class FanCommandBatcher:
+    """Collects fan commands from all apps in this AppDaemon for a short window.
+
+    Each window ends with one service call per action listing every entity,
+    sent from the app that opened the window. When a batched call fails, the
+    entities are retried one by one and each failure is reported back to the
+    app that asked, on that app's own thread.
+    """
+
+    # a window still open this long after it should have ended lost its timer,
+    # e.g. to its app being reloaded, and is taken over by the next command
+    OVERRUN_SECONDS = 30
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._sender = None
+        self._handle = None
+        self._window_started = None
+        self._window = None
+
+    def submit(self, app, service, entity, window):
+        now = app.clock()
+        with self._lock:
+            for other_service, commands in self._pending.items():
+                if other_service != service:
+                    # a later command for the same fan supersedes
+                    commands.pop(entity, None)
+            self._pending.setdefault(service, {})[entity] = app
+            overrun = None
+            if self._sender is not None:
+                if now < self._window_started + self._window + self.OVERRUN_SECONDS:
+                    return
+                overrun = (self._sender, self._handle)
+            self._sender = app
+            self._handle = None
+            self._window_started = now
+            self._window = window
+
+        if overrun is not None:
+            sender, handle = overrun
+            app.log(
+                f"Fan command window opened by {sender.name} never ended, "
+                "sending its commands with this one",
+                level="WARNING",
+            )
+            try:
+                sender.cancel_timer(handle)
+            except Exception:
+                pass
+        try:
+            handle = app.run_in(self._on_window_end, window)
+        except Exception:
+            with self._lock:
+                if self._sender is app:
+                    self._sender = None
+                commands = self._pending.get(service, {})
+                if commands.get(entity) is app:
+                    del commands[entity]
+            raise
+        with self._lock:
+            if self._sender is app:
+                self._handle = handle
+
+    def release(self, app):
+        """Sends the window `app` opened now, as its timer goes with the app."""
+        with self._lock:
+            if self._sender is not app:
+                return
+        self._on_window_end({})
+
+    def _on_window_end(self, kwargs):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            sender, self._sender = self._sender, None
+            self._handle = None
+
+        for service, commands in pending.items():
+            if not commands:
+                continue
+            if self._call(sender, service, list(commands)):
+                continue
+            for entity, app in commands.items():
+                if self._call(sender, service, entity):
+                    continue
+                try:
+                    app.run_in(app.on_fan_command_failed, 0, service=service)
+                except Exception:
+                    # the app has been terminated since
+                    pass
+
+    @staticmethod
+    def _call(app, service, entity_id):
+        app.metrics.count(Metrics.CALL_SERVICE)
+        # AppDaemon returns None whether or not the call succeeded; only an
+        # exception tells a failure
+        try:
+            app.call_service(service, entity_id=entity_id)
+        except Exception:
+            return False
+        return True
+
+
+class Metrics:
+    """Counters and callback latency histograms of one app.
+
+    Everything lives in arrays sized up front and indexed by position, so
+    recording an event is an in-place increment that allocates nothing.
+    """
+
+    # counters
+    INVALID_TRANSITIONS = 0
+    GET_STATE = 1
+    CALL_SERVICE = 2
+    SET_STATE = 3
+    MERGED_EVENTS = 4
+    PARSE_FAILURES = 5
+    COUNTERS = (
+        "invalid_transitions",
+        "get_state",
+        "call_service",
+        "set_state",
+        "merged_events",
+        "parse_failures",
+    )
+    CALLS = (GET_STATE, CALL_SERVICE, SET_STATE)
+
+    # latency histograms, named by `_timed`
+    HISTOGRAMS = (
+        "humidity",
+        "reference_humidity",
+        "temperature",
+        "reference_temperature",
+        "quiet_switch",
+        "quiet_hours",
+        "trigger_entity",
+        "sensor_hold",
+        "fan",
+        "fan_resync",
+        "publish_state",
+        "save_snapshot",
+        "timeout",
+        "trigger",
+    )
+    # upper bounds of the latency buckets in seconds; one more bucket is +Inf
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1, 1.0)
+    WIDTH = len(LATENCY_BUCKETS) + 1
+
+    def __init__(self, transitions):
+        self.transitions = list(transitions)
+        self.transition_counts = array("q", [0]) * len(self.transitions)
+        self.counters = array("q", [0]) * len(self.COUNTERS)
+        self.latency_counts = array("q", [0]) * (len(self.HISTOGRAMS) * self.WIDTH)
+        self.latency_sums = array("d", [0.0]) * len(self.HISTOGRAMS)
+
+    def count(self, counter):
+        self.counters[counter] += 1
+
+    def observe(self, histogram, seconds):
+        self.latency_counts[
+            histogram * self.WIDTH + bisect_left(self.LATENCY_BUCKETS, seconds)
+        ] += 1
+        self.latency_sums[histogram] += seconds
+
+    def histogram(self, histogram):
+        """Bucket counts (not cumulative), the last one for +Inf."""
+        start = histogram * self.WIDTH
+        return self.latency_counts[start : start + self.WIDTH]
+
+    def attributes(self):
+        return {
+            "transitions": {
+                f"{state} / {input}": self.transition_counts[i]
+                for i, (state, input) in enumerate(self.transitions)
+            },
+            **dict(zip(self.COUNTERS, self.counters)),
+            "latency_buckets_ms": [bound * 1000 for bound in self.LATENCY_BUCKETS],
+            "latency": {
+                name: {
+                    "count": sum(self.histogram(i)),
+                    "sum_ms": self.latency_sums[i] * 1000,
+                    "buckets": list(self.histogram(i)),
+                }
+                for i, name in enumerate(self.HISTOGRAMS)
+            },
+        }
+
+    def prometheus(self, app):
+        """The metrics in Prometheus text format, labelled with the app name."""
+        lines = [
+            "# TYPE shower_fan_transitions_total counter",
+            *(
+                f'shower_fan_transitions_total{{app="{app}",state="{state}",'
+                f'input="{input}"}} {self.transition_counts[i]}'
+                for i, (state, input) in enumerate(self.transitions)
+            ),
+            "# TYPE shower_fan_invalid_transitions_total counter",
+            f'shower_fan_invalid_transitions_total{{app="{app}"}} '
+            f"{self.counters[self.INVALID_TRANSITIONS]}",
+            "# TYPE shower_fan_calls_total counter",
+            *(
+                f'shower_fan_calls_total{{app="{app}",call="{self.COUNTERS[i]}"}} '
+                f"{self.counters[i]}"
+                for i in self.CALLS
+            ),
+            "# TYPE shower_fan_merged_events_total counter",
+            f'shower_fan_merged_events_total{{app="{app}"}} '
+            f"{self.counters[self.MERGED_EVENTS]}",
+            "# TYPE shower_fan_parse_failures_total counter",
+            f'shower_fan_parse_failures_total{{app="{app}"}} '
+            f"{self.counters[self.PARSE_FAILURES]}",
+            "# TYPE shower_fan_callback_seconds histogram",
+        ]
+        for i, name in enumerate(self.HISTOGRAMS):
+            labels = f'app="{app}",callback="{name}"'
+            total = 0
+            for bound, count in zip(
+                self.LATENCY_BUCKETS + ("+Inf",), self.histogram(i)
+            ):
+                total += count
+                lines.append(
+                    f'shower_fan_callback_seconds_bucket{{{labels},le="{bound}"}} '
+                    f"{total}"
+                )
+            lines.append(
+                f"shower_fan_callback_seconds_sum{{{labels}}} {self.latency_sums[i]}"
+            )
+            lines.append(f"shower_fan_callback_seconds_count{{{labels}}} {total}")
+        return "\n".join(lines) + "\n"
+
+
+class TransitionTrace:
+    """Ring buffer of the last `size` inputs to the state machine.
+
+    A record is the time, the state before, the input, the state after and the
+    humidity then, stored as codes and floats in parallel arrays. An input that
+    has no transition is recorded with the same state before and after.
+    """
+
+    CSV_FIELDS = ("time", "state", "input", "target", "humidity")
+
+    def __init__(self, size, states, inputs):
+        self.size = size
+        self.states = states
+        self.inputs = inputs
+        self._state_codes = {state: code for code, state in enumerate(states)}
+        self._input_codes = {input: code for code, input in enumerate(inputs)}
+        self.times = array("d", [0.0]) * size
+        self.from_states = array("b", [0]) * size
+        self.input_codes = array("b", [0]) * size
+        self.to_states = array("b", [0]) * size
+        self.humidity = array("d", [0.0]) * size
+        self.count = 0
+        self.next = 0
+
+    def record(self, timestamp, state, input, target, humidity):
+        i = self.next
+        self.times[i] = timestamp
+        self.from_states[i] = self._state_codes[state]
+        self.input_codes[i] = self._input_codes[input]
+        self.to_states[i] = self._state_codes[target]
+        self.humidity[i] = _NAN if humidity is None else humidity
+        self.next = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def records(self):
+        """The records as dicts, oldest first."""
+        oldest = self.next if self.count == self.size else 0
+        for k in range(self.count):
+            i = (oldest + k) % self.size
+            humidity = self.humidity[i]
+            yield {
+                "time": self.times[i],
+                "state": self.states[self.from_states[i]],
+                "input": self.inputs[self.input_codes[i]],
+                "target": self.states[self.to_states[i]],
+                "humidity": None if humidity != humidity else humidity,
+            }
+
+    def to_json(self):
+        return json.dumps(list(self.records()))
+
+    def to_csv(self):
+        text = io.StringIO()
+        writer = csv.DictWriter(text, self.CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(self.records())
+        return text.getvalue()
+
+
+_NAN = float("nan")
+
+
+def _timed(histogram):
+    """Records the wall time of each call in the app's `histogram` latency."""
+    index = Metrics.HISTOGRAMS.index(histogram)
+    clock = time.perf_counter
+
+    def decorator(method):
+        @functools.wraps(method)
+        def timed(self, *args, **kwargs):
+            started = clock()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(index, clock() - started)
+
+        return timed
+
+    return decorator
 
 
 class ShowerFan(hass.Hass):
+    # shared by every app in this AppDaemon
+    fan_commands = FanCommandBatcher()
+
     # states
     INIT = "init"
     OFF = "off"
@@ -31,30 +844,198 @@ class ShowerFan(hass.Hass):
     TIMEOUT = "timeout"
     BEGIN_QUIET = "begin quiet"
     END_QUIET = "end quiet"
+    OCCUPIED = "occupied"
+    VACATED = "vacated"
+
+    STATES = (INIT, OFF, EXTRACTION, DRYING, QUIET, QUIET_EXTRACTION)
+    INPUTS = (
+        TURNED_ON,
+        TURNED_OFF,
+        HIGH_HUMIDITY,
+        LOW_HUMIDITY,
+        TIMEOUT,
+        BEGIN_QUIET,
+        END_QUIET,
+        OCCUPIED,
+        VACATED,
+    )
+
+    # (state, input) -> target state. Drives `trigger` and the README diagram.
+    TRANSITIONS = {
+        (INIT, TURNED_ON): EXTRACTION,
+        (INIT, TURNED_OFF): OFF,
+        (INIT, BEGIN_QUIET): QUIET,
+        (OFF, TURNED_ON): EXTRACTION,
+        (OFF, HIGH_HUMIDITY): DRYING,
+        (OFF, BEGIN_QUIET): QUIET,
+        (OFF, OCCUPIED): EXTRACTION,
+        (EXTRACTION, TIMEOUT): OFF,
+        (EXTRACTION, TURNED_OFF): OFF,
+        (EXTRACTION, HIGH_HUMIDITY): DRYING,
+        (EXTRACTION, BEGIN_QUIET): QUIET,
+        (EXTRACTION, OCCUPIED): EXTRACTION,
+        (EXTRACTION, VACATED): EXTRACTION,
+        (DRYING, LOW_HUMIDITY): OFF,
+        (DRYING, TURNED_OFF): OFF,
+        (DRYING, TIMEOUT): OFF,
+        (DRYING, BEGIN_QUIET): QUIET,
+        (QUIET, TURNED_ON): QUIET_EXTRACTION,
+        (QUIET, END_QUIET): OFF,
+        (QUIET_EXTRACTION, TIMEOUT): QUIET,
+        (QUIET_EXTRACTION, TURNED_OFF): QUIET,
+        (QUIET_EXTRACTION, END_QUIET): OFF,
+    }
+
+    # target state -> action entering it
+    ACTIONS = {
+        OFF: "set_off",
+        EXTRACTION: "set_extraction",
+        DRYING: "set_drying",
+        QUIET: "set_quiet",
+        QUIET_EXTRACTION: "set_quiet_extraction",
+    }
 
     def initialize(self):
-        self.reference_humidity_sensor = self.args.get(CONFIG_REFERENCE_HUMIDITY_SENSOR)
+        self.metrics = Metrics(ShowerFan.TRANSITIONS)
+
+        # callbacks can arrive on several worker threads; their events are
+        # queued here and handled in order by one thread at a time
+        self._inbox = deque()
+        self._inbox_lock = threading.Lock()
+        self._inbox_keys = {}
+        self._inbox_draining = False
+
+        # checked once: hot paths skip building DEBUG messages nobody will see
+        self.debug_enabled = bool(self.get_main_log().isEnabledFor(logging.DEBUG))
+
+        self.reference_humidity_sensors = _entities(
+            self.args.get(CONFIG_REFERENCE_HUMIDITY_SENSOR)
+        )
         self.humidity_sensor = self.args.get(CONFIG_HUMIDITY_SENSOR)
+
+        # relative humidity, or absolute humidity or dew point worked out with
+        # the rooms' temperatures; the thresholds are in the chosen units
+        self.humidity_comparison = self.args.get(
+            CONFIG_HUMIDITY_COMPARISON, HUMIDITY_COMPARISON_RELATIVE
+        )
+        if self.humidity_comparison not in HUMIDITY_CONVERSIONS:
+            raise ValueError(
+                f"Unknown humidity comparison '{self.humidity_comparison}'"
+            )
+        self.humidity_conversion = HUMIDITY_CONVERSIONS[self.humidity_comparison]
+        high, low = DEFAULT_HUMIDITY_THRESHOLDS[self.humidity_comparison]
         self.humidity_relative_high = float(
-            self.args.get(CONFIG_HUMIDITY_RELATIVE_HIGH, DEFAULT_HUMIDITY_RELATIVE_HIGH)
+            self.args.get(CONFIG_HUMIDITY_RELATIVE_HIGH, high)
         )
         self.humidity_relative_low = float(
-            self.args.get(CONFIG_HUMIDITY_RELATIVE_LOW, DEFAULT_HUMIDITY_RELATIVE_LOW)
+            self.args.get(CONFIG_HUMIDITY_RELATIVE_LOW, low)
         )
 
+        # quiet when the switch is on or within the quiet hours; either is optional
         self.quiet_switch = self.args.get(CONFIG_QUIET_SWITCH)
-        self.log(f"Quiet switch: {self.quiet_switch}", level=DEBUG)
-        self.listen_state(self._on_quiet_switch_state, self.quiet_switch)
+        if self.quiet_switch:
+            self.log(f"Quiet switch: {self.quiet_switch}", level=DEBUG)
+            self.listen_state(self._on_quiet_switch_state, self.quiet_switch)
+        self.quiet_hours = None
+        if self.args.get(CONFIG_QUIET_HOURS):
+            self.quiet_hours = QuietHours(self.args[CONFIG_QUIET_HOURS])
+        self.quiet_switch_on = False
+        self.in_quiet_hours = False
+        self.quiet_period = None
+        self.quiet_hours_boundary = None
+
+        # latest parsed readings; the reference is pushed to us rather than
+        # fetched on every bathroom reading. `humidity` and `reference_humidity`
+        # are in the comparison's units, the others as the sensors report them
+        self.humidity = None
+        self.reference_humidity = None
+        self.relative_humidity = None
+        self.temperature = None
+        self.reference_temperature = None
 
-        if self.reference_humidity_sensor:
+        # a sensor without a reading keeps its last good value this long; the
+        # machine holds its state meanwhile and drying can still time out
+        self.sensor_hold_seconds = (
+            float(
+                self.args.get(CONFIG_SENSOR_HOLD_MINUTES, DEFAULT_SENSOR_HOLD_MINUTES)
+            )
+            * 60
+        )
+        self.humidity_reading = SensorReading()
+        self.temperature_reading = SensorReading()
+        self.reference_temperature_reading = SensorReading()
+
+        self.temperature_sensor = None
+        self.reference_temperature_sensor = None
+        if self.humidity_conversion is not None:
+            for key in (CONFIG_TEMPERATURE_SENSOR, CONFIG_REFERENCE_TEMPERATURE_SENSOR):
+                if not self.args.get(key):
+                    raise ValueError(
+                        f"Humidity comparison '{self.humidity_comparison}' needs {key}"
+                    )
+            self.temperature_sensor = self.args.get(CONFIG_TEMPERATURE_SENSOR)
+            self.log(f"Temperature sensor: {self.temperature_sensor}", level=DEBUG)
+            self.metrics.count(Metrics.GET_STATE)
+            self.temperature_reading.update(
+                self.get_state(self.temperature_sensor), self.clock()
+            )
+            self.temperature = self.temperature_reading.value
+            self.listen_state(self._on_temperature_state, self.temperature_sensor)
+
+            self.reference_temperature_sensor = self.args.get(
+                CONFIG_REFERENCE_TEMPERATURE_SENSOR
+            )
             self.log(
-                f"Reference humidity sensor: {self.reference_humidity_sensor}",
+                f"Reference temperature sensor: {self.reference_temperature_sensor}",
                 level=DEBUG,
             )
+            self.metrics.count(Metrics.GET_STATE)
+            self.reference_temperature_reading.update(
+                self.get_state(self.reference_temperature_sensor), self.clock()
+            )
+            self.reference_temperature = self.reference_temperature_reading.value
+            self.listen_state(
+                self._on_reference_temperature_state,
+                self.reference_temperature_sensor,
+            )
+
+        # one or more sensors; several are combined by `reference`
+        self.setup_reference_humidity(
+            self.args.get(
+                CONFIG_REFERENCE_HUMIDITY_AGGREGATE,
+                DEFAULT_REFERENCE_HUMIDITY_AGGREGATE,
+            ),
+            float(
+                self.args.get(
+                    CONFIG_REFERENCE_HUMIDITY_STALE_MINUTES,
+                    DEFAULT_REFERENCE_HUMIDITY_STALE_MINUTES,
+                )
+            )
+            * 60,
+        )
+        self.update_reference_humidity(self.clock())
+
+        # rate of rise (% per minute) that starts drying before the absolute
+        # threshold is crossed
+        self.humidity_slope_high = _to_float(self.args.get(CONFIG_HUMIDITY_SLOPE_HIGH))
+        self.humidity_trend = None
+        if self.humidity_slope_high is not None:
+            self.humidity_trend = HumidityTrend(
+                int(
+                    self.args.get(
+                        CONFIG_HUMIDITY_SLOPE_SAMPLES, DEFAULT_HUMIDITY_SLOPE_SAMPLES
+                    )
+                )
+            )
 
         if self.humidity_sensor:
             self.log(f"Humidity sensor: {self.humidity_sensor}", level=DEBUG)
-            self.listen_state(self._log_entity_state, self.humidity_sensor)
+            self.metrics.count(Metrics.GET_STATE)
+            self.humidity_reading.update(
+                self.get_state(self.humidity_sensor), self.clock()
+            )
+            self.relative_humidity = self.humidity_reading.value
+            self.update_humidity()
             self.listen_state(self._on_humidity_state, self.humidity_sensor)
 
         self.fan = self.args.get(CONFIG_FAN)
@@ -67,11 +1048,140 @@ class ShowerFan(hass.Hass):
             )
             * 60
         )
+        self.drying_timeout_seconds = (
+            float(
+                self.args.get(
+                    CONFIG_DRYING_TIMEOUT_MINUTES, DRYING_TIMEOUT_SECONDS / 60
+                )
+            )
+            * 60
+        )
+        # predicts the end of drying from the humidity decay and learns how
+        # long drying takes in this bathroom
+        self.decay_fit = None
+        if _to_bool(self.args.get(CONFIG_DRYING_PREDICTION, False)):
+            self.decay_fit = DecayFit()
+        self.drying_started = None
+        self.learned_drying_seconds = None
+
+        # a light, door or occupancy sensor turning on starts extraction before
+        # the humidity rises; it runs on for a while once they are all off
+        self.trigger_entities = _entities(self.args.get(CONFIG_TRIGGER_ENTITIES))
+        self.trigger_run_on_seconds = (
+            float(
+                self.args.get(
+                    CONFIG_TRIGGER_RUN_ON_MINUTES, DEFAULT_TRIGGER_RUN_ON_MINUTES
+                )
+            )
+            * 60
+        )
+        self.active_triggers = set()
+        for entity in self.trigger_entities:
+            self.log(f"Trigger entity: {entity}", level=DEBUG)
+            self.metrics.count(Metrics.GET_STATE)
+            if self.get_state(entity) == "on":
+                self.active_triggers.add(entity)
+            self.listen_state(self._on_trigger_entity_state, entity)
+        self.occupied = bool(self.active_triggers)
+
+        # one logical deadline; the armed scheduler callback (due at
+        # fan_timeout_due) may be earlier and re-arms itself for the rest
+        self.fan_timeout_deadline = None
         self.fan_timeout_handle = None
+        self.fan_timeout_due = None
+        self.scheduler_operations = 0
         self.current_state = ShowerFan.INIT
+        # (state, input) -> (action, index of its transition counter)
+        self._transitions = {
+            key: (getattr(self, ShowerFan.ACTIONS[target]), index)
+            for index, (key, target) in enumerate(ShowerFan.TRANSITIONS.items())
+        }
 
+        # shadow copy of the fan state, kept current by _on_fan_state and our own
+        # service calls, so transitions don't need a get_state round-trip
+        self.metrics.count(Metrics.GET_STATE)
+        self.fan_state = self.get_state(self.fan)
         self.listen_state(self._on_fan_state, self.fan)
 
+        fan_resync_seconds = (
+            float(self.args.get(CONFIG_FAN_RESYNC_MINUTES, DEFAULT_FAN_RESYNC_MINUTES))
+            * 60
+        )
+        if fan_resync_seconds > 0:
+            self.schedule_fan_resync(fan_resync_seconds)
+
+        # variable speed while drying, for fans taking a percentage
+        self.fan_percentage_gain = _to_float(self.args.get(CONFIG_FAN_PERCENTAGE_GAIN))
+        self.fan_percentage_min = float(
+            self.args.get(CONFIG_FAN_PERCENTAGE_MIN, DEFAULT_FAN_PERCENTAGE_MIN)
+        )
+        self.fan_percentage_interval_seconds = float(
+            self.args.get(
+                CONFIG_FAN_PERCENTAGE_INTERVAL_SECONDS,
+                DEFAULT_FAN_PERCENTAGE_INTERVAL_SECONDS,
+            )
+        )
+        self.fan_percentage = None
+        self.fan_percentage_sent_at = None
+
+        self.fan_command_batch_seconds = float(
+            self.args.get(
+                CONFIG_FAN_COMMAND_BATCH_SECONDS, DEFAULT_FAN_COMMAND_BATCH_SECONDS
+            )
+        )
+
+        self.state_sensor_publish = self.args.get(
+            CONFIG_STATE_SENSOR_PUBLISH, DEFAULT_STATE_SENSOR_PUBLISH
+        )
+        self.state_sensor_coalesce_seconds = float(
+            self.args.get(
+                CONFIG_STATE_SENSOR_COALESCE_SECONDS,
+                DEFAULT_STATE_SENSOR_COALESCE_SECONDS,
+            )
+        )
+        self.last_input = None
+        self.previous_state = None
+        self.published_state = None
+        self.suppressed_state_writes = 0
+        self.coalesced_state_writes = 0
+        self._publish_handle = None
+
+        # state saved across restarts; `{name}` in the path is the app's name
+        self.snapshot_file = self.args.get(CONFIG_SNAPSHOT_FILE)
+        if self.snapshot_file:
+            self.snapshot_file = self.app_file(self.snapshot_file)
+        self.snapshot_coalesce_seconds = float(
+            self.args.get(
+                CONFIG_SNAPSHOT_COALESCE_SECONDS, DEFAULT_SNAPSHOT_COALESCE_SECONDS
+            )
+        )
+        self._snapshot_handle = None
+
+        self.metrics_file = self.args.get(CONFIG_METRICS_FILE)
+        if self.metrics_file:
+            self.metrics_file = self.app_file(self.metrics_file)
+        metrics_publish_seconds = (
+            float(
+                self.args.get(
+                    CONFIG_METRICS_PUBLISH_MINUTES, DEFAULT_METRICS_PUBLISH_MINUTES
+                )
+            )
+            * 60
+        )
+        if metrics_publish_seconds > 0:
+            self.run_every(
+                self._on_publish_metrics,
+                f"now+{metrics_publish_seconds}",
+                metrics_publish_seconds,
+            )
+
+        trace_size = int(self.args.get(CONFIG_TRACE_SIZE, DEFAULT_TRACE_SIZE))
+        self.trace = None
+        self.trace_directory = self.args.get(CONFIG_TRACE_DIRECTORY)
+        if trace_size > 0:
+            self.trace = TransitionTrace(trace_size, ShowerFan.STATES, ShowerFan.INPUTS)
+            self.listen_event(self._on_dump_trace_event, TRACE_DUMP_EVENT)
+
         self.log(
             f"{self.fan} configured with {self.fan_off_delay_seconds} off delay",
             level=DEBUG,
@@ -81,126 +1191,485 @@ class ShowerFan(hass.Hass):
 
     # commands -----------------
 
+    def terminate(self):
+        self.fan_commands.release(self)
+        if getattr(self, "_snapshot_handle", None) is not None:
+            # its timer goes with the app, and a restart is what it is for
+            self._snapshot_handle = None
+            self.write_snapshot()
+
+    def app_file(self, path):
+        """`path` with `{name}` replaced by the app's name."""
+        return path.replace("{name}", self.name)
+
+    def setup_reference_humidity(self, aggregate, stale_seconds):
+        self.reference = ReferenceHumidity(aggregate, stale_seconds)
+        self.reference_readings = {}
+        for sensor in self.reference_humidity_sensors:
+            self.log(f"Reference humidity sensor: {sensor}", level=DEBUG)
+            self.metrics.count(Metrics.GET_STATE)
+            reading = self.reference_readings[sensor] = SensorReading()
+            reading.update(self.get_state(sensor), self.clock())
+            self.reference.update(sensor, self.clock(), reading.value)
+            self.listen_state(self._on_reference_humidity_state, sensor)
+
+    def schedule_fan_resync(self, seconds):
+        self.run_every(self._on_fan_resync, f"now+{seconds}", seconds)
+
     def restore_state(self):
-        is_quiet_period = self.get_state(self.quiet_switch) == "on"
+        if self.quiet_switch:
+            self.metrics.count(Metrics.GET_STATE)
+            self.quiet_switch_on = self.get_state(self.quiet_switch) == "on"
+        if self.quiet_hours is not None:
+            now = self.local_time()
+            self.in_quiet_hours = self.quiet_hours.is_quiet(_seconds_of_week(now))
+            self.schedule_quiet_hours(now)
+        is_quiet_period = self.quiet_period = self.is_quiet_period()
+        # read before BEGIN_QUIET switches the cached fan state off
+        is_on = self.is_on()
+
+        if self.restore_snapshot(is_quiet_period, is_on):
+            return
 
         if is_quiet_period:
             self.trigger(ShowerFan.BEGIN_QUIET)
-            if self.is_on():
+            if is_on:
                 self.trigger(ShowerFan.TURNED_ON)
-        elif self.is_on():
+        elif is_on:
             self.trigger(ShowerFan.TURNED_ON)
         else:
             self.trigger(ShowerFan.TURNED_OFF)
 
+    def restore_snapshot(self, is_quiet_period, is_on):
+        """Resumes the state saved before a restart, with its remaining timeout,
+        if it agrees with the live quiet switch and fan; returns whether it did."""
+        snapshot = self.read_snapshot()
+        if snapshot is None:
+            return False
+
+        self.learned_drying_seconds = snapshot.get("learned_drying_seconds")
+
+        state = snapshot.get("state")
+        deadline = snapshot.get("deadline")
+        if state not in ShowerFan.ACTIONS:
+            return False
+        if (state in (ShowerFan.QUIET, ShowerFan.QUIET_EXTRACTION)) != is_quiet_period:
+            return False
+        timed = state in (
+            ShowerFan.EXTRACTION,
+            ShowerFan.DRYING,
+            ShowerFan.QUIET_EXTRACTION,
+        )
+        if timed != is_on or timed != (deadline is not None):
+            return False
+
+        if self.humidity_trend is not None:
+            for timestamp, humidity in snapshot.get("humidity_trend", []):
+                self.humidity_trend.add(timestamp, humidity)
+
+        self.current_state = state
+        if state == ShowerFan.DRYING:
+            self.drying_started = snapshot.get("drying_started")
+        if timed:
+            # an expired deadline times out straight away
+            self.begin_timeout(max(deadline - self.clock(), 0))
+        self.previous_state = ShowerFan.INIT
+        self.publish_state()
+        self.log(f"Resumed '{state}' from {self.snapshot_file}", level=DEBUG)
+        return True
+
+    def read_snapshot(self):
+        if not self.snapshot_file:
+            return None
+        try:
+            with open(self.snapshot_file) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            self.log(
+                f"Ignoring snapshot {self.snapshot_file}: {error}", level="WARNING"
+            )
+            return None
+
+    def save_snapshot(self):
+        if not self.snapshot_file:
+            return
+        if self.snapshot_coalesce_seconds <= 0:
+            self.write_snapshot()
+        elif self._snapshot_handle is None:
+            self._snapshot_handle = self.run_in(
+                self._on_save_snapshot, self.snapshot_coalesce_seconds
+            )
+
+    def write_snapshot(self):
+        snapshot = {
+            "state": self.current_state,
+            "deadline": self.fan_timeout_deadline,
+            "saved_at": self.clock(),
+            "humidity": self.humidity,
+            "reference_humidity": self.reference_humidity,
+            "drying_started": self.drying_started,
+            "learned_drying_seconds": self.learned_drying_seconds,
+        }
+        if self.humidity_trend is not None:
+            snapshot["humidity_trend"] = list(self.humidity_trend.samples())
+
+        try:
+            _replace_file(
+                self.snapshot_file, json.dumps(snapshot, separators=(",", ":"))
+            )
+        except OSError as error:
+            self.log(
+                f"Could not write snapshot {self.snapshot_file}: {error}",
+                level="WARNING",
+            )
+
+    # the cached state only follows commands that did not raise, so a failed one
+    # is sent again on the next transition
+
     def turn_on(self):
-        if not self.is_on():
-            self.call_service("homeassistant/turn_on", entity_id=self.fan)
+        if not self.is_on() and self.send_fan_command("homeassistant/turn_on"):
+            self.fan_state = "on"
 
     def turn_off(self):
-        if self.is_on():
-            self.call_service("homeassistant/turn_off", entity_id=self.fan)
+        if self.is_on() and self.send_fan_command("homeassistant/turn_off"):
+            self.fan_state = "off"
+        self.fan_percentage = None
+
+    def set_fan_percentage(self, percentage):
+        if not self.call_fan_service("fan/set_percentage", percentage=percentage):
+            return
+        self.fan_state = "on"
+        self.fan_percentage = percentage
+        self.fan_percentage_sent_at = self.clock()
+
+    def drying_percentage(self):
+        """Fan speed for the humidity left to remove: `fan_percentage_min` at the
+        low threshold plus `fan_percentage_gain` per % above it."""
+        humidity = self.humidity
+        reference_humidity = self.reference_humidity
+        if humidity is None or reference_humidity is None:
+            return 100
+        excess = humidity - (reference_humidity + self.humidity_relative_low)
+        percentage = self.fan_percentage_min + self.fan_percentage_gain * max(excess, 0)
+        percentage = FAN_PERCENTAGE_STEP * round(percentage / FAN_PERCENTAGE_STEP)
+        return int(min(max(percentage, self.fan_percentage_min), 100))
+
+    def adjust_drying_speed(self):
+        # at most one speed command per interval; the next reading catches up
+        if (
+            self.fan_percentage_sent_at is not None
+            and self.clock() - self.fan_percentage_sent_at
+            < self.fan_percentage_interval_seconds
+        ):
+            return
+        percentage = self.drying_percentage()
+        if percentage != self.fan_percentage:
+            self.set_fan_percentage(percentage)
+
+    def send_fan_command(self, service):
+        """Sends, or queues for the batch, a fan command; False if it failed."""
+        if self.fan_command_batch_seconds > 0:
+            # failures are reported back through on_fan_command_failed
+            self.fan_commands.submit(
+                self, service, self.fan, self.fan_command_batch_seconds
+            )
+            return True
+        return self.call_fan_service(service)
+
+    def call_fan_service(self, service, **data):
+        self.metrics.count(Metrics.CALL_SERVICE)
+        # AppDaemon returns None for a call made without return_result, so only
+        # an exception tells a failure
+        try:
+            self.call_service(service, entity_id=self.fan, **data)
+        except Exception as error:
+            self.log(f"{service} failed for {self.fan}: {error}", level="WARNING")
+            return False
+        return True
 
     def is_on(self):
-        return self.get_state(self.fan) == "on"
+        return self.fan_state == "on"
 
     def begin_timeout(self, duration):
-        self.end_timeout()
-        self.fan_timeout_handle = self.run_in(self.on_timeout, duration)
-
-    def end_timeout(self):
+        now = self.clock()
+        self.fan_timeout_deadline = now + duration
         if self.fan_timeout_handle is not None:
-            # already on with delay
+            if self.fan_timeout_due <= self.fan_timeout_deadline:
+                # fires first and re-arms for the remainder
+                return
             self.cancel_timer(self.fan_timeout_handle)
+            self.scheduler_operations += 1
+        self._arm_timeout(now, duration)
 
-        self.fan_timeout_handle = None
+    def end_timeout(self):
+        # an armed callback is left to find no deadline rather than cancelled
+        self.fan_timeout_deadline = None
+
+    def _arm_timeout(self, now, delay):
+        self.fan_timeout_handle = self.run_in(self.on_timeout, delay)
+        self.fan_timeout_due = now + delay
+        self.scheduler_operations += 1
+
+    def evaluate_humidity(self):
+        if self.reference.stale_seconds > 0:
+            self.update_reference_humidity(self.clock())
+        humidity = self.humidity
+        reference_humidity = self.reference_humidity
+        if humidity is None or reference_humidity is None:
+            return
+
+        if self.debug_enabled:
+            self.debug(
+                "humidity: %s, reference_humidity: %s", humidity, reference_humidity
+            )
+
+        if humidity > (reference_humidity + self.humidity_relative_high):
+            self.trigger(ShowerFan.HIGH_HUMIDITY)
+        elif self.is_humidity_rising():
+            self.trigger(ShowerFan.HIGH_HUMIDITY)
+        elif humidity < (reference_humidity + self.humidity_relative_low):
+            self.trigger(ShowerFan.LOW_HUMIDITY)
+
+        if self.current_state == ShowerFan.DRYING:
+            if self.decay_fit is not None:
+                self.predict_drying_end(humidity - reference_humidity)
+            if self.fan_percentage_gain is not None:
+                self.adjust_drying_speed()
+
+    def predict_drying_end(self, excess):
+        now = self.clock()
+        self.decay_fit.add(now, excess)
+        if self.drying_started is None:
+            return
+        deadline = self.drying_started + self.drying_timeout()
+        dry_at = self.decay_fit.predict(self.humidity_relative_low)
+        # a crossing already past disagrees with this reading, still above the
+        # threshold; the threshold check per reading ends drying instead
+        if dry_at is not None and now < dry_at < deadline:
+            deadline = dry_at
+        if (
+            self.fan_timeout_deadline is None
+            or abs(deadline - self.fan_timeout_deadline) > TIMEOUT_TOLERANCE_SECONDS
+        ):
+            self.begin_timeout(max(deadline - now, 0))
+            self.save_snapshot()
+
+    def drying_timeout(self):
+        """`drying_timeout_minutes`, or less once this bathroom's usual drying
+        time is known."""
+        if self.learned_drying_seconds is None:
+            return self.drying_timeout_seconds
+        return min(
+            self.drying_timeout_seconds,
+            max(
+                DRYING_TIMEOUT_FACTOR * self.learned_drying_seconds,
+                self.fan_off_delay_seconds,
+            ),
+        )
+
+    def learn_drying_time(self):
+        if self.drying_started is None:
+            return
+        # only drying that reached the low threshold counts, not a fan switched
+        # off by hand or a timeout with the bathroom still humid
+        if self.last_input == ShowerFan.TIMEOUT:
+            humidity = self.humidity
+            reference_humidity = self.reference_humidity
+            if (
+                humidity is None
+                or reference_humidity is None
+                or humidity - reference_humidity > self.humidity_relative_low
+            ):
+                return
+        elif self.last_input != ShowerFan.LOW_HUMIDITY:
+            return
+        duration = self.clock() - self.drying_started
+        if self.learned_drying_seconds is None:
+            self.learned_drying_seconds = duration
+        else:
+            self.learned_drying_seconds += DRYING_TIME_SMOOTHING * (
+                duration - self.learned_drying_seconds
+            )
+
+    def is_humidity_rising(self):
+        if self.humidity_trend is None:
+            return False
+        slope = self.humidity_trend.slope()
+        return slope is not None and slope * 60 >= self.humidity_slope_high
+
+    def clock(self):
+        """Seconds since the epoch; the offline tools substitute a simulated clock."""
+        return time.time()
+
+    def local_time(self):
+        """AppDaemon's current time, naive in its `time_zone` as `run_at` reads it."""
+        return self.datetime()
 
     # state machine -------------------
 
+    def submit(self, handler, *args, key=None):
+        """Queues `handler(*args)` behind the events already queued and handles
+        the queue unless another thread already is. An event with a `key`
+        supersedes a queued event with the same key, e.g. an older reading."""
+        entry = [handler, args, key]
+        with self._inbox_lock:
+            if key is not None:
+                superseded = self._inbox_keys.get(key)
+                if superseded is not None:
+                    superseded[0] = None
+                    self.metrics.count(Metrics.MERGED_EVENTS)
+                self._inbox_keys[key] = entry
+            self._inbox.append(entry)
+            if self._inbox_draining:
+                return
+            self._inbox_draining = True
+        self._drain_inbox()
+
+    def _drain_inbox(self):
+        inbox = self._inbox
+        while True:
+            with self._inbox_lock:
+                if not inbox:
+                    self._inbox_draining = False
+                    return
+                entry = inbox.popleft()
+                handler, args, key = entry
+                if key is not None and self._inbox_keys.get(key) is entry:
+                    del self._inbox_keys[key]
+            if handler is None:
+                continue
+            try:
+                handler(*args)
+            except BaseException:
+                # the events left are handled after the next one arrives
+                with self._inbox_lock:
+                    self._inbox_draining = False
+                raise
+
+    @_timed("trigger")
     def trigger(self, input):
         previous_state = self.current_state
-        if self.current_state == ShowerFan.INIT:
-            if input == ShowerFan.TURNED_ON:
-                self.set_extraction()
-            elif input == ShowerFan.TURNED_OFF:
-                self.set_off()
-            elif input == ShowerFan.BEGIN_QUIET:
-                self.set_quiet()
-            else:
-                self.log_invalid_transition(input)
-                return
-        elif self.current_state == ShowerFan.OFF:
-            if input == ShowerFan.TURNED_ON:
-                self.set_extraction()
-            elif input == ShowerFan.HIGH_HUMIDITY:
-                self.set_drying()
-            elif input == ShowerFan.BEGIN_QUIET:
-                self.set_quiet()
-            else:
-                self.log_invalid_transition(input)
-                return
-        elif self.current_state == ShowerFan.EXTRACTION:
-            if input == ShowerFan.TIMEOUT:
-                self.set_off()
-            elif input == ShowerFan.TURNED_OFF:
-                self.set_off()
-            elif input == ShowerFan.HIGH_HUMIDITY:
-                self.set_drying()
-            elif input == ShowerFan.BEGIN_QUIET:
-                self.set_quiet()
-            else:
-                self.log_invalid_transition(input)
-                return
-        elif self.current_state == ShowerFan.DRYING:
-            if input == ShowerFan.LOW_HUMIDITY:
-                self.set_off()
-            elif input == ShowerFan.TURNED_OFF:
-                self.set_off()
-            elif input == ShowerFan.TIMEOUT:
-                self.set_off()
-            elif input == ShowerFan.BEGIN_QUIET:
-                self.set_quiet()
-            else:
-                self.log_invalid_transition(input)
-                return
-        elif self.current_state == ShowerFan.QUIET:
-            if input == ShowerFan.TURNED_ON:
-                self.set_quiet_extraction()
-            elif input == ShowerFan.END_QUIET:
-                self.set_off()
-            else:
-                self.log_invalid_transition(input)
-                return
-        elif self.current_state == ShowerFan.QUIET_EXTRACTION:
-            if input == ShowerFan.TIMEOUT:
-                self.set_quiet()
-            elif input == ShowerFan.TURNED_OFF:
-                self.set_quiet()
-            elif input == ShowerFan.END_QUIET:
-                self.set_off()
-            else:
-                self.log_invalid_transition(input)
-                return
-        else:
+        transition = self._transitions.get((previous_state, input))
+        if transition is None:
+            self.metrics.count(Metrics.INVALID_TRANSITIONS)
+            if self.trace is not None:
+                self.trace.record(
+                    self.clock(), previous_state, input, previous_state, self.humidity
+                )
             self.log_invalid_transition(input)
             return
-        self.log(
-            f"Transitioned from '{previous_state}' to '{self.current_state}' on '{input}'",
-            level=DEBUG,
-        )
+        action, index = transition
+        self.metrics.transition_counts[index] += 1
+        # set first: actions may depend on what caused them
+        self.last_input = input
+        action()
+        if self.trace is not None:
+            self.trace.record(
+                self.clock(), previous_state, input, self.current_state, self.humidity
+            )
+        if self.debug_enabled:
+            self.debug(
+                "Transitioned from '%s' to '%s' on '%s'",
+                previous_state,
+                self.current_state,
+                input,
+            )
+        self.previous_state = previous_state
+        self.publish_state()
+        self.save_snapshot()
+
+    def publish_state(self):
+        if self.state_sensor_coalesce_seconds > 0:
+            if self._publish_handle is None:
+                self._publish_handle = self.run_in(
+                    self._on_publish_state, self.state_sensor_coalesce_seconds
+                )
+            else:
+                self.coalesced_state_writes += 1
+            return
+
+        self._write_state_sensor()
+
+    def _write_state_sensor(self):
+        if (
+            self.state_sensor_publish == STATE_SENSOR_PUBLISH_CHANGES
+            and self.current_state == self.published_state
+        ):
+            self.suppressed_state_writes += 1
+            return
+
+        self.metrics.count(Metrics.SET_STATE)
         self.set_state(
             f"sensor.{self.name}_fan_state_machine",
             state=self.current_state,
-            attributes={"input": input, "previous_state": previous_state},
+            attributes={
+                "input": self.last_input,
+                "previous_state": self.previous_state,
+                "suppressed_writes": self.suppressed_state_writes,
+                "coalesced_writes": self.coalesced_state_writes,
+                "scheduler_operations": self.scheduler_operations,
+            },
         )
+        self.published_state = self.current_state
+
+    def publish_metrics(self):
+        self.metrics.count(Metrics.SET_STATE)
+        self.set_state(
+            f"sensor.{self.name}_fan_metrics",
+            state=sum(self.metrics.transition_counts),
+            attributes=self.metrics.attributes(),
+        )
+        if not self.metrics_file:
+            return
+        try:
+            _replace_file(self.metrics_file, self.metrics.prometheus(self.name))
+        except OSError as error:
+            self.log(
+                f"Could not write metrics {self.metrics_file}: {error}",
+                level="WARNING",
+            )
+
+    @classmethod
+    def state_diagram(cls):
+        """Renders `TRANSITIONS` as the mermaid diagram shown in the README."""
+
+        def node(value):
+            return value.upper().replace(" ", "_")
+
+        lines = ["stateDiagram-v2", "  direction LR", "", f"  [*] --> {node(cls.INIT)}"]
+        for (state, input), target in cls.TRANSITIONS.items():
+            lines.append(f"  {node(state)} --> {node(target)}: {node(input)}")
+        return "\n".join(lines)
+
+    def debug(self, msg, *args):
+        """Logs at DEBUG, formatting `msg % args` only if the message is emitted."""
+        self.log(msg, *args, level=DEBUG)
 
     def log_invalid_transition(self, input):
+        if self.trace is None:
+            level = "WARNING"
+        elif self.debug_enabled:
+            # recorded in the trace; only worth a line when debugging
+            level = DEBUG
+        else:
+            return
         self.log(
-            f"Transition from '{self.current_state}' on '{input}' is not allowed",
-            level="WARNING",
+            "Transition from '%s' on '%s' is not allowed",
+            self.current_state,
+            input,
+            level=level,
         )
 
+    def dump_trace(self, format="json"):
+        if format == "csv":
+            return self.trace.to_csv()
+        return self.trace.to_json()
+
     def set_off(self):
+        if self.current_state == ShowerFan.DRYING and self.decay_fit is not None:
+            self.learn_drying_time()
         self.current_state = ShowerFan.OFF
         self.turn_off()
 
@@ -211,13 +1680,27 @@ class ShowerFan(hass.Hass):
 
     def set_extraction(self):
         self.current_state = ShowerFan.EXTRACTION
-        self.begin_timeout(self.fan_off_delay_seconds)
+        self.begin_timeout(self.extraction_timeout())
         self.turn_on()
 
+    def extraction_timeout(self):
+        if self.occupied:
+            # held while a trigger is on; the drying timeout bounds a stuck one
+            return self.drying_timeout_seconds
+        if self.last_input == ShowerFan.VACATED:
+            return self.trigger_run_on_seconds
+        return self.fan_off_delay_seconds
+
     def set_drying(self):
         self.current_state = ShowerFan.DRYING
-        self.begin_timeout(3600)  # large timeout
-        self.turn_on()
+        self.drying_started = self.clock()
+        if self.decay_fit is not None:
+            self.decay_fit.reset()
+        self.begin_timeout(self.drying_timeout())
+        if self.fan_percentage_gain is None:
+            self.turn_on()
+        else:
+            self.set_fan_percentage(self.drying_percentage())
 
     def set_quiet(self):
         self.current_state = ShowerFan.QUIET
@@ -226,44 +1709,253 @@ class ShowerFan(hass.Hass):
 
     # state listeners -----------------
 
-    def _log_entity_state(self, entity, attribute, old, new, kwargs):
-        self.log(
-            f"{entity} {attribute} changed from {old} to {new}. {kwargs}", level=DEBUG
+    @_timed("humidity")
+    def _on_humidity_state(self, entity, attribute, old, new, kwargs):
+        if self.debug_enabled:
+            self.debug(
+                "%s %s changed from %s to %s. %s", entity, attribute, old, new, kwargs
+            )
+
+        self.submit(self.humidity_changed, new, key="humidity")
+
+    def humidity_changed(self, value):
+        if not self.read_sensor(
+            self.humidity_sensor, self.humidity_reading, value, self.humidity_lost
+        ):
+            return
+        self.relative_humidity = self.humidity_reading.value
+        self.update_humidity()
+        if self.humidity_trend is not None and self.humidity is not None:
+            self.humidity_trend.add(self.clock(), self.humidity)
+        self.evaluate_humidity()
+
+    @_timed("reference_humidity")
+    def _on_reference_humidity_state(self, entity, attribute, old, new, kwargs):
+        self.submit(
+            self.reference_humidity_changed, entity, new, key=("reference", entity)
         )
 
-    def _on_humidity_state(self, entity, attribute, old, new, kwargs):
-        if self.reference_humidity_sensor:
-            reference_humidity = float(self.get_state(self.reference_humidity_sensor))
-            humidity = float(new)
-            self.log(
-                f"humidity: {humidity}, reference_humidity: {reference_humidity}",
-                level=DEBUG,
+    def humidity_lost(self):
+        self.relative_humidity = None
+        self.update_humidity()
+
+    def reference_humidity_changed(self, sensor, value):
+        reading = self.reference_readings[sensor]
+        lost = functools.partial(self.reference_humidity_lost, sensor)
+        if not self.read_sensor(sensor, reading, value, lost):
+            return
+        now = self.clock()
+        self.reference.update(sensor, now, reading.value)
+        self.reference_changed(now)
+
+    def reference_humidity_lost(self, sensor):
+        # the others, if any, still make a reference
+        now = self.clock()
+        self.reference.update(sensor, now, None)
+        self.reference_changed(now)
+
+    def reference_changed(self, now):
+        self.update_reference_humidity(now)
+        self.evaluate_humidity()
+
+    @_timed("temperature")
+    def _on_temperature_state(self, entity, attribute, old, new, kwargs):
+        self.submit(self.temperature_changed, new, key="temperature")
+
+    def temperature_changed(self, value):
+        if not self.read_sensor(
+            self.temperature_sensor,
+            self.temperature_reading,
+            value,
+            self.temperature_lost,
+        ):
+            return
+        self.temperature = self.temperature_reading.value
+        self.update_humidity()
+        self.evaluate_humidity()
+
+    def temperature_lost(self):
+        self.temperature = None
+        self.update_humidity()
+
+    @_timed("reference_temperature")
+    def _on_reference_temperature_state(self, entity, attribute, old, new, kwargs):
+        self.submit(
+            self.reference_temperature_changed, new, key="reference_temperature"
+        )
+
+    def reference_temperature_changed(self, value):
+        if not self.read_sensor(
+            self.reference_temperature_sensor,
+            self.reference_temperature_reading,
+            value,
+            self.reference_temperature_lost,
+        ):
+            return
+        self.reference_temperature = self.reference_temperature_reading.value
+        self.update_reference_humidity(self.clock())
+        self.evaluate_humidity()
+
+    def reference_temperature_lost(self):
+        self.reference_temperature = None
+        self.update_reference_humidity(self.clock())
+
+    def read_sensor(self, entity, reading, state, lost):
+        """Parses a numeric sensor state into `reading`; returns whether it was a
+        number. A sensor that stops reporting one keeps its last good value for
+        `sensor_hold_seconds`, then `lost` is called if it is still down."""
+        now = self.clock()
+        was_down = reading.down_since is not None
+        if reading.update(state, now):
+            return True
+        self.metrics.count(Metrics.PARSE_FAILURES)
+        if was_down:
+            return False
+        if self.sensor_hold_seconds > 0 and reading.value is not None:
+            self.run_in(
+                self._on_sensor_hold,
+                self.sensor_hold_seconds,
+                entity=entity,
+                reading=reading,
+                since=now,
+                lost=lost,
             )
+        else:
+            lost()
+        return False
 
-            if humidity > (reference_humidity + self.humidity_relative_high):
-                self.trigger(ShowerFan.HIGH_HUMIDITY)
-            elif humidity < (reference_humidity + self.humidity_relative_low):
-                self.trigger(ShowerFan.LOW_HUMIDITY)
+    @_timed("sensor_hold")
+    def _on_sensor_hold(self, kwargs):
+        self.submit(
+            self.sensor_hold_expired,
+            kwargs["entity"],
+            kwargs["reading"],
+            kwargs["since"],
+            kwargs["lost"],
+        )
 
-    def _on_quiet_switch_state(self, entity, attribute, old, new, kwargs):
+    def sensor_hold_expired(self, entity, reading, since, lost):
+        if reading.down_since != since:
+            # it has reported a reading since
+            return
         self.log(
-            f"{self.name} {attribute} changed from {old} to {new}. {kwargs}",
-            level=DEBUG,
+            f"{entity} has had no reading for {self.clock() - since:.0f}s, "
+            f"dropping its value {reading.value} from "
+            f"{reading.age(self.clock()):.0f}s ago",
+            level="WARNING",
         )
+        lost()
+
+    def compared_humidity(self, relative_humidity, temperature):
+        """A relative humidity in the units of the configured comparison."""
+        if self.humidity_conversion is None or relative_humidity is None:
+            return relative_humidity
+        if temperature is None:
+            return None
+        return self.humidity_conversion(relative_humidity, temperature)
+
+    def update_humidity(self):
+        self.humidity = self.compared_humidity(self.relative_humidity, self.temperature)
+
+    def update_reference_humidity(self, now):
+        self.reference_humidity = self.compared_humidity(
+            self.reference.value(now), self.reference_temperature
+        )
+
+    @_timed("quiet_switch")
+    def _on_quiet_switch_state(self, entity, attribute, old, new, kwargs):
+        if self.debug_enabled:
+            self.debug(
+                "%s %s changed from %s to %s. %s",
+                self.name,
+                attribute,
+                old,
+                new,
+                kwargs,
+            )
+
+        self.submit(self.quiet_switch_changed, old, new)
 
+    def quiet_switch_changed(self, old, new):
         if old == "unavailable" or new == "unavailable":
             return
 
         if new == "on":
-            self.trigger(ShowerFan.BEGIN_QUIET)
+            self.quiet_switch_on = True
         elif new == "off":
-            self.trigger(ShowerFan.END_QUIET)
+            self.quiet_switch_on = False
+        else:
+            return
+        self.update_quiet_period()
 
-    def _on_fan_state(self, entity, attribute, old, new, kwargs):
-        self.log(
-            f"{self.name} {attribute} changed from {old} to {new}. {kwargs}",
-            level=DEBUG,
+    # quiet hours ---------------------
+
+    def schedule_quiet_hours(self, moment):
+        """Arms one timer for the first quiet hours boundary after `moment`."""
+        seconds = self.quiet_hours.next_change(_seconds_of_week(moment))
+        if seconds is None:
+            return
+        # wall-clock arithmetic, so the boundary keeps its time of day over DST
+        week_start = datetime.combine(
+            moment.date() - timedelta(days=moment.weekday()), datetime.min.time()
         )
+        self.quiet_hours_boundary = week_start + timedelta(seconds=seconds)
+        self.run_at(self._on_quiet_hours, self.quiet_hours_boundary)
+
+    @_timed("quiet_hours")
+    def _on_quiet_hours(self, kwargs):
+        self.submit(self.quiet_hours_changed)
+
+    def quiet_hours_changed(self):
+        boundary = self.quiet_hours_boundary
+        self.in_quiet_hours = self.quiet_hours.is_quiet(_seconds_of_week(boundary))
+        self.schedule_quiet_hours(boundary)
+        self.update_quiet_period()
+
+    def is_quiet_period(self):
+        return self.quiet_switch_on or self.in_quiet_hours
+
+    def update_quiet_period(self):
+        quiet = self.is_quiet_period()
+        if quiet == self.quiet_period:
+            return
+        self.quiet_period = quiet
+        self.trigger(ShowerFan.BEGIN_QUIET if quiet else ShowerFan.END_QUIET)
+
+    @_timed("trigger_entity")
+    def _on_trigger_entity_state(self, entity, attribute, old, new, kwargs):
+        self.submit(self.trigger_entity_changed, entity, new, key=("trigger", entity))
+
+    def trigger_entity_changed(self, entity, value):
+        # unavailable counts as off, so a lost sensor ends with the run-on
+        if value == "on":
+            self.active_triggers.add(entity)
+        else:
+            self.active_triggers.discard(entity)
+        occupied = bool(self.active_triggers)
+        if occupied == self.occupied:
+            return
+        self.occupied = occupied
+        self.trigger(ShowerFan.OCCUPIED if occupied else ShowerFan.VACATED)
+
+    @_timed("fan")
+    def _on_fan_state(self, entity, attribute, old, new, kwargs):
+        if self.debug_enabled:
+            self.debug(
+                "%s %s changed from %s to %s. %s",
+                self.name,
+                attribute,
+                old,
+                new,
+                kwargs,
+            )
+
+        self.submit(self.fan_state_changed, old, new)
+
+    def fan_state_changed(self, old, new):
+        self.fan_state = new
+        if new != "on":
+            self.fan_percentage = None
 
         if old == "unavailable" or new == "unavailable":
             return
@@ -275,6 +1967,420 @@ class ShowerFan(hass.Hass):
 
     # timers callbacks ----------------
 
+    @_timed("fan_resync")
+    def _on_fan_resync(self, kwargs):
+        self.metrics.count(Metrics.GET_STATE)
+        self.submit(self.resync_fan_state, self.get_state(self.fan))
+
+    def resync_fan_state(self, fan_state):
+        if fan_state != self.fan_state:
+            self.log(
+                f"{self.fan} is '{fan_state}' but was cached as '{self.fan_state}'",
+                level="WARNING",
+            )
+            self.fan_state_changed(self.fan_state, fan_state)
+
+    def _on_dump_trace_event(self, event_name, data, kwargs):
+        if data.get("name", self.name) != self.name or self.trace is None:
+            return
+        format = data.get("format", "json")
+        file = data.get("file")
+        if not file:
+            self.log(f"Trace:\n{self.dump_trace(format)}")
+            return
+        # anything can fire the event, so it only names a file in trace_directory
+        file = self.app_file(os.path.basename(file))
+        if not self.trace_directory or file in ("", ".", ".."):
+            self.log(
+                f"Not writing trace to '{file}', set {CONFIG_TRACE_DIRECTORY} "
+                "and fire the event with a file name",
+                level="WARNING",
+            )
+            return
+        path = os.path.join(self.trace_directory, file)
+        try:
+            _replace_file(path, self.dump_trace(format))
+        except OSError as error:
+            self.log(f"Could not write trace {path}: {error}", level="WARNING")
+            return
+        self.log(f"Trace of {self.trace.count} inputs written to {path}")
+
+    def on_fan_command_failed(self, kwargs):
+        self.log(
+            f"{kwargs['service']} failed for {self.fan}, re-reading its state",
+            level="WARNING",
+        )
+        self.metrics.count(Metrics.GET_STATE)
+        self.submit(self.resync_fan_state, self.get_state(self.fan))
+
+    @_timed("publish_state")
+    def _on_publish_state(self, kwargs):
+        self._publish_handle = None
+        self._write_state_sensor()
+
+    @_timed("save_snapshot")
+    def _on_save_snapshot(self, kwargs):
+        self._snapshot_handle = None
+        self.write_snapshot()
+
+    def _on_publish_metrics(self, kwargs):
+        self.publish_metrics()
+
+    @_timed("timeout")
     def on_timeout(self, kwargs):
+        self.submit(self.timeout_elapsed)
+
+    def timeout_elapsed(self):
         self.fan_timeout_handle = None
+        if self.fan_timeout_deadline is None:
+            return
+
+        now = self.clock()
+        remaining = self.fan_timeout_deadline - now
+        if remaining > TIMEOUT_TOLERANCE_SECONDS:
+            self._arm_timeout(now, remaining)
+            return
+
+        self.fan_timeout_deadline = None
         self.trigger(ShowerFan.TIMEOUT)
+
+
+class AsyncShowerFan(ShowerFan):
+    """ShowerFan with its callbacks running on AppDaemon's event loop.
+
+    The state machine is the same as ShowerFan's. On the loop, AppDaemon calls
+    return futures instead of blocking a worker thread, so the service calls and
+    state sensor writes of a transition run concurrently and are awaited together
+    at the end of the callback.
+    """
+
+    async def initialize(self):
+        self._pending = []
+        entities = [
+            entity
+            for key in (
+                CONFIG_FAN,
+                CONFIG_QUIET_SWITCH,
+                CONFIG_REFERENCE_HUMIDITY_SENSOR,
+                CONFIG_HUMIDITY_SENSOR,
+                CONFIG_TEMPERATURE_SENSOR,
+                CONFIG_REFERENCE_TEMPERATURE_SENSOR,
+                CONFIG_TRIGGER_ENTITIES,
+            )
+            for entity in _entities(self.args.get(key))
+        ]
+        states = await asyncio.gather(*(self.get_state(entity) for entity in entities))
+        self._startup_states = dict(zip(entities, states))
+        if self.args.get(CONFIG_QUIET_HOURS):
+            self._startup_time = await self.datetime()
+        super().initialize()
+        self._startup_states = None
+        self._startup_time = None
+        await self._drain()
+
+    def get_state(self, entity_id=None, **kwargs):
+        startup_states = getattr(self, "_startup_states", None)
+        if startup_states is not None and not kwargs:
+            return startup_states.get(entity_id)
+        return super().get_state(entity_id, **kwargs)
+
+    def local_time(self):
+        startup_time = getattr(self, "_startup_time", None)
+        if startup_time is not None:
+            return startup_time
+        return super().local_time()
+
+    def call_service(self, service, **kwargs):
+        return self._track(super().call_service(service, **kwargs))
+
+    def set_state(self, entity_id, **kwargs):
+        return self._track(super().set_state(entity_id, **kwargs))
+
+    def cancel_timer(self, handle):
+        if isinstance(handle, asyncio.Future):
+            # run_in hands out a future for the timer handle while on the loop
+            handle.add_done_callback(
+                lambda future: super(AsyncShowerFan, self).cancel_timer(future.result())
+            )
+            return
+        return super().cancel_timer(handle)
+
+    def _track(self, result):
+        if isinstance(result, asyncio.Future):
+            self._pending.append(result)
+        return result
+
+    async def _drain(self):
+        pending, self._pending = self._pending, []
+        if pending:
+            await asyncio.gather(*pending)
+
+    def call_fan_service(self, service, **data):
+        """Caches the command optimistically, as its result arrives on the loop; a
+        failure puts the fan's real state back in the cache."""
+        self.metrics.count(Metrics.CALL_SERVICE)
+        result = super().call_service(service, entity_id=self.fan, **data)
+        if isinstance(result, asyncio.Future):
+            self._pending.append(
+                asyncio.ensure_future(self._await_fan_service(service, result))
+            )
+        return True
+
+    async def _await_fan_service(self, service, result):
+        try:
+            await result
+        except Exception as error:
+            self.log(f"{service} failed for {self.fan}: {error}", level="WARNING")
+            # so the next transition sends the command again, as off the loop
+            self.metrics.count(Metrics.GET_STATE)
+            self.fan_state = await self.get_state(self.fan)
+            self.fan_percentage = None
+
+    async def on_fan_command_failed(self, kwargs):
+        self.log(
+            f"{kwargs['service']} failed for {self.fan}, re-reading its state",
+            level="WARNING",
+        )
+        self.metrics.count(Metrics.GET_STATE)
+        self.submit(self.resync_fan_state, await self.get_state(self.fan))
+        await self._drain()
+
+    # state listeners -----------------
+
+    async def _on_humidity_state(self, entity, attribute, old, new, kwargs):
+        super()._on_humidity_state(entity, attribute, old, new, kwargs)
+        await self._drain()
+
+    async def _on_reference_humidity_state(self, entity, attribute, old, new, kwargs):
+        super()._on_reference_humidity_state(entity, attribute, old, new, kwargs)
+        await self._drain()
+
+    async def _on_temperature_state(self, entity, attribute, old, new, kwargs):
+        super()._on_temperature_state(entity, attribute, old, new, kwargs)
+        await self._drain()
+
+    async def _on_reference_temperature_state(
+        self, entity, attribute, old, new, kwargs
+    ):
+        super()._on_reference_temperature_state(entity, attribute, old, new, kwargs)
+        await self._drain()
+
+    async def _on_quiet_switch_state(self, entity, attribute, old, new, kwargs):
+        super()._on_quiet_switch_state(entity, attribute, old, new, kwargs)
+        await self._drain()
+
+    async def _on_fan_state(self, entity, attribute, old, new, kwargs):
+        super()._on_fan_state(entity, attribute, old, new, kwargs)
+        await self._drain()
+
+    async def _on_trigger_entity_state(self, entity, attribute, old, new, kwargs):
+        super()._on_trigger_entity_state(entity, attribute, old, new, kwargs)
+        await self._drain()
+
+    async def _on_sensor_hold(self, kwargs):
+        super()._on_sensor_hold(kwargs)
+        await self._drain()
+
+    async def _on_quiet_hours(self, kwargs):
+        super()._on_quiet_hours(kwargs)
+        await self._drain()
+
+    # timers callbacks ----------------
+
+    async def _on_fan_resync(self, kwargs):
+        self.metrics.count(Metrics.GET_STATE)
+        self.submit(self.resync_fan_state, await self.get_state(self.fan))
+        await self._drain()
+
+    async def _on_publish_state(self, kwargs):
+        super()._on_publish_state(kwargs)
+        await self._drain()
+
+    async def on_timeout(self, kwargs):
+        super().on_timeout(kwargs)
+        await self._drain()
+
+
+class ShowerFanManager(hass.Hass):
+    """Runs the ShowerFan state machine for many bathrooms from one app.
+
+    Each entry of `bathrooms` takes the same arguments as a ShowerFan app; other
+    arguments of the manager are defaults shared by every bathroom. State
+    callbacks are registered once per entity and fanned out to each bathroom
+    using it, and entity states read during startup are fetched once.
+    """
+
+    def initialize(self):
+        defaults = {
+            key: value for key, value in self.args.items() if key != CONFIG_BATHROOMS
+        }
+        self._state_callbacks = {}
+        self._event_callbacks = {}
+        self._resync_groups = {}
+        self._reference_groups = {}
+        self._startup_states = {}
+
+        self.bathrooms = []
+        for config in self.args.get(CONFIG_BATHROOMS, []):
+            args = {**defaults, **config}
+            name = args.pop(CONFIG_NAME, None) or args[CONFIG_FAN].split(".", 1)[1]
+            bathroom = ManagedShowerFan(self, name, args)
+            bathroom.initialize()
+            self.bathrooms.append(bathroom)
+
+        self._startup_states = None
+        self.log(
+            f"Managing {len(self.bathrooms)} bathrooms with "
+            f"{len(self._state_callbacks)} state listeners",
+            level=DEBUG,
+        )
+
+    def subscribe(self, callback, entity):
+        callbacks = self._state_callbacks.get(entity)
+        if callbacks is None:
+            callbacks = self._state_callbacks[entity] = []
+            self.listen_state(self._on_entity_state, entity)
+        callbacks.append(callback)
+
+    def subscribe_event(self, name, callback, event):
+        callbacks = self._event_callbacks.get(event)
+        if callbacks is None:
+            callbacks = self._event_callbacks[event] = {}
+            self.listen_event(self._on_event, event)
+        callbacks[name] = callback
+
+    def add_fan_resync(self, bathroom, seconds):
+        bathrooms = self._resync_groups.get(seconds)
+        if bathrooms is None:
+            bathrooms = self._resync_groups[seconds] = []
+            self.run_every(
+                self._on_fan_resync, f"now+{seconds}", seconds, resync_seconds=seconds
+            )
+        bathrooms.append(bathroom)
+
+    def join_reference_group(self, key, bathroom):
+        """Bathrooms with the same reference sensors and settings share their
+        readings; the first to join owns the listeners and updates the others."""
+        bathrooms = self._reference_groups.setdefault(key, [])
+        bathrooms.append(bathroom)
+        return bathrooms
+
+    def clock(self):
+        return time.time()
+
+    def terminate(self):
+        for bathroom in self.bathrooms:
+            bathroom.terminate()
+
+    def startup_state(self, entity):
+        if self._startup_states is None:
+            return self.get_state(entity)
+        if entity not in self._startup_states:
+            self._startup_states[entity] = self.get_state(entity)
+        return self._startup_states[entity]
+
+    def _on_entity_state(self, entity, attribute, old, new, kwargs):
+        for callback in self._state_callbacks[entity]:
+            callback(entity, attribute, old, new, kwargs)
+
+    def _on_event(self, event_name, data, kwargs):
+        callbacks = self._event_callbacks[event_name]
+        name = data.get(CONFIG_NAME)
+        if name is None:
+            for callback in callbacks.values():
+                callback(event_name, data, kwargs)
+        elif name in callbacks:
+            callbacks[name](event_name, data, kwargs)
+
+    def _on_fan_resync(self, kwargs):
+        # one pass over every fan resynced at this interval
+        for bathroom in self._resync_groups[kwargs["resync_seconds"]]:
+            bathroom._on_fan_resync(kwargs)
+
+
+class ManagedShowerFan(ShowerFan):
+    """Per-bathroom state of a ShowerFanManager.
+
+    It is not an AppDaemon app: it holds the bathroom's config and machine state
+    and routes every AppDaemon call through its manager.
+    """
+
+    def __init__(self, manager, name, args):
+        self.manager = manager
+        self.name = name
+        self.args = args
+
+    def listen_state(self, callback, entity=None, **kwargs):
+        self.manager.subscribe(callback, entity)
+
+    def get_state(self, entity_id=None, **kwargs):
+        if kwargs:
+            return self.manager.get_state(entity_id, **kwargs)
+        return self.manager.startup_state(entity_id)
+
+    def listen_event(self, callback, event=None, **kwargs):
+        self.manager.subscribe_event(self.name, callback, event)
+
+    def set_state(self, entity_id, **kwargs):
+        return self.manager.set_state(entity_id, **kwargs)
+
+    def call_service(self, service, **kwargs):
+        return self.manager.call_service(service, **kwargs)
+
+    def run_in(self, callback, delay, **kwargs):
+        return self.manager.run_in(callback, delay, **kwargs)
+
+    def run_every(self, callback, start, interval, **kwargs):
+        return self.manager.run_every(callback, start, interval, **kwargs)
+
+    def schedule_fan_resync(self, seconds):
+        self.manager.add_fan_resync(self, seconds)
+
+    def app_file(self, path):
+        # a path from the manager's shared arguments would be every bathroom's
+        if "{name}" not in path:
+            root, extension = os.path.splitext(path)
+            path = f"{root}_{{name}}{extension}"
+        return super().app_file(path)
+
+    def setup_reference_humidity(self, aggregate, stale_seconds):
+        self.reference_group = self.manager.join_reference_group(
+            (
+                tuple(self.reference_humidity_sensors),
+                aggregate,
+                stale_seconds,
+                self.sensor_hold_seconds,
+            ),
+            self,
+        )
+        owner = self.reference_group[0]
+        if owner is self:
+            super().setup_reference_humidity(aggregate, stale_seconds)
+        else:
+            self.reference = owner.reference
+            self.reference_readings = owner.reference_readings
+
+    def reference_changed(self, now):
+        for bathroom in self.reference_group:
+            bathroom.submit(bathroom.refresh_reference, now, key="reference")
+
+    def refresh_reference(self, now):
+        super().reference_changed(now)
+
+    def run_at(self, callback, start, **kwargs):
+        return self.manager.run_at(callback, start, **kwargs)
+
+    def cancel_timer(self, handle):
+        return self.manager.cancel_timer(handle)
+
+    def log(self, msg, *args, **kwargs):
+        self.manager.log(f"{self.name}: {msg}", *args, **kwargs)
+
+    def get_main_log(self):
+        return self.manager.get_main_log()
+
+    def clock(self):
+        return self.manager.clock()
+
+    def local_time(self):
+        return self.manager.datetime()
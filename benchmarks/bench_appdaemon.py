@@ -0,0 +1,294 @@
+"""End-to-end load benchmark: real AppDaemon against a fake Home Assistant.
+
+Serves tools/fake_home_assistant.py in-process on a free localhost port, writes
+an AppDaemon configuration with `--instances` ShowerFan apps to a temporary
+directory, runs AppDaemon on it as a subprocess and drives the bathrooms'
+humidity sensors. Every round takes each bathroom through a shower: a reading
+above the high threshold (the app should turn the fan on), `--noise` readings
+between the thresholds (no command expected) and a reading below the low
+threshold (the app should turn the fan off). Prints a JSON report with the
+startup time, event-to-fan-command latency percentiles, throughput and the
+WARNING and ERROR lines in AppDaemon's logs; the run fails if there are any.
+
+    python benchmarks/bench_appdaemon.py --instances 200 --rounds 3
+
+Runs offline; only AppDaemon and its dependencies need to be installed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from collections import Counter
+
+import yaml
+
+sys.path.append("tools")
+
+from fake_home_assistant import FakeHomeAssistant  # noqa: E402
+
+APP_MODULE = os.path.join("apps", "shower_fan", "shower_fan.py")
+REFERENCE_HUMIDITY_SENSOR = "sensor.living_room_humidity"
+QUIET_SWITCH = "switch.quiet_time"
+TOKEN = "bench-token"
+LOGS = ("main.log", "error.log")
+PROBLEM_LEVELS = ("WARNING", "ERROR", "CRITICAL")
+
+
+def bathroom(index):
+    return {
+        "name": f"bathroom_{index}",
+        "fan": f"fan.bathroom_{index}",
+        "humidity_sensor": f"sensor.bathroom_{index}_humidity",
+    }
+
+
+def write_config(directory, url, options):
+    apps_directory = os.path.join(directory, "apps")
+    os.makedirs(apps_directory)
+    shutil.copy(APP_MODULE, apps_directory)
+
+    appdaemon = {
+        "latitude": 51.5,
+        "longitude": -0.1,
+        "elevation": 10,
+        "time_zone": "UTC",
+        "plugins": {"HASS": {"type": "hass", "ha_url": url, "token": TOKEN}},
+    }
+    if options.threads:
+        appdaemon["total_threads"] = options.threads
+    config = {
+        "appdaemon": appdaemon,
+        "logs": {
+            f"{os.path.splitext(log)[0]}_log": {
+                "filename": os.path.join(directory, log)
+            }
+            for log in LOGS
+        },
+    }
+    with open(os.path.join(directory, "appdaemon.yaml"), "w") as file:
+        yaml.safe_dump(config, file)
+
+    apps = {}
+    for index in range(options.instances):
+        args = bathroom(index)
+        apps[args["name"]] = {
+            "module": "shower_fan",
+            "class": options.app_class,
+            "reference_humidity_sensor": REFERENCE_HUMIDITY_SENSOR,
+            "humidity_sensor": args["humidity_sensor"],
+            "quiet_switch": QUIET_SWITCH,
+            "fan": args["fan"],
+            "log_level": "WARNING",
+        }
+    with open(os.path.join(apps_directory, "apps.yaml"), "w") as file:
+        yaml.safe_dump(apps, file)
+
+
+def log_problems(directory):
+    """Counts of WARNING and worse lines per AppDaemon log."""
+    problems = {}
+    for log in LOGS:
+        counts = Counter()
+        try:
+            with open(os.path.join(directory, log)) as file:
+                for line in file:
+                    # "<date> <time> <level> <logger>: <message>"
+                    fields = line.split(" ", 3)
+                    if len(fields) > 2 and fields[2] in PROBLEM_LEVELS:
+                        counts[fields[2]] += 1
+        except FileNotFoundError:
+            pass
+        problems[log] = dict(counts)
+    return problems
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    return {
+        name: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+    } | {"max": ordered[-1] * 1000}
+
+
+async def run(options):
+    home_assistant = FakeHomeAssistant(token=TOKEN)
+    bathrooms = [bathroom(index) for index in range(options.instances)]
+    await home_assistant.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    await home_assistant.set_state(QUIET_SWITCH, "off")
+    for args in bathrooms:
+        await home_assistant.set_state(args["fan"], "off")
+        await home_assistant.set_state(args["humidity_sensor"], "55")
+        # as left by an earlier run, or AppDaemon warns when an app creates it
+        await home_assistant.set_state(f"sensor.{args['name']}_fan_state_machine", "")
+
+    # fan -> when the reading that should switch it was sent
+    waiting = {}
+    latencies = array("d")
+    unexpected_commands = 0
+    started_apps = set()
+    all_started = asyncio.Event()
+    command_received = asyncio.Event()
+
+    def on_service_call(domain, service, data):
+        nonlocal unexpected_commands
+        entities = data.get("entity_id") or []
+        if isinstance(entities, str):
+            entities = [entities]
+        for entity in entities:
+            sent = waiting.pop(entity, None)
+            if sent is None:
+                unexpected_commands += 1
+            else:
+                latencies.append(time.perf_counter() - sent)
+        if not waiting:
+            command_received.set()
+
+    def on_set_state(entity_id, state):
+        # every app publishes its state machine sensor once it has started
+        if entity_id.endswith("_fan_state_machine"):
+            started_apps.add(entity_id)
+            if len(started_apps) == options.instances:
+                all_started.set()
+
+    home_assistant.on_service_call = on_service_call
+    home_assistant.on_set_state = on_set_state
+    url = await home_assistant.start()
+
+    directory = tempfile.mkdtemp(prefix="bench_appdaemon_")
+    write_config(directory, url, options)
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "appdaemon", "-c", directory],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while not all_started.is_set():
+            if process.poll() is not None:
+                raise SystemExit(f"AppDaemon exited early, see {directory}")
+            if time.perf_counter() - started > options.startup_timeout:
+                raise SystemExit(
+                    f"only {len(started_apps)} of {options.instances} apps started "
+                    f"within {options.startup_timeout}s, see {directory}"
+                )
+            try:
+                await asyncio.wait_for(all_started.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+        startup_seconds = time.perf_counter() - started
+
+        rng = random.Random(options.seed)
+        interval = 1 / options.rate if options.rate else 0
+        events = 0
+        timeouts = 0
+        load_started = time.perf_counter()
+
+        async def send(entity, value):
+            nonlocal events
+            await home_assistant.set_state(entity, value)
+            events += 1
+            if interval:
+                await asyncio.sleep(interval)
+
+        async def phase(value, expect_command):
+            nonlocal timeouts
+            order = list(bathrooms)
+            rng.shuffle(order)
+            command_received.clear()
+            for args in order:
+                if expect_command:
+                    waiting[args["fan"]] = time.perf_counter()
+                await send(args["humidity_sensor"], value())
+            if expect_command and waiting:
+                try:
+                    await asyncio.wait_for(
+                        command_received.wait(), options.command_timeout
+                    )
+                except asyncio.TimeoutError:
+                    timeouts += len(waiting)
+                    waiting.clear()
+
+        for _ in range(options.rounds):
+            await phase(lambda: f"{rng.uniform(80, 90):.1f}", True)
+            for _ in range(options.noise):
+                await phase(lambda: f"{rng.uniform(61, 69):.1f}", False)
+            await phase(lambda: f"{rng.uniform(52, 58):.1f}", True)
+
+        load_seconds = time.perf_counter() - load_started
+        # let stray commands arrive before counting them
+        await asyncio.sleep(options.settle)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        await home_assistant.stop()
+
+    problems = log_problems(directory)
+    if not options.keep:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "config": vars(options),
+        "startup_seconds": startup_seconds,
+        "events": events,
+        "fan_commands": len(latencies),
+        "missed_fan_commands": timeouts,
+        "unexpected_fan_commands": unexpected_commands,
+        "events_per_second": events / load_seconds,
+        "fan_commands_per_second": len(latencies) / load_seconds,
+        "event_to_fan_command_ms": percentiles(latencies),
+        "home_assistant_requests": dict(home_assistant.calls),
+        "appdaemon_log_problems": problems,
+        "failed": any(problems.values()),
+        "appdaemon_directory": directory if options.keep else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--instances", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument(
+        "--noise", type=int, default=2, help="readings between thresholds per round"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0, help="events per second (0: as fast as sent)"
+    )
+    parser.add_argument(
+        "--app-class", default="ShowerFan", choices=("ShowerFan", "AsyncShowerFan")
+    )
+    parser.add_argument("--threads", type=int, help="AppDaemon total_threads")
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--command-timeout", type=float, default=30)
+    parser.add_argument("--settle", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the AppDaemon config and logs"
+    )
+    options = parser.parse_args()
+
+    report = asyncio.run(run(options))
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if report["failed"]:
+        directory = report["appdaemon_directory"]
+        raise SystemExit(
+            "AppDaemon logged warnings or errors, "
+            + (f"see {directory}" if directory else "rerun with --keep to see them")
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Sustained event load benchmark for ShowerFan.
+
+Generates synthetic humidity, reference humidity, manual fan and quiet switch
+streams for one or many bathrooms, pumps them through ShowerFan apps running on
+the offline simulation, and prints a JSON report: callbacks per second,
+per-event latency percentiles, AppDaemon calls per event and peak memory.
+
+    python benchmarks/bench_event_load.py --instances 40 --days 7 > run.json
+    python benchmarks/bench_event_load.py --instances 40 --days 7 --compare run.json
+"""
+
+import argparse
+import heapq
+import json
+import math
+import random
+import sys
+import time
+import tracemalloc
+from array import array
+
+sys.path.append("tools")
+
+from simulation import Simulation  # noqa: E402
+from shower_fan import ShowerFan, ShowerFanManager  # noqa: E402
+
+START = 1_704_067_200  # 2024-01-01T00:00:00Z
+DAY = 86400
+REFERENCE_HUMIDITY_SENSOR = "sensor.reference_humidity"
+QUIET_SWITCH = "switch.quiet_time"
+CALLS = ("get_state", "call_service", "set_state", "schedule", "cancel_timer", "log")
+
+
+def humidity_stream(rng, entity, options):
+    """Readings every `humidity_interval` seconds with showers at random times."""
+    end = START + options.days * DAY
+    shower_rate = options.showers_per_day / DAY
+    next_shower = START + rng.expovariate(shower_rate)
+    shower = None
+    last = None
+    t = START + rng.uniform(0, options.humidity_interval)
+    while t < end:
+        if t >= next_shower:
+            shower = next_shower
+            next_shower += rng.expovariate(shower_rate)
+        excess = 0.0
+        if shower is not None:
+            elapsed = t - shower
+            if elapsed < 600:
+                excess = 35 * elapsed / 600
+            else:
+                excess = 35 * math.exp(-(elapsed - 600) / 1200)
+        value = f"{55 + excess + rng.gauss(0, 0.3):.1f}"
+        if value != last:
+            yield t, entity, value
+            last = value
+        t += options.humidity_interval
+
+
+def reference_stream(rng, options):
+    end = START + options.days * DAY
+    t = START
+    while t < end:
+        yield t, REFERENCE_HUMIDITY_SENSOR, f"{50 + rng.gauss(0, 0.5):.1f}"
+        t += 300
+
+
+def fan_stream(rng, entity, options):
+    """Manual fan switching: on at random times, off a few minutes later."""
+    end = START + options.days * DAY
+    rate = options.fan_toggles_per_day / DAY
+    t = START + rng.expovariate(rate)
+    while t < end:
+        yield t, entity, "on"
+        yield t + rng.uniform(120, 900), entity, "off"
+        t += 900 + rng.expovariate(rate)
+
+
+def quiet_stream(options):
+    for day in range(options.days):
+        yield START + day * DAY + 7 * 3600, QUIET_SWITCH, "off"
+        yield START + day * DAY + 22 * 3600, QUIET_SWITCH, "on"
+
+
+def bathroom_args(index):
+    return {
+        "fan": f"fan.bathroom_{index}",
+        "humidity_sensor": f"sensor.bathroom_{index}_humidity",
+    }
+
+
+def events(options):
+    streams = [reference_stream(random.Random(options.seed), options)]
+    if options.quiet_switch:
+        streams.append(quiet_stream(options))
+    for index in range(options.instances):
+        rng = random.Random(options.seed * 1000 + index)
+        args = bathroom_args(index)
+        streams.append(humidity_stream(rng, args["humidity_sensor"], options))
+        streams.append(fan_stream(rng, args["fan"], options))
+    return heapq.merge(*streams, key=lambda event: event[0])
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(options):
+    if options.trace_memory:
+        tracemalloc.start()
+
+    simulation = Simulation(start=START)
+    simulation.states[REFERENCE_HUMIDITY_SENSOR] = "50"
+    simulation.states[QUIET_SWITCH] = "off"
+    shared = {
+        "reference_humidity_sensor": REFERENCE_HUMIDITY_SENSOR,
+        "quiet_switch": QUIET_SWITCH,
+    }
+    bathrooms = [bathroom_args(index) for index in range(options.instances)]
+    if options.manager:
+        simulation.create_app(
+            ShowerFanManager, "bathrooms", {**shared, "bathrooms": bathrooms}
+        )
+    else:
+        for index, args in enumerate(bathrooms):
+            simulation.create_app(ShowerFan, f"bathroom_{index}", {**shared, **args})
+
+    simulation.calls.clear()
+    simulation.callbacks = 0
+    latencies = array("d")
+    started = time.perf_counter()
+    for timestamp, entity, value in events(options):
+        simulation.advance(timestamp)
+        event_started = time.perf_counter()
+        simulation.set_state(entity, value)
+        latencies.append(time.perf_counter() - event_started)
+    simulation.advance(START + options.days * DAY)
+    wall_seconds = time.perf_counter() - started
+
+    peak_memory = None
+    if options.trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # the latency samples are the benchmark's, not the apps'
+        peak_memory -= latencies.buffer_info()[1] * latencies.itemsize
+
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {
+        "config": {
+            key: value for key, value in vars(options).items() if key != "compare"
+        },
+        "events": count,
+        "callbacks": simulation.callbacks,
+        "wall_seconds": wall_seconds,
+        "events_per_second": count / wall_seconds,
+        "callbacks_per_second": simulation.callbacks / wall_seconds,
+        "latency_us": {
+            name: percentile(ordered, fraction) * 1e6
+            for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+        }
+        | {"max": ordered[-1] * 1e6},
+        "calls_per_event": {name: simulation.calls[name] / count for name in CALLS},
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def compare(report, baseline):
+    """Ratios of this run to the baseline for the headline numbers."""
+
+    def ratio(new, old):
+        return None if not old or new is None else round(new / old, 3)
+
+    return {
+        "callbacks_per_second": ratio(
+            report["callbacks_per_second"], baseline["callbacks_per_second"]
+        ),
+        "latency_us": {
+            name: ratio(value, baseline["latency_us"].get(name))
+            for name, value in report["latency_us"].items()
+        },
+        "calls_per_event": {
+            name: ratio(value, baseline["calls_per_event"].get(name))
+            for name, value in report["calls_per_event"].items()
+        },
+        "peak_memory_bytes": ratio(
+            report["peak_memory_bytes"], baseline["peak_memory_bytes"]
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--instances", type=int, default=10)
+    parser.add_argument("--days", type=int, default=1)
+    parser.add_argument("--humidity-interval", type=float, default=30)
+    parser.add_argument("--showers-per-day", type=float, default=2)
+    parser.add_argument("--fan-toggles-per-day", type=float, default=3)
+    parser.add_argument("--no-quiet-switch", dest="quiet_switch", action="store_false")
+    parser.add_argument(
+        "--manager", action="store_true", help="run one ShowerFanManager app"
+    )
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--compare", help="baseline report to compare against")
+    options = parser.parse_args()
+
+    report = run(options)
+    if options.compare:
+        with open(options.compare) as baseline:
+            report["compared_to_baseline"] = compare(report, json.load(baseline))
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
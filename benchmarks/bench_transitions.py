@@ -0,0 +1,112 @@
+"""Micro-benchmark: per-event dispatch cost of `ShowerFan.trigger`.
+
+Compares the transition table lookup against the if/elif ladder it replaced.
+
+    python benchmarks/bench_transitions.py [--events 1000000]
+"""
+
+import argparse
+import itertools
+import sys
+import timeit
+
+sys.path.append("apps/shower_fan")
+
+from shower_fan import ShowerFan  # noqa: E402
+
+STATES = [
+    ShowerFan.INIT,
+    ShowerFan.OFF,
+    ShowerFan.EXTRACTION,
+    ShowerFan.DRYING,
+    ShowerFan.QUIET,
+    ShowerFan.QUIET_EXTRACTION,
+]
+INPUTS = [
+    ShowerFan.TURNED_ON,
+    ShowerFan.TURNED_OFF,
+    ShowerFan.HIGH_HUMIDITY,
+    ShowerFan.LOW_HUMIDITY,
+    ShowerFan.TIMEOUT,
+    ShowerFan.BEGIN_QUIET,
+    ShowerFan.END_QUIET,
+]
+
+
+def ladder_dispatch(state, input):
+    """The pre-table `trigger` ladder, reduced to returning the target state."""
+    if state == ShowerFan.INIT:
+        if input == ShowerFan.TURNED_ON:
+            return ShowerFan.EXTRACTION
+        elif input == ShowerFan.TURNED_OFF:
+            return ShowerFan.OFF
+        elif input == ShowerFan.BEGIN_QUIET:
+            return ShowerFan.QUIET
+    elif state == ShowerFan.OFF:
+        if input == ShowerFan.TURNED_ON:
+            return ShowerFan.EXTRACTION
+        elif input == ShowerFan.HIGH_HUMIDITY:
+            return ShowerFan.DRYING
+        elif input == ShowerFan.BEGIN_QUIET:
+            return ShowerFan.QUIET
+    elif state == ShowerFan.EXTRACTION:
+        if input == ShowerFan.TIMEOUT:
+            return ShowerFan.OFF
+        elif input == ShowerFan.TURNED_OFF:
+            return ShowerFan.OFF
+        elif input == ShowerFan.HIGH_HUMIDITY:
+            return ShowerFan.DRYING
+        elif input == ShowerFan.BEGIN_QUIET:
+            return ShowerFan.QUIET
+    elif state == ShowerFan.DRYING:
+        if input == ShowerFan.LOW_HUMIDITY:
+            return ShowerFan.OFF
+        elif input == ShowerFan.TURNED_OFF:
+            return ShowerFan.OFF
+        elif input == ShowerFan.TIMEOUT:
+            return ShowerFan.OFF
+        elif input == ShowerFan.BEGIN_QUIET:
+            return ShowerFan.QUIET
+    elif state == ShowerFan.QUIET:
+        if input == ShowerFan.TURNED_ON:
+            return ShowerFan.QUIET_EXTRACTION
+        elif input == ShowerFan.END_QUIET:
+            return ShowerFan.OFF
+    elif state == ShowerFan.QUIET_EXTRACTION:
+        if input == ShowerFan.TIMEOUT:
+            return ShowerFan.QUIET
+        elif input == ShowerFan.TURNED_OFF:
+            return ShowerFan.QUIET
+        elif input == ShowerFan.END_QUIET:
+            return ShowerFan.OFF
+    return None
+
+
+def table_dispatch(state, input, transitions=ShowerFan.TRANSITIONS):
+    return transitions.get((state, input))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=1_000_000)
+    options = parser.parse_args()
+
+    pairs = list(itertools.product(STATES, INPUTS))
+    for state, input in pairs:
+        assert ladder_dispatch(state, input) == table_dispatch(state, input)
+
+    events = list(itertools.islice(itertools.cycle(pairs), options.events))
+
+    for name, dispatch in (("ladder", ladder_dispatch), ("table", table_dispatch)):
+        seconds = min(
+            timeit.repeat(
+                lambda: [dispatch(state, input) for state, input in events],
+                number=1,
+                repeat=5,
+            )
+        )
+        print(f"{name:>6}: {seconds / len(events) * 1e9:7.1f} ns/event")
+
+
+if __name__ == "__main__":
+    main()
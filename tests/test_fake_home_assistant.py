@@ -0,0 +1,80 @@
+import asyncio
+import sys
+
+import aiohttp
+
+sys.path.append("tools")
+
+from fake_home_assistant import FakeHomeAssistant  # noqa: E402
+
+TOKEN = "test-token"
+FAN = "fan.master_bathroom_fan"
+HUMIDITY_SENSOR = "sensor.master_bathroom_climate_humidity"
+
+
+def test_websocket_streams_state_changes_after_auth_and_subscribe():
+    async def scenario():
+        home_assistant = FakeHomeAssistant(token=TOKEN)
+        url = await home_assistant.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.ws_connect(f"{url}/api/websocket") as ws:
+                    assert (await ws.receive_json())["type"] == "auth_required"
+                    await ws.send_json({"type": "auth", "access_token": TOKEN})
+                    assert (await ws.receive_json())["type"] == "auth_ok"
+                    await ws.send_json({"id": 1, "type": "subscribe_events"})
+                    assert await ws.receive_json() == {
+                        "id": 1,
+                        "type": "result",
+                        "success": True,
+                        "result": None,
+                    }
+
+                    await home_assistant.set_state(HUMIDITY_SENSOR, "75")
+
+                    message = await ws.receive_json()
+        finally:
+            await home_assistant.stop()
+
+        assert message["id"] == 1
+        assert message["type"] == "event"
+        assert message["event"]["event_type"] == "state_changed"
+        assert message["event"]["data"]["old_state"] is None
+        assert message["event"]["data"]["new_state"]["state"] == "75"
+
+    asyncio.run(scenario())
+
+
+def test_rest_service_call_changes_fan_and_reports_it():
+    async def scenario():
+        home_assistant = FakeHomeAssistant(token=TOKEN)
+        await home_assistant.set_state(FAN, "off")
+        calls = []
+        home_assistant.on_service_call = lambda *call: calls.append(call)
+        url = await home_assistant.start()
+        headers = {"Authorization": f"Bearer {TOKEN}"}
+        try:
+            async with aiohttp.ClientSession(headers=headers) as session:
+                async with session.post(
+                    f"{url}/api/services/homeassistant/turn_on",
+                    json={"entity_id": FAN},
+                ) as response:
+                    changed = await response.json()
+                async with session.post(
+                    f"{url}/api/states/sensor.bathroom_fan_state_machine",
+                    json={"state": "extraction", "attributes": {"input": "on"}},
+                ) as response:
+                    created = response.status
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{url}/api/states") as response:
+                    unauthorized = response.status
+        finally:
+            await home_assistant.stop()
+
+        assert [state["state"] for state in changed] == ["on"]
+        assert calls == [("homeassistant", "turn_on", {"entity_id": FAN})]
+        assert home_assistant.states[FAN]["state"] == "on"
+        assert created == 201
+        assert unauthorized == 401
+
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+import csv
+import sqlite3
+import sys
+from datetime import datetime, timezone
+
+sys.path.append("apps/shower_fan")
+sys.path.append("tools")
+
+from shower_fan import ShowerFan  # noqa: E402
+from replay_history import csv_rows, replay, sqlite_rows  # noqa: E402
+
+FAN = "fan.master_bathroom_fan"
+REFERENCE_HUMIDITY_SENSOR = "sensor.living_room_humidity"
+HUMIDITY_SENSOR = "sensor.master_bathroom_climate_humidity"
+ARGS = {
+    "fan": FAN,
+    "humidity_sensor": HUMIDITY_SENSOR,
+    "reference_humidity_sensor": REFERENCE_HUMIDITY_SENSOR,
+}
+START = 1_700_000_000
+HISTORY = [
+    (START, REFERENCE_HUMIDITY_SENSOR, "50"),
+    (START + 10, HUMIDITY_SENSOR, "55"),
+    (START + 600, HUMIDITY_SENSOR, "75"),
+    (START + 1200, HUMIDITY_SENSOR, "72"),
+    (START + 3000, HUMIDITY_SENSOR, "58"),
+]
+
+
+def test_replay_reports_transitions_and_fan_on_intervals():
+    records = []
+
+    summary = replay(iter(HISTORY), ARGS, records.append)
+
+    assert [
+        (record["from"], record["input"], record["to"])
+        for record in records
+        if record["type"] == "transition"
+    ] == [
+        (ShowerFan.OFF, ShowerFan.HIGH_HUMIDITY, ShowerFan.DRYING),
+        (ShowerFan.DRYING, ShowerFan.LOW_HUMIDITY, ShowerFan.OFF),
+    ]
+    assert summary["fan_on_intervals"] == 1
+    assert summary["fan_on_seconds"] == 2400
+
+
+def test_drying_timeout_runs_on_the_simulated_clock():
+    records = []
+    history = HISTORY[:3] + [(START + 5000, HUMIDITY_SENSOR, "74")]
+
+    replay(iter(history), ARGS, records.append)
+
+    assert [record for record in records if record["type"] == "fan_on"][0] == (
+        {
+            "type": "fan_on",
+            "start": START + 600,
+            "end": START + 4200,
+            "seconds": 3600,
+            "truncated": False,
+        }
+    )
+
+
+def test_sqlite_rows_are_streamed_in_time_order(tmp_path):
+    path = tmp_path / "home-assistant_v2.db"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE states_meta (metadata_id INTEGER, entity_id TEXT)")
+    connection.execute(
+        "CREATE TABLE states (metadata_id INTEGER, state TEXT, last_updated_ts FLOAT)"
+    )
+    metadata_ids = {REFERENCE_HUMIDITY_SENSOR: 1, HUMIDITY_SENSOR: 2, FAN: 3}
+    connection.executemany(
+        "INSERT INTO states_meta VALUES (?, ?)",
+        [(metadata_id, entity) for entity, metadata_id in metadata_ids.items()],
+    )
+    connection.executemany(
+        "INSERT INTO states VALUES (?, ?, ?)",
+        [(metadata_ids[entity], state, time) for time, entity, state in HISTORY]
+        + [(3, "on", START + 5)],
+    )
+    connection.commit()
+    connection.close()
+
+    rows = sqlite_rows(path, [REFERENCE_HUMIDITY_SENSOR, HUMIDITY_SENSOR])
+
+    assert list(rows) == HISTORY
+
+
+def test_csv_rows_merge_entities_exported_one_after_another(tmp_path):
+    path = tmp_path / "history.csv"
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["entity_id", "state", "last_changed"])
+        for time, entity, state in sorted(HISTORY, key=lambda row: row[1]):
+            moment = datetime.fromtimestamp(time, timezone.utc)
+            writer.writerow([entity, state, moment.isoformat()])
+
+    rows = csv_rows(path, [REFERENCE_HUMIDITY_SENSOR, HUMIDITY_SENSOR])
+
+    assert list(rows) == HISTORY
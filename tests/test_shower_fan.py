@@ -1,4 +1,8 @@
+import asyncio
+import json
+import math
 import sys
+from datetime import datetime
 import pytest
 import pytest_mock
 from unittest import mock
@@ -8,11 +12,38 @@ import appdaemon.plugins.hass.hassapi as hass
 sys.path.append("apps/shower_fan")
 
 from shower_fan import (
+    FanCommandBatcher,
+    DecayFit,
+    HumidityTrend,
+    ReferenceHumidity,
+    QuietHours,
+    SensorReading,
+    Metrics,
     ShowerFan,
+    AsyncShowerFan,
+    ShowerFanManager,
+    CONFIG_BATHROOMS,
     CONFIG_REFERENCE_HUMIDITY_SENSOR,
     CONFIG_HUMIDITY_SENSOR,
     CONFIG_QUIET_SWITCH,
     CONFIG_FAN,
+    CONFIG_HUMIDITY_SLOPE_HIGH,
+    CONFIG_FAN_COMMAND_BATCH_SECONDS,
+    CONFIG_SNAPSHOT_FILE,
+    CONFIG_METRICS_FILE,
+    CONFIG_TRACE_SIZE,
+    CONFIG_TRACE_DIRECTORY,
+    TRACE_DUMP_EVENT,
+    CONFIG_FAN_PERCENTAGE_GAIN,
+    CONFIG_DRYING_PREDICTION,
+    CONFIG_REFERENCE_HUMIDITY_STALE_MINUTES,
+    CONFIG_HUMIDITY_COMPARISON,
+    CONFIG_TEMPERATURE_SENSOR,
+    CONFIG_REFERENCE_TEMPERATURE_SENSOR,
+    CONFIG_QUIET_HOURS,
+    CONFIG_TRIGGER_ENTITIES,
+    absolute_humidity,
+    dew_point,
 )
 
 HASS_LISTEN_STATE = "listen_state"
@@ -43,6 +74,49 @@ def shower_fan_app() -> ShowerFan:
     pass
 
 
+@automation_fixture(
+    AsyncShowerFan,
+    args={
+        CONFIG_FAN: FAN,
+        CONFIG_REFERENCE_HUMIDITY_SENSOR: REFERENCE_HUMIDITY_SENSOR,
+        CONFIG_HUMIDITY_SENSOR: HUMIDITY_SENSOR,
+        CONFIG_QUIET_SWITCH: QUIET_SWITCH,
+    },
+    initialize=False,
+)
+def async_shower_fan_app() -> AsyncShowerFan:
+    pass
+
+
+GUEST_FAN = "fan.guest_bathroom_fan"
+GUEST_HUMIDITY_SENSOR = "sensor.guest_bathroom_climate_humidity"
+
+
+@automation_fixture(
+    ShowerFan,
+    args={CONFIG_FAN: GUEST_FAN, CONFIG_QUIET_SWITCH: QUIET_SWITCH},
+    initialize=False,
+)
+def guest_shower_fan_app() -> ShowerFan:
+    pass
+
+
+@automation_fixture(
+    ShowerFanManager,
+    args={
+        CONFIG_REFERENCE_HUMIDITY_SENSOR: REFERENCE_HUMIDITY_SENSOR,
+        CONFIG_QUIET_SWITCH: QUIET_SWITCH,
+        CONFIG_BATHROOMS: [
+            {CONFIG_FAN: FAN, CONFIG_HUMIDITY_SENSOR: HUMIDITY_SENSOR},
+            {CONFIG_FAN: GUEST_FAN, CONFIG_HUMIDITY_SENSOR: GUEST_HUMIDITY_SENSOR},
+        ],
+    },
+    initialize=False,
+)
+def shower_fan_manager_app() -> ShowerFanManager:
+    pass
+
+
 def test_listens_to_state(hass_driver, shower_fan_app: ShowerFan):
     shower_fan_app.initialize()
     listen_state = hass_driver.get_mock(HASS_LISTEN_STATE)
@@ -167,6 +241,8 @@ def test_restore_state_triggers_begin_quiet_and_turned_on_when_quiet_witch_is_on
         (ShowerFan.OFF, ShowerFan.TIMEOUT, ShowerFan.OFF),
         (ShowerFan.OFF, ShowerFan.LOW_HUMIDITY, ShowerFan.OFF),
         (ShowerFan.OFF, ShowerFan.END_QUIET, ShowerFan.OFF),
+        (ShowerFan.OFF, ShowerFan.OCCUPIED, ShowerFan.EXTRACTION),
+        (ShowerFan.OFF, ShowerFan.VACATED, ShowerFan.OFF),
         (ShowerFan.EXTRACTION, ShowerFan.TURNED_OFF, ShowerFan.OFF),
         (ShowerFan.EXTRACTION, ShowerFan.TIMEOUT, ShowerFan.OFF),
         (ShowerFan.EXTRACTION, ShowerFan.HIGH_HUMIDITY, ShowerFan.DRYING),
@@ -174,6 +250,8 @@ def test_restore_state_triggers_begin_quiet_and_turned_on_when_quiet_witch_is_on
         (ShowerFan.EXTRACTION, ShowerFan.TURNED_ON, ShowerFan.EXTRACTION),
         (ShowerFan.EXTRACTION, ShowerFan.BEGIN_QUIET, ShowerFan.QUIET),
         (ShowerFan.EXTRACTION, ShowerFan.END_QUIET, ShowerFan.EXTRACTION),
+        (ShowerFan.EXTRACTION, ShowerFan.OCCUPIED, ShowerFan.EXTRACTION),
+        (ShowerFan.EXTRACTION, ShowerFan.VACATED, ShowerFan.EXTRACTION),
         (ShowerFan.DRYING, ShowerFan.TURNED_OFF, ShowerFan.OFF),
         (ShowerFan.DRYING, ShowerFan.LOW_HUMIDITY, ShowerFan.OFF),
         (ShowerFan.DRYING, ShowerFan.TIMEOUT, ShowerFan.OFF),
@@ -181,6 +259,7 @@ def test_restore_state_triggers_begin_quiet_and_turned_on_when_quiet_witch_is_on
         (ShowerFan.DRYING, ShowerFan.HIGH_HUMIDITY, ShowerFan.DRYING),
         (ShowerFan.DRYING, ShowerFan.TURNED_ON, ShowerFan.DRYING),
         (ShowerFan.DRYING, ShowerFan.END_QUIET, ShowerFan.DRYING),
+        (ShowerFan.DRYING, ShowerFan.OCCUPIED, ShowerFan.DRYING),
         (ShowerFan.QUIET, ShowerFan.END_QUIET, ShowerFan.OFF),
         (ShowerFan.QUIET, ShowerFan.TURNED_ON, ShowerFan.QUIET_EXTRACTION),
         (ShowerFan.QUIET, ShowerFan.TURNED_OFF, ShowerFan.QUIET),
@@ -188,6 +267,7 @@ def test_restore_state_triggers_begin_quiet_and_turned_on_when_quiet_witch_is_on
         (ShowerFan.QUIET, ShowerFan.TIMEOUT, ShowerFan.QUIET),
         (ShowerFan.QUIET, ShowerFan.BEGIN_QUIET, ShowerFan.QUIET),
         (ShowerFan.QUIET, ShowerFan.HIGH_HUMIDITY, ShowerFan.QUIET),
+        (ShowerFan.QUIET, ShowerFan.OCCUPIED, ShowerFan.QUIET),
         (ShowerFan.QUIET_EXTRACTION, ShowerFan.TURNED_OFF, ShowerFan.QUIET),
         (ShowerFan.QUIET_EXTRACTION, ShowerFan.TIMEOUT, ShowerFan.QUIET),
         (ShowerFan.QUIET_EXTRACTION, ShowerFan.END_QUIET, ShowerFan.OFF),
@@ -236,6 +316,30 @@ def test_fan_turning_on_when_extraction(hass_driver, shower_fan_app: ShowerFan):
     )
 
 
+def test_failed_fan_command_is_not_cached_and_is_sent_again(
+    hass_driver, shower_fan_app: ShowerFan
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+    shower_fan_app.initialize()
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+    call_service.side_effect = RuntimeError("Home Assistant is not connected")
+
+    shower_fan_app.set_extraction()
+
+    assert shower_fan_app.fan_state == "off"
+
+    # AppDaemon returns None for a call that succeeded
+    call_service.side_effect = None
+    shower_fan_app.set_extraction()
+
+    assert shower_fan_app.fan_state == "on"
+    assert call_service.call_args_list == [
+        mock.call("homeassistant/turn_on", entity_id=FAN),
+        mock.call("homeassistant/turn_on", entity_id=FAN),
+    ]
+
+
 def test_fan_turning_off_when_off(hass_driver, shower_fan_app: ShowerFan):
     with hass_driver.setup():
         hass_driver.set_state(FAN, "on")
@@ -462,3 +566,1229 @@ def test_dryig_starts_long_timeout(
 
     run_in_mock = hass_driver.get_mock(HASS_RUN_IN)
     run_in_mock.assert_called_once_with(shower_fan_app.on_timeout, 3600)
+
+
+def test_invalid_transition_is_logged_and_not_published(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    shower_fan_app.initialize()
+    shower_fan_app.current_state = ShowerFan.QUIET
+    log_invalid_transition_spy = mocker.spy(shower_fan_app, "log_invalid_transition")
+    hass_driver.get_mock("set_state").reset_mock()
+
+    shower_fan_app.trigger(ShowerFan.HIGH_HUMIDITY)
+
+    log_invalid_transition_spy.assert_called_once_with(ShowerFan.HIGH_HUMIDITY)
+    hass_driver.get_mock("set_state").assert_not_called()
+
+
+def test_readme_state_diagram_matches_transitions():
+    with open("README.md") as readme:
+        assert ShowerFan.state_diagram() in readme.read()
+
+
+def test_fan_commands_use_cached_fan_state(hass_driver, shower_fan_app: ShowerFan):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+
+    shower_fan_app.initialize()
+    get_state = hass_driver.get_mock("get_state")
+    get_state.reset_mock()
+
+    shower_fan_app.set_extraction()
+    shower_fan_app.set_off()
+
+    get_state.assert_not_called()
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+    call_service.assert_has_calls(
+        [
+            mock.call("homeassistant/turn_on", entity_id=FAN),
+            mock.call("homeassistant/turn_off", entity_id=FAN),
+        ]
+    )
+
+
+def test_fan_state_is_resynced_periodically(hass_driver, shower_fan_app: ShowerFan):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+
+    shower_fan_app.initialize()
+    run_every = hass_driver.get_mock("run_every")
+    run_every.assert_called_once_with(shower_fan_app._on_fan_resync, "now+900.0", 900.0)
+
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "on")
+    shower_fan_app._on_fan_resync({})
+
+    assert shower_fan_app.is_on()
+    assert shower_fan_app.current_state == ShowerFan.EXTRACTION
+
+
+def test_humidity_reading_does_not_fetch_reference_humidity(
+    hass_driver, shower_fan_app: ShowerFan
+):
+    with hass_driver.setup():
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+
+    shower_fan_app.initialize()
+    get_state = hass_driver.get_mock("get_state")
+    get_state.reset_mock()
+
+    hass_driver.set_state(HUMIDITY_SENSOR, "71")
+
+    get_state.assert_not_called()
+
+
+def test_reference_humidity_change_triggers_low_humidity(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+        hass_driver.set_state(HUMIDITY_SENSOR, "65")
+
+    shower_fan_app.initialize()
+
+    trigger_spy = mocker.spy(shower_fan_app, "trigger")
+    hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "60")
+
+    trigger_spy.assert_has_calls(
+        [
+            mock.call(ShowerFan.LOW_HUMIDITY),
+        ]
+    )
+
+
+def test_manager_listens_to_shared_entities_once(
+    hass_driver, shower_fan_manager_app: ShowerFanManager
+):
+    shower_fan_manager_app.initialize()
+
+    listen_state = hass_driver.get_mock(HASS_LISTEN_STATE)
+    entities = [call.args[1] for call in listen_state.call_args_list]
+    assert sorted(entities) == sorted(
+        [
+            QUIET_SWITCH,
+            REFERENCE_HUMIDITY_SENSOR,
+            HUMIDITY_SENSOR,
+            GUEST_HUMIDITY_SENSOR,
+            FAN,
+            GUEST_FAN,
+        ]
+    )
+    get_state = hass_driver.get_mock("get_state")
+    assert get_state.call_count == 6
+
+
+def test_manager_fans_out_quiet_switch(
+    hass_driver, shower_fan_manager_app: ShowerFanManager
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "on")
+        hass_driver.set_state(GUEST_FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+
+    shower_fan_manager_app.initialize()
+    hass_driver.set_state(QUIET_SWITCH, "on")
+
+    assert [
+        bathroom.current_state for bathroom in shower_fan_manager_app.bathrooms
+    ] == [
+        ShowerFan.QUIET,
+        ShowerFan.QUIET,
+    ]
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+    call_service.assert_called_once_with("homeassistant/turn_off", entity_id=FAN)
+
+
+def test_manager_fans_out_reference_humidity(
+    hass_driver, shower_fan_manager_app: ShowerFanManager
+):
+    with hass_driver.setup():
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "40")
+        hass_driver.set_state(HUMIDITY_SENSOR, "65")
+        hass_driver.set_state(GUEST_HUMIDITY_SENSOR, "45")
+
+    shower_fan_manager_app.initialize()
+    hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "30")
+
+    assert [
+        bathroom.current_state for bathroom in shower_fan_manager_app.bathrooms
+    ] == [
+        ShowerFan.DRYING,
+        ShowerFan.OFF,
+    ]
+
+
+def test_manager_shares_resync_trace_listener_and_reference_readings(
+    hass_driver, shower_fan_manager_app: ShowerFanManager
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(GUEST_FAN, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "40")
+    shower_fan_manager_app.initialize()
+    master, guest = shower_fan_manager_app.bathrooms
+    run_every = hass_driver.get_mock("run_every")
+    listen_event = hass_driver.get_mock("listen_event")
+
+    assert run_every.call_count == 1
+    assert listen_event.call_count == 1
+    assert guest.reference is master.reference
+    assert guest.reference_humidity == 40
+
+    with hass_driver.setup():
+        hass_driver.set_state(GUEST_FAN, "on")
+    shower_fan_manager_app._on_fan_resync(run_every.call_args.kwargs)
+    assert guest.fan_state == "on"
+
+    log = hass_driver.get_mock("log")
+    log.reset_mock()
+    shower_fan_manager_app._on_event(
+        TRACE_DUMP_EVENT, {"name": "guest_bathroom_fan"}, {}
+    )
+    messages = [call.args[0] for call in log.call_args_list]
+    assert [message.split(":")[0] for message in messages] == ["guest_bathroom_fan"]
+
+
+def test_manager_gives_each_bathroom_its_own_snapshot_file(
+    hass_driver, shower_fan_manager_app: ShowerFanManager, tmp_path
+):
+    shower_fan_manager_app.args[CONFIG_SNAPSHOT_FILE] = str(tmp_path / "fan.json")
+    shower_fan_manager_app.initialize()
+
+    assert [
+        bathroom.snapshot_file for bathroom in shower_fan_manager_app.bathrooms
+    ] == [
+        str(tmp_path / "fan_master_bathroom_fan.json"),
+        str(tmp_path / "fan_guest_bathroom_fan.json"),
+    ]
+
+
+def test_state_sensor_writes_are_coalesced(hass_driver, shower_fan_app: ShowerFan):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+
+    shower_fan_app.initialize()
+    shower_fan_app.state_sensor_coalesce_seconds = 2
+    set_state = hass_driver.get_mock("set_state")
+    set_state.reset_mock()
+
+    shower_fan_app.trigger(ShowerFan.TURNED_ON)
+    shower_fan_app.trigger(ShowerFan.HIGH_HUMIDITY)
+
+    set_state.assert_not_called()
+    run_in = hass_driver.get_mock(HASS_RUN_IN)
+    run_in.assert_any_call(shower_fan_app._on_publish_state, 2)
+
+    shower_fan_app._on_publish_state({})
+
+    set_state.assert_called_once_with(
+        "sensor.ShowerFan_fan_state_machine",
+        state=ShowerFan.DRYING,
+        attributes={
+            "input": ShowerFan.HIGH_HUMIDITY,
+            "previous_state": ShowerFan.EXTRACTION,
+            "suppressed_writes": 0,
+            "coalesced_writes": 1,
+            "scheduler_operations": 1,
+        },
+    )
+
+
+def test_unchanged_state_sensor_write_is_suppressed(
+    hass_driver, shower_fan_app: ShowerFan
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+
+    shower_fan_app.initialize()
+    shower_fan_app.state_sensor_coalesce_seconds = 2
+    set_state = hass_driver.get_mock("set_state")
+    set_state.reset_mock()
+
+    shower_fan_app.trigger(ShowerFan.TURNED_ON)
+    shower_fan_app.trigger(ShowerFan.TURNED_OFF)
+    shower_fan_app._on_publish_state({})
+
+    set_state.assert_not_called()
+    assert shower_fan_app.suppressed_state_writes == 1
+    assert shower_fan_app.last_input == ShowerFan.TURNED_OFF
+    assert shower_fan_app.previous_state == ShowerFan.EXTRACTION
+
+
+def test_debug_messages_are_skipped_when_debug_is_disabled(
+    hass_driver, shower_fan_app: ShowerFan
+):
+    with hass_driver.setup():
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+
+    shower_fan_app.initialize()
+    shower_fan_app.debug_enabled = False
+    log = hass_driver.get_mock("log")
+    log.reset_mock()
+
+    hass_driver.set_state(HUMIDITY_SENSOR, "71")
+    hass_driver.set_state(QUIET_SWITCH, "on")
+
+    log.assert_not_called()
+
+
+def test_debug_messages_are_formatted_lazily(hass_driver, shower_fan_app: ShowerFan):
+    with hass_driver.setup():
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+
+    shower_fan_app.initialize()
+    log = hass_driver.get_mock("log")
+    log.reset_mock()
+
+    hass_driver.set_state(HUMIDITY_SENSOR, "60")
+
+    log.assert_has_calls(
+        [
+            mock.call(
+                "%s %s changed from %s to %s. %s",
+                HUMIDITY_SENSOR,
+                "state",
+                None,
+                "60",
+                {},
+                level="DEBUG",
+            ),
+            mock.call(
+                "humidity: %s, reference_humidity: %s", 60.0, 50.0, level="DEBUG"
+            ),
+        ]
+    )
+
+
+def _return_futures(hass_driver, *methods):
+    """Makes driver mocks behave like AppDaemon calls made on the event loop."""
+    for method in methods:
+        mock_method = hass_driver.get_mock(method)
+        side_effect = mock_method.side_effect
+
+        def returns_future(*args, side_effect=side_effect, **kwargs):
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(side_effect(*args, **kwargs) if side_effect else None)
+            return future
+
+        mock_method.side_effect = returns_future
+
+
+def test_async_shower_fan_awaits_transition_calls_together(
+    hass_driver, async_shower_fan_app: AsyncShowerFan
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    _return_futures(
+        hass_driver, "get_state", "call_service", "set_state", "run_in", "cancel_timer"
+    )
+
+    async def scenario():
+        await async_shower_fan_app.initialize()
+        assert async_shower_fan_app.current_state == ShowerFan.OFF
+        await async_shower_fan_app._on_humidity_state(
+            HUMIDITY_SENSOR, "state", "50", "71", {}
+        )
+        assert async_shower_fan_app._pending == []
+
+    asyncio.run(scenario())
+
+    assert async_shower_fan_app.current_state == ShowerFan.DRYING
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+    call_service.assert_called_once_with("homeassistant/turn_on", entity_id=FAN)
+    set_state = hass_driver.get_mock("set_state")
+    assert set_state.call_args.kwargs["state"] == ShowerFan.DRYING
+
+
+def test_async_failed_fan_command_re_reads_the_fan(
+    hass_driver, async_shower_fan_app: AsyncShowerFan
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    _return_futures(hass_driver, "get_state", "set_state", "run_in", "cancel_timer")
+
+    def fails(*args, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        future.set_exception(RuntimeError("Home Assistant is not connected"))
+        return future
+
+    hass_driver.get_mock(HASS_CALL_SERVICE).side_effect = fails
+
+    async def scenario():
+        await async_shower_fan_app.initialize()
+        await async_shower_fan_app._on_humidity_state(
+            HUMIDITY_SENSOR, "state", "50", "71", {}
+        )
+        assert async_shower_fan_app._pending == []
+
+    asyncio.run(scenario())
+
+    assert async_shower_fan_app.current_state == ShowerFan.DRYING
+    assert async_shower_fan_app.fan_state == "off"
+
+
+def test_humidity_trend_slope_covers_last_samples_only():
+    trend = HumidityTrend(3)
+    assert trend.slope() is None
+
+    for timestamp, humidity in [(0, 90), (60, 10), (120, 50), (180, 53), (240, 56)]:
+        trend.add(1_700_000_000 + timestamp, humidity)
+
+    assert trend.slope() == pytest.approx(0.05)
+    assert len(trend.times) == 3
+
+
+def test_humidity_trend_rebase_keeps_slope():
+    trend = HumidityTrend(4)
+    for minute in range(0, 3 * 24 * 60, 30):
+        trend.add(minute * 60, 40 + minute / 1000)
+
+    assert trend.origin > 0
+    assert trend.slope() == pytest.approx(1 / 60000)
+
+
+def test_rising_humidity_triggers_high_humidity_below_threshold(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+
+    shower_fan_app.args[CONFIG_HUMIDITY_SLOPE_HIGH] = 2
+    shower_fan_app.initialize()
+    clock = mocker.patch.object(shower_fan_app, "clock", return_value=0)
+
+    for timestamp, humidity in [(0, "55"), (60, "57"), (120, "60")]:
+        clock.return_value = timestamp
+        hass_driver.set_state(HUMIDITY_SENSOR, humidity)
+
+    assert shower_fan_app.current_state == ShowerFan.DRYING
+
+
+def test_extending_timeout_moves_deadline_without_rescheduling(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    shower_fan_app.initialize()
+    clock = mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    run_in = hass_driver.get_mock(HASS_RUN_IN)
+    cancel_timer = hass_driver.get_mock(HASS_CANCEL_TIMER)
+
+    shower_fan_app.begin_timeout(300)
+    clock.return_value = 1100
+    shower_fan_app.begin_timeout(300)
+
+    run_in.assert_called_once_with(shower_fan_app.on_timeout, 300)
+    cancel_timer.assert_not_called()
+    assert shower_fan_app.fan_timeout_deadline == 1400
+
+    trigger_spy = mocker.spy(shower_fan_app, "trigger")
+    clock.return_value = 1300
+    shower_fan_app.on_timeout({})
+
+    trigger_spy.assert_not_called()
+    run_in.assert_called_with(shower_fan_app.on_timeout, 100)
+
+    clock.return_value = 1400
+    shower_fan_app.on_timeout({})
+
+    trigger_spy.assert_called_once_with(ShowerFan.TIMEOUT)
+    assert shower_fan_app.scheduler_operations == 2
+
+
+def test_earlier_deadline_reschedules_timeout(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    shower_fan_app.initialize()
+    mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+
+    shower_fan_app.begin_timeout(3600)
+    handle = shower_fan_app.fan_timeout_handle
+    shower_fan_app.begin_timeout(300)
+
+    hass_driver.get_mock(HASS_CANCEL_TIMER).assert_called_once_with(handle)
+    hass_driver.get_mock(HASS_RUN_IN).assert_called_with(shower_fan_app.on_timeout, 300)
+    assert shower_fan_app.scheduler_operations == 3
+
+
+def test_ended_timeout_is_ignored_when_it_fires(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    shower_fan_app.initialize()
+    mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    shower_fan_app.set_extraction()
+    shower_fan_app.set_quiet()
+    trigger_spy = mocker.spy(shower_fan_app, "trigger")
+
+    shower_fan_app.on_timeout({})
+
+    hass_driver.get_mock(HASS_CANCEL_TIMER).assert_not_called()
+    trigger_spy.assert_not_called()
+
+
+@pytest.fixture
+def batched_fan_apps(
+    hass_driver,
+    shower_fan_app: ShowerFan,
+    guest_shower_fan_app: ShowerFan,
+    mocker: pytest_mock.MockerFixture,
+):
+    mocker.patch.object(ShowerFan, "fan_commands", FanCommandBatcher())
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "on")
+        hass_driver.set_state(GUEST_FAN, "on")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+    for app in (shower_fan_app, guest_shower_fan_app):
+        app.args[CONFIG_FAN_COMMAND_BATCH_SECONDS] = 0.5
+        app.initialize()
+    hass_driver.get_mock(HASS_RUN_IN).reset_mock()
+    return shower_fan_app, guest_shower_fan_app
+
+
+def test_fan_commands_from_many_apps_are_sent_together(hass_driver, batched_fan_apps):
+    hass_driver.set_state(QUIET_SWITCH, "on")
+
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+    call_service.assert_not_called()
+    run_in = hass_driver.get_mock(HASS_RUN_IN)
+    run_in.assert_called_once_with(ShowerFan.fan_commands._on_window_end, 0.5)
+
+    ShowerFan.fan_commands._on_window_end({})
+
+    call_service.assert_called_once_with(
+        "homeassistant/turn_off", entity_id=[FAN, GUEST_FAN]
+    )
+    assert [app.is_on() for app in batched_fan_apps] == [False, False]
+
+
+def test_failed_batched_fan_command_is_reported_to_its_app(
+    hass_driver, batched_fan_apps
+):
+    shower_fan_app, guest_shower_fan_app = batched_fan_apps
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+
+    def call_service_side_effect(service, entity_id):
+        if GUEST_FAN in entity_id:
+            raise RuntimeError(f"{GUEST_FAN} is unavailable")
+
+    call_service.side_effect = call_service_side_effect
+
+    hass_driver.set_state(QUIET_SWITCH, "on")
+    ShowerFan.fan_commands._on_window_end({})
+
+    call_service.assert_has_calls(
+        [
+            mock.call("homeassistant/turn_off", entity_id=[FAN, GUEST_FAN]),
+            mock.call("homeassistant/turn_off", entity_id=FAN),
+            mock.call("homeassistant/turn_off", entity_id=GUEST_FAN),
+        ]
+    )
+    hass_driver.get_mock(HASS_RUN_IN).assert_called_with(
+        guest_shower_fan_app.on_fan_command_failed,
+        0,
+        service="homeassistant/turn_off",
+    )
+    guest_shower_fan_app.on_fan_command_failed({"service": "homeassistant/turn_off"})
+    assert guest_shower_fan_app.is_on()
+
+
+def test_overrun_fan_command_window_is_taken_over_by_the_next_command(
+    hass_driver, batched_fan_apps, mocker: pytest_mock.MockerFixture
+):
+    shower_fan_app, guest_shower_fan_app = batched_fan_apps
+    clock = mocker.patch.object(ShowerFan, "clock", return_value=1000)
+    run_in = hass_driver.get_mock(HASS_RUN_IN)
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+
+    shower_fan_app.turn_off()
+    # its timer is lost, e.g. with the app reloaded
+    clock.return_value = 1060
+    guest_shower_fan_app.turn_off()
+
+    assert run_in.call_count == 2
+    hass_driver.get_mock(HASS_CANCEL_TIMER).assert_called_once()
+    ShowerFan.fan_commands._on_window_end({})
+    call_service.assert_called_once_with(
+        "homeassistant/turn_off", entity_id=[FAN, GUEST_FAN]
+    )
+
+
+def test_fan_command_window_is_released_when_run_in_fails_or_the_app_stops(
+    hass_driver, batched_fan_apps
+):
+    shower_fan_app, guest_shower_fan_app = batched_fan_apps
+    run_in = hass_driver.get_mock(HASS_RUN_IN)
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+
+    run_in.side_effect = RuntimeError("scheduler stopped")
+    with pytest.raises(RuntimeError):
+        shower_fan_app.turn_off()
+    assert shower_fan_app.is_on()
+
+    run_in.side_effect = None
+    guest_shower_fan_app.turn_off()
+    assert run_in.call_count == 2
+    guest_shower_fan_app.terminate()
+
+    call_service.assert_called_once_with(
+        "homeassistant/turn_off", entity_id=[GUEST_FAN]
+    )
+
+
+def test_transitions_are_saved_to_one_snapshot_per_window(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture, tmp_path
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+    shower_fan_app.args[CONFIG_SNAPSHOT_FILE] = str(tmp_path / "{name}.json")
+    mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    shower_fan_app.initialize()
+    shower_fan_app._on_save_snapshot({})
+    run_in = hass_driver.get_mock(HASS_RUN_IN)
+    run_in.reset_mock()
+
+    shower_fan_app.trigger(ShowerFan.TURNED_ON)
+    shower_fan_app.trigger(ShowerFan.HIGH_HUMIDITY)
+
+    assert (
+        run_in.call_args_list.count(mock.call(shower_fan_app._on_save_snapshot, 5)) == 1
+    )
+    shower_fan_app._on_save_snapshot({})
+
+    with open(tmp_path / "ShowerFan.json") as file:
+        snapshot = json.load(file)
+    assert snapshot["state"] == ShowerFan.DRYING
+    assert snapshot["deadline"] == 1000 + 3600
+
+
+def test_predicted_deadline_is_saved_and_flushed_on_terminate(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture, tmp_path
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    shower_fan_app.args[CONFIG_SNAPSHOT_FILE] = str(tmp_path / "{name}.json")
+    shower_fan_app.args[CONFIG_DRYING_PREDICTION] = True
+    clock = mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    shower_fan_app.initialize()
+    for t in (0, 60):
+        clock.return_value = 1000 + t
+        hass_driver.set_state(HUMIDITY_SENSOR, f"{50 + 30 * math.exp(-t / 600):.2f}")
+    shower_fan_app._on_save_snapshot({})
+
+    # the third reading moves the deadline to the predicted end of drying
+    clock.return_value = 1120
+    hass_driver.set_state(HUMIDITY_SENSOR, f"{50 + 30 * math.exp(-120 / 600):.2f}")
+    assert shower_fan_app._snapshot_handle is not None
+    shower_fan_app.terminate()
+
+    with open(tmp_path / "ShowerFan.json") as file:
+        snapshot = json.load(file)
+    assert snapshot["deadline"] == shower_fan_app.fan_timeout_deadline
+    assert snapshot["deadline"] == pytest.approx(1000 + 600 * math.log(3), abs=1)
+
+
+def test_restart_resumes_drying_with_remaining_timeout(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture, tmp_path
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "on")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+    snapshot_file = tmp_path / "snapshot.json"
+    snapshot_file.write_text(json.dumps({"state": "drying", "deadline": 2200}))
+    shower_fan_app.args[CONFIG_SNAPSHOT_FILE] = str(snapshot_file)
+    mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+
+    shower_fan_app.initialize()
+
+    assert shower_fan_app.current_state == ShowerFan.DRYING
+    hass_driver.get_mock(HASS_CALL_SERVICE).assert_not_called()
+    hass_driver.get_mock(HASS_RUN_IN).assert_called_once_with(
+        shower_fan_app.on_timeout, 1200
+    )
+
+
+def test_snapshot_disagreeing_with_live_fan_is_ignored(
+    hass_driver, shower_fan_app: ShowerFan, tmp_path
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+    snapshot_file = tmp_path / "snapshot.json"
+    snapshot_file.write_text(json.dumps({"state": "drying", "deadline": 2200}))
+    shower_fan_app.args[CONFIG_SNAPSHOT_FILE] = str(snapshot_file)
+
+    shower_fan_app.initialize()
+
+    assert shower_fan_app.current_state == ShowerFan.OFF
+    hass_driver.get_mock(HASS_CALL_SERVICE).assert_not_called()
+
+
+def test_metrics_count_transitions_calls_and_callback_latency(
+    hass_driver, shower_fan_app: ShowerFan
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+    shower_fan_app.initialize()
+
+    hass_driver.set_state(FAN, "on")
+    hass_driver.set_state(QUIET_SWITCH, "unavailable")
+    shower_fan_app.trigger(ShowerFan.LOW_HUMIDITY)
+
+    metrics = shower_fan_app.metrics
+    attributes = metrics.attributes()
+    assert attributes["transitions"]["init / turned off"] == 1
+    assert attributes["transitions"]["off / turned on"] == 1
+    assert attributes["invalid_transitions"] == 1
+    assert attributes["get_state"] == 4
+    assert attributes["call_service"] == 0
+    assert attributes["set_state"] == 2
+    assert attributes["latency"]["fan"]["count"] == 1
+    assert attributes["latency"]["quiet_switch"]["count"] == 1
+    assert attributes["latency"]["trigger"]["count"] == 3
+
+
+def test_metrics_are_published_to_a_sensor_and_prometheus_file(
+    hass_driver, shower_fan_app: ShowerFan, tmp_path
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+    shower_fan_app.args[CONFIG_METRICS_FILE] = str(tmp_path / "{name}.prom")
+    shower_fan_app.initialize()
+    shower_fan_app.metrics.observe(Metrics.HISTOGRAMS.index("humidity"), 0.003)
+
+    shower_fan_app.publish_metrics()
+
+    hass_driver.get_mock("set_state").assert_called_with(
+        "sensor.ShowerFan_fan_metrics",
+        state=1,
+        attributes=mock.ANY,
+    )
+    text = (tmp_path / "ShowerFan.prom").read_text()
+    assert (
+        'shower_fan_transitions_total{app="ShowerFan",state="init",'
+        'input="turned off"} 1'
+    ) in text
+    assert (
+        'shower_fan_callback_seconds_bucket{app="ShowerFan",callback="humidity",'
+        'le="0.0025"} 0'
+    ) in text
+    assert (
+        'shower_fan_callback_seconds_bucket{app="ShowerFan",callback="humidity",'
+        'le="0.005"} 1'
+    ) in text
+
+
+def test_trace_keeps_last_inputs_including_invalid_ones(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    shower_fan_app.args[CONFIG_TRACE_SIZE] = 2
+    mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    shower_fan_app.initialize()
+    log = hass_driver.get_mock("log")
+    log.reset_mock()
+
+    hass_driver.set_state(HUMIDITY_SENSOR, "80")
+    shower_fan_app.trigger(ShowerFan.END_QUIET)
+
+    assert list(shower_fan_app.trace.records()) == [
+        {
+            "time": 1000,
+            "state": ShowerFan.OFF,
+            "input": ShowerFan.HIGH_HUMIDITY,
+            "target": ShowerFan.DRYING,
+            "humidity": 80.0,
+        },
+        {
+            "time": 1000,
+            "state": ShowerFan.DRYING,
+            "input": ShowerFan.END_QUIET,
+            "target": ShowerFan.DRYING,
+            "humidity": 80.0,
+        },
+    ]
+    assert all(call.kwargs["level"] == "DEBUG" for call in log.call_args_list)
+
+
+def test_trace_is_dumped_to_csv_on_event(
+    hass_driver, shower_fan_app: ShowerFan, tmp_path
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+    shower_fan_app.args[CONFIG_TRACE_DIRECTORY] = str(tmp_path)
+    shower_fan_app.initialize()
+    hass_driver.get_mock("listen_event").assert_called_once_with(
+        shower_fan_app._on_dump_trace_event, TRACE_DUMP_EVENT
+    )
+
+    shower_fan_app._on_dump_trace_event(
+        TRACE_DUMP_EVENT, {"format": "csv", "file": "{name}.csv"}, {}
+    )
+
+    lines = (tmp_path / "ShowerFan.csv").read_text().splitlines()
+    assert lines[0] == "time,state,input,target,humidity"
+    assert lines[1].split(",")[1:] == ["init", "turned off", "off", ""]
+
+
+def test_trace_dump_only_writes_into_the_trace_directory(
+    hass_driver, shower_fan_app: ShowerFan, tmp_path
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+    apps_yaml = tmp_path / "apps.yaml"
+    apps_yaml.write_text("shower_fan: {}\n")
+    trace_directory = tmp_path / "traces"
+    trace_directory.mkdir()
+    shower_fan_app.initialize()
+
+    shower_fan_app._on_dump_trace_event(TRACE_DUMP_EVENT, {"file": "trace.json"}, {})
+    assert not (tmp_path / "trace.json").exists()
+
+    shower_fan_app.args[CONFIG_TRACE_DIRECTORY] = str(trace_directory)
+    shower_fan_app.initialize()
+    shower_fan_app._on_dump_trace_event(TRACE_DUMP_EVENT, {"file": str(apps_yaml)}, {})
+    shower_fan_app._on_dump_trace_event(TRACE_DUMP_EVENT, {"file": ".."}, {})
+
+    assert apps_yaml.read_text() == "shower_fan: {}\n"
+    assert [path.name for path in trace_directory.iterdir()] == ["apps.yaml"]
+
+
+def test_drying_speed_follows_humidity_at_a_limited_rate(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    shower_fan_app.args[CONFIG_FAN_PERCENTAGE_GAIN] = 3
+    clock = mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    shower_fan_app.initialize()
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+
+    hass_driver.set_state(HUMIDITY_SENSOR, "80")
+    call_service.assert_called_once_with(
+        "fan/set_percentage", entity_id=FAN, percentage=90
+    )
+
+    clock.return_value = 1030
+    hass_driver.set_state(HUMIDITY_SENSOR, "70")
+    assert call_service.call_count == 1
+
+    clock.return_value = 1060
+    hass_driver.set_state(HUMIDITY_SENSOR, "69")
+    call_service.assert_called_with("fan/set_percentage", entity_id=FAN, percentage=60)
+
+    clock.return_value = 1200
+    hass_driver.set_state(HUMIDITY_SENSOR, "68.5")
+    assert call_service.call_count == 2
+
+    hass_driver.set_state(HUMIDITY_SENSOR, "59")
+    assert shower_fan_app.current_state == ShowerFan.OFF
+    call_service.assert_called_with("homeassistant/turn_off", entity_id=FAN)
+
+
+def test_decay_fit_predicts_threshold_crossing_after_the_peak():
+    fit = DecayFit()
+    fit.add(0, 20)
+    fit.add(60, 30)
+    for t in (120, 180, 240):
+        fit.add(t, 30 * math.exp(-(t - 60) / 600))
+
+    assert fit.count == 4
+    assert fit.predict(10) == pytest.approx(60 + 600 * math.log(3))
+
+
+def test_drying_ends_at_predicted_time_and_learns_timeout(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    shower_fan_app.args[CONFIG_DRYING_PREDICTION] = True
+    clock = mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    shower_fan_app.initialize()
+    run_in = hass_driver.get_mock(HASS_RUN_IN)
+
+    for t in (0, 60, 120, 180):
+        clock.return_value = 1000 + t
+        hass_driver.set_state(HUMIDITY_SENSOR, f"{50 + 30 * math.exp(-t / 600):.2f}")
+
+    assert shower_fan_app.current_state == ShowerFan.DRYING
+    dry_at = 1000 + 600 * math.log(3)
+    assert shower_fan_app.fan_timeout_deadline == pytest.approx(dry_at, abs=1)
+    run_in.assert_called_with(shower_fan_app.on_timeout, mock.ANY)
+
+    clock.return_value = 1650
+    hass_driver.set_state(HUMIDITY_SENSOR, "60.00")
+    clock.return_value = shower_fan_app.fan_timeout_deadline
+    shower_fan_app.on_timeout({})
+
+    assert shower_fan_app.current_state == ShowerFan.OFF
+    assert shower_fan_app.learned_drying_seconds == pytest.approx(650, abs=5)
+    assert shower_fan_app.drying_timeout() == pytest.approx(1300, abs=10)
+
+
+def test_drying_ignores_a_past_prediction_and_learns_only_reaching_the_threshold(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    shower_fan_app.args[CONFIG_DRYING_PREDICTION] = True
+    clock = mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    shower_fan_app.initialize()
+
+    # a fast drop then a plateau puts the fitted crossing in the past
+    for t, humidity in ((0, "80"), (60, "62"), (120, "61.5"), (180, "61.4")):
+        clock.return_value = 1000 + t
+        hass_driver.set_state(HUMIDITY_SENSOR, humidity)
+
+    assert shower_fan_app.current_state == ShowerFan.DRYING
+    assert shower_fan_app.fan_timeout_deadline == 1000 + 60 * 60
+
+    clock.return_value = shower_fan_app.fan_timeout_deadline
+    shower_fan_app.on_timeout({})
+
+    assert shower_fan_app.current_state == ShowerFan.OFF
+    assert shower_fan_app.learned_drying_seconds is None
+
+    clock.return_value = 5000
+    hass_driver.set_state(HUMIDITY_SENSOR, "80")
+    clock.return_value = 5300
+    hass_driver.set_state(HUMIDITY_SENSOR, "65")
+    # switched off by hand
+    hass_driver.set_state(FAN, "on")
+    hass_driver.set_state(FAN, "off")
+
+    assert shower_fan_app.current_state == ShowerFan.OFF
+    assert shower_fan_app.learned_drying_seconds is None
+
+
+def test_readings_queued_behind_a_slow_transition_are_merged(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    shower_fan_app.initialize()
+    humidity_changed_spy = mocker.spy(shower_fan_app, "humidity_changed")
+
+    def readings_arrive_meanwhile(service, entity_id):
+        if service != "homeassistant/turn_on":
+            return
+        for value in ("75", "55"):
+            shower_fan_app._on_humidity_state(HUMIDITY_SENSOR, "state", None, value, {})
+
+    hass_driver.get_mock(HASS_CALL_SERVICE).side_effect = readings_arrive_meanwhile
+
+    shower_fan_app._on_humidity_state(HUMIDITY_SENSOR, "state", None, "80", {})
+
+    assert humidity_changed_spy.call_args_list == [mock.call("80"), mock.call("55")]
+    assert shower_fan_app.current_state == ShowerFan.OFF
+    assert shower_fan_app.metrics.attributes()["merged_events"] == 1
+
+
+def test_reference_humidity_median_and_trimmed_mean_update_per_reading():
+    median = ReferenceHumidity()
+    trimmed = ReferenceHumidity("trimmed_mean")
+    for reference in (median, trimmed):
+        for sensor, value in (("a", 50), ("b", 52), ("c", 90), ("d", 48)):
+            reference.update(sensor, 0, value)
+
+    assert median.value() == 51
+    assert trimmed.value() == 51
+
+    median.update("c", 1, 51)
+    median.update("d", 1, None)
+    assert median.value() == 51
+
+
+def test_last_reporting_reference_sensor_is_never_stale():
+    reference = ReferenceHumidity(stale_seconds=1800)
+    reference.update("a", 0, 50)
+    reference.update("b", 600, 54)
+
+    assert reference.value(600 + 2400) == 54
+    assert reference.value(600 + 86400) == 54
+
+
+def test_stale_reference_sensors_are_left_out(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    second_sensor = "sensor.hallway_humidity"
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "40")
+        hass_driver.set_state(second_sensor, "60")
+    shower_fan_app.args[CONFIG_REFERENCE_HUMIDITY_SENSOR] = [
+        REFERENCE_HUMIDITY_SENSOR,
+        second_sensor,
+    ]
+    shower_fan_app.args[CONFIG_REFERENCE_HUMIDITY_STALE_MINUTES] = 30
+    clock = mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    shower_fan_app.initialize()
+    get_state = hass_driver.get_mock("get_state")
+    get_state.reset_mock()
+
+    assert shower_fan_app.reference_humidity == 50
+
+    clock.return_value = 1000 + 20 * 60
+    hass_driver.set_state(second_sensor, "62")
+    assert shower_fan_app.reference_humidity == 51
+
+    clock.return_value = 1000 + 31 * 60
+    hass_driver.set_state(HUMIDITY_SENSOR, "75")
+
+    assert shower_fan_app.reference_humidity == 62
+    assert shower_fan_app.current_state == ShowerFan.OFF
+    get_state.assert_not_called()
+
+
+def test_absolute_humidity_and_dew_point_match_the_magnus_formula():
+    for relative_humidity, temperature in ((50, 20), (85, 22.3), (38, 27.8), (60, -5)):
+        saturation = 6.112 * math.exp(17.62 * temperature / (243.12 + temperature))
+        gamma = math.log(relative_humidity / 100) + 17.62 * temperature / (
+            243.12 + temperature
+        )
+        assert absolute_humidity(relative_humidity, temperature) == pytest.approx(
+            216.7 * relative_humidity / 100 * saturation / (273.15 + temperature),
+            rel=1e-3,
+        )
+        assert dew_point(relative_humidity, temperature) == pytest.approx(
+            243.12 * gamma / (17.62 - gamma), abs=0.01
+        )
+
+
+def test_dew_point_comparison_keeps_drying_a_warm_bathroom(
+    hass_driver, shower_fan_app: ShowerFan
+):
+    temperature_sensor = "sensor.master_bathroom_climate_temperature"
+    reference_temperature_sensor = "sensor.living_room_temperature"
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+        hass_driver.set_state(reference_temperature_sensor, "20")
+        hass_driver.set_state(temperature_sensor, "22")
+    shower_fan_app.args[CONFIG_HUMIDITY_COMPARISON] = "dew_point"
+    shower_fan_app.args[CONFIG_TEMPERATURE_SENSOR] = temperature_sensor
+    shower_fan_app.args[CONFIG_REFERENCE_TEMPERATURE_SENSOR] = (
+        reference_temperature_sensor
+    )
+    shower_fan_app.initialize()
+
+    assert shower_fan_app.reference_humidity == pytest.approx(9.25, abs=0.01)
+
+    hass_driver.set_state(HUMIDITY_SENSOR, "85")
+    assert shower_fan_app.current_state == ShowerFan.DRYING
+
+    # the bathroom warms up: its relative humidity falls, the moisture stays
+    hass_driver.set_state(temperature_sensor, "27")
+    hass_driver.set_state(HUMIDITY_SENSOR, "55")
+    assert shower_fan_app.humidity == pytest.approx(17.19, abs=0.01)
+    assert shower_fan_app.current_state == ShowerFan.DRYING
+
+    hass_driver.set_state(HUMIDITY_SENSOR, "38")
+    assert shower_fan_app.current_state == ShowerFan.OFF
+
+
+def test_quiet_hours_cross_midnight_and_the_end_of_the_week():
+    hour = 3600
+    day = 24 * hour
+    quiet_hours = QuietHours(
+        [
+            {"start": QUIET_TIME_FROM, "end": QUIET_TIME_TO, "days": "sun,mon"},
+            {"start": "13:00", "end": "15:00", "days": ["Sun"]},
+            "06:00-08:00",
+        ]
+    )
+
+    assert quiet_hours.is_quiet(0)
+    assert quiet_hours.is_quiet(7.5 * hour)
+    assert not quiet_hours.is_quiet(8 * hour)
+    assert quiet_hours.next_change(0) == 8 * hour
+    assert quiet_hours.next_change(8 * hour) == 21 * hour
+    assert quiet_hours.is_quiet(day + 2 * hour)
+    assert not quiet_hours.is_quiet(3 * day + 5 * hour)
+    assert quiet_hours.is_quiet(6 * day + 14 * hour)
+    # Sunday 21:00 to Monday 08:00 is one period across the week's end
+    assert quiet_hours.next_change(6 * day + 20 * hour) == 6 * day + 21 * hour
+    assert quiet_hours.next_change(6 * day + 22 * hour) == 7 * day + 8 * hour
+
+
+def test_quiet_hours_begin_and_end_quiet_at_boundary_timers(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+    del shower_fan_app.args[CONFIG_QUIET_SWITCH]
+    shower_fan_app.args[CONFIG_QUIET_HOURS] = [f"{QUIET_TIME_FROM}-{QUIET_TIME_TO}"]
+    mocker.patch.object(
+        shower_fan_app, "datetime", return_value=datetime(2026, 10, 16, 23, 30)
+    )
+    shower_fan_app.initialize()
+    run_at = hass_driver.get_mock("run_at")
+
+    assert shower_fan_app.current_state == ShowerFan.QUIET
+    run_at.assert_called_once_with(
+        shower_fan_app._on_quiet_hours, datetime(2026, 10, 17, 7, 0)
+    )
+    listened = [c.args[1] for c in hass_driver.get_mock(HASS_LISTEN_STATE).mock_calls]
+    assert QUIET_SWITCH not in listened
+
+    shower_fan_app._on_quiet_hours({})
+
+    assert shower_fan_app.current_state == ShowerFan.OFF
+    run_at.assert_called_with(
+        shower_fan_app._on_quiet_hours, datetime(2026, 10, 17, 21, 0)
+    )
+
+
+def test_async_quiet_hours_start_from_appdaemon_time(
+    hass_driver, async_shower_fan_app: AsyncShowerFan, mocker: pytest_mock.MockerFixture
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+    _return_futures(hass_driver, "get_state", "call_service", "set_state", "run_at")
+    del async_shower_fan_app.args[CONFIG_QUIET_SWITCH]
+    async_shower_fan_app.args[CONFIG_QUIET_HOURS] = [
+        f"{QUIET_TIME_FROM}-{QUIET_TIME_TO}"
+    ]
+    mocker.patch.object(
+        async_shower_fan_app,
+        "datetime",
+        mocker.AsyncMock(return_value=datetime(2026, 10, 17, 12, 0)),
+    )
+
+    asyncio.run(async_shower_fan_app.initialize())
+
+    assert async_shower_fan_app.current_state == ShowerFan.OFF
+    hass_driver.get_mock("run_at").assert_called_once_with(
+        async_shower_fan_app._on_quiet_hours, datetime(2026, 10, 17, 21, 0)
+    )
+
+
+def test_trigger_entities_hold_extraction_and_run_on_after_the_last_is_off(
+    hass_driver, shower_fan_app: ShowerFan, mocker: pytest_mock.MockerFixture
+):
+    light = "light.master_bathroom"
+    occupancy = "binary_sensor.master_bathroom_occupancy"
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(light, "off")
+        hass_driver.set_state(occupancy, "off")
+    shower_fan_app.args[CONFIG_TRIGGER_ENTITIES] = [light, occupancy]
+    mocker.patch.object(shower_fan_app, "clock", return_value=1000)
+    shower_fan_app.initialize()
+    call_service = hass_driver.get_mock(HASS_CALL_SERVICE)
+
+    hass_driver.set_state(light, "on")
+    assert shower_fan_app.current_state == ShowerFan.EXTRACTION
+    call_service.assert_called_once_with("homeassistant/turn_on", entity_id=FAN)
+    assert shower_fan_app.fan_timeout_deadline == 1000 + 60 * 60
+
+    hass_driver.set_state(occupancy, "on")
+    hass_driver.set_state(light, "off")
+    assert shower_fan_app.fan_timeout_deadline == 1000 + 60 * 60
+
+    hass_driver.set_state(occupancy, "off")
+    assert shower_fan_app.current_state == ShowerFan.EXTRACTION
+    assert shower_fan_app.fan_timeout_deadline == 1000 + 5 * 60
+    assert call_service.call_count == 1
+
+
+def test_trigger_entities_are_ignored_when_quiet(
+    hass_driver, shower_fan_app: ShowerFan
+):
+    light = "light.master_bathroom"
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "on")
+        hass_driver.set_state(light, "off")
+    shower_fan_app.args[CONFIG_TRIGGER_ENTITIES] = light
+    shower_fan_app.initialize()
+
+    hass_driver.set_state(light, "on")
+
+    assert shower_fan_app.current_state == ShowerFan.QUIET
+    hass_driver.get_mock(HASS_CALL_SERVICE).assert_not_called()
+
+
+def test_sensor_reading_keeps_last_good_value_through_non_numeric_states():
+    reading = SensorReading()
+
+    assert reading.update("61.5", 100)
+    assert not reading.update("unavailable", 130)
+    assert not reading.update("unknown", 160)
+    assert not reading.update(None, 170)
+
+    assert reading.value == 61.5
+    assert reading.down_since == 130
+    assert reading.age(190) == 90
+    assert reading.update("60", 200)
+    assert reading.down_since is None
+
+
+def test_unavailable_humidity_sensor_holds_state_then_drops_its_value(
+    hass_driver, shower_fan_app: ShowerFan
+):
+    with hass_driver.setup():
+        hass_driver.set_state(FAN, "off")
+        hass_driver.set_state(QUIET_SWITCH, "off")
+        hass_driver.set_state(REFERENCE_HUMIDITY_SENSOR, "50")
+    shower_fan_app.initialize()
+    run_in = hass_driver.get_mock(HASS_RUN_IN)
+    hass_driver.set_state(HUMIDITY_SENSOR, "80")
+    run_in.reset_mock()
+
+    hass_driver.set_state(HUMIDITY_SENSOR, "unavailable")
+    hass_driver.set_state(HUMIDITY_SENSOR, "unknown")
+    hass_driver.set_state(HUMIDITY_SENSOR, "nan")
+    hass_driver.set_state(HUMIDITY_SENSOR, "-inf")
+
+    assert shower_fan_app.current_state == ShowerFan.DRYING
+    assert shower_fan_app.humidity == 80
+    assert shower_fan_app.metrics.attributes()["parse_failures"] == 4
+    run_in.assert_called_once_with(
+        shower_fan_app._on_sensor_hold,
+        10 * 60,
+        entity=HUMIDITY_SENSOR,
+        reading=shower_fan_app.humidity_reading,
+        since=mock.ANY,
+        lost=shower_fan_app.humidity_lost,
+    )
+
+    shower_fan_app._on_sensor_hold(run_in.call_args.kwargs)
+
+    assert shower_fan_app.humidity is None
+    assert shower_fan_app.current_state == ShowerFan.DRYING
+    hass_driver.set_state(HUMIDITY_SENSOR, "55")
+    assert shower_fan_app.current_state == ShowerFan.OFF
+
+
+def test_absolute_comparison_requires_both_temperature_sensors(
+    hass_driver, shower_fan_app: ShowerFan
+):
+    shower_fan_app.args[CONFIG_HUMIDITY_COMPARISON] = "absolute"
+    shower_fan_app.args[CONFIG_TEMPERATURE_SENSOR] = "sensor.bathroom_temperature"
+
+    with pytest.raises(ValueError, match=CONFIG_REFERENCE_TEMPERATURE_SENSOR):
+        shower_fan_app.initialize()
+
+    listened = [c.args[1] for c in hass_driver.get_mock(HASS_LISTEN_STATE).mock_calls]
+    assert None not in listened
@@ -0,0 +1,69 @@
+import sys
+
+sys.path.append("apps/shower_fan")
+sys.path.append("tools")
+
+from shower_fan import (  # noqa: E402
+    ShowerFan,
+    CONFIG_FAN,
+    CONFIG_FAN_COMMAND_BATCH_SECONDS,
+    CONFIG_HUMIDITY_SENSOR,
+)
+from simulation import Simulation  # noqa: E402
+
+FAN = "fan.master_bathroom_fan"
+HUMIDITY_SENSOR = "sensor.master_bathroom_climate_humidity"
+
+
+def test_manually_switched_on_fan_turns_off_after_delay():
+    simulation = Simulation(start=1000)
+    app = simulation.create_app(
+        ShowerFan,
+        "bathroom",
+        {CONFIG_FAN: FAN, CONFIG_HUMIDITY_SENSOR: HUMIDITY_SENSOR},
+    )
+
+    simulation.set_state(FAN, "on", at=1060)
+    assert app.current_state == ShowerFan.EXTRACTION
+
+    simulation.advance(1060 + 299)
+    assert simulation.states[FAN] == "on"
+
+    simulation.advance(1060 + 300)
+    assert simulation.states[FAN] == "off"
+    assert app.current_state == ShowerFan.OFF
+    assert simulation.calls["call_service"] == 1
+
+
+def test_app_service_calls_are_delivered_after_the_callback():
+    simulation = Simulation()
+    simulation.states[FAN] = "off"
+    app = simulation.create_app(ShowerFan, "bathroom", {CONFIG_FAN: FAN})
+    app.set_extraction()
+
+    assert simulation.states[FAN] == "on"
+    assert list(simulation._pending) == [(app._on_fan_state, FAN, "off", "on")]
+
+
+def test_batched_fan_commands_make_one_service_call():
+    simulation = Simulation(start=1000)
+    fans = [FAN, "fan.guest_bathroom_fan"]
+    for fan in fans:
+        simulation.states[fan] = "off"
+    apps = [
+        simulation.create_app(
+            ShowerFan,
+            fan,
+            {CONFIG_FAN: fan, CONFIG_FAN_COMMAND_BATCH_SECONDS: 0.5},
+        )
+        for fan in fans
+    ]
+    get_state_calls = simulation.calls["get_state"]
+    for app in apps:
+        app.set_extraction()
+
+    simulation.advance(1001)
+
+    assert [simulation.states[fan] for fan in fans] == ["on", "on"]
+    assert simulation.calls["call_service"] == 1
+    assert simulation.calls["get_state"] == get_state_calls
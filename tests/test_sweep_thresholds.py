@@ -0,0 +1,70 @@
+import math
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+sys.path.append("apps/shower_fan")
+sys.path.append("tools")
+
+from replay_history import replay  # noqa: E402
+from sweep_thresholds import History, parameter_grid, sweep  # noqa: E402
+
+FAN = "fan.master_bathroom_fan"
+REFERENCE_HUMIDITY_SENSOR = "sensor.living_room_humidity"
+HUMIDITY_SENSOR = "sensor.master_bathroom_climate_humidity"
+START = 1_700_000_000
+
+
+def shower_history(days=2):
+    rows = []
+    for minute in range(days * 24 * 60):
+        t = START + minute * 60
+        if minute % 240 == 0:
+            rows.append((t, REFERENCE_HUMIDITY_SENSOR, "50"))
+        since_shower = minute % 720
+        excess = 35 * math.exp(-since_shower / 25) if since_shower < 400 else 2
+        rows.append((t + 1, HUMIDITY_SENSOR, f"{52 + excess:.1f}"))
+        if minute % 1440 == 600:
+            rows.append((t + 2, FAN, "on"))
+        elif minute % 1440 == 640:
+            # recorded after the app switched the fan off again
+            rows.append((t + 2, FAN, "off"))
+    return rows
+
+
+def test_parameter_grid_drops_low_above_high():
+    high, low, delay = parameter_grid([10, 20], [5, 15], [1, 2])
+
+    assert len(high) == 6
+    assert (low < high).all()
+
+
+def test_sweep_matches_event_replay():
+    rows = shower_history()
+    history = History.from_rows(
+        iter(rows), HUMIDITY_SENSOR, REFERENCE_HUMIDITY_SENSOR, FAN
+    )
+    high, low, delay = parameter_grid([15, 25], [5, 10], [5, 20])
+
+    results = sweep(history, high, low, delay)
+
+    for i in range(len(high)):
+        summary = replay(
+            iter(rows),
+            {
+                "fan": FAN,
+                "humidity_sensor": HUMIDITY_SENSOR,
+                "reference_humidity_sensor": REFERENCE_HUMIDITY_SENSOR,
+                "humidity_relative_high": high[i],
+                "humidity_relative_low": low[i],
+                "fan_off_delay_minutes": delay[i],
+            },
+            lambda record: None,
+            include_fan=True,
+        )
+        assert results["fan_cycles"][i] == summary["fan_on_intervals"]
+        assert results["fan_runtime_hours"][i] * 3600 == pytest.approx(
+            summary["fan_on_seconds"], abs=summary["fan_on_intervals"] * 120
+        )
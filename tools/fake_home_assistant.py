@@ -0,0 +1,331 @@
+"""Fake Home Assistant for running real AppDaemon against, offline.
+
+Speaks the part of the Home Assistant API that AppDaemon's hass plugin uses:
+the websocket handshake and `subscribe_events` stream, and the REST endpoints
+for the config, services, states, `set_state`, `call_service` and events. The
+entity store is in memory; service calls switch entities on and off and change
+fan percentages, and every change is streamed as a `state_changed` event.
+
+    python tools/fake_home_assistant.py --port 8123 --token secret \\
+        --state sensor.living_room_humidity=50 --state fan.bathroom=off
+
+Used in-process by benchmarks/bench_appdaemon.py, which awaits `start()` and
+drives state changes with `set_state()`.
+"""
+
+import argparse
+import asyncio
+import json
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from aiohttp import WSMsgType, web
+
+HA_VERSION = "2024.1.0"
+CONFIG = {
+    "latitude": 51.5,
+    "longitude": -0.1,
+    "elevation": 10,
+    "time_zone": "UTC",
+    "unit_system": {"temperature": "°C", "length": "km"},
+    "location_name": "Fake Home",
+    "version": HA_VERSION,
+    "components": ["fan", "homeassistant", "sensor", "switch"],
+    "state": "RUNNING",
+}
+SERVICES = {
+    "homeassistant": ("turn_on", "turn_off", "toggle"),
+    "fan": ("turn_on", "turn_off", "toggle", "set_percentage"),
+    "switch": ("turn_on", "turn_off", "toggle"),
+}
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeHomeAssistant:
+    """In-memory Home Assistant serving AppDaemon over HTTP and a websocket.
+
+    `on_service_call(domain, service, data)` and `on_set_state(entity_id, state)`
+    are called as the requests arrive, before they are applied. `calls` counts
+    requests by kind.
+    """
+
+    def __init__(self, token="fake-token", config=CONFIG, services=SERVICES):
+        self.token = token
+        self.config = dict(config)
+        self.services = services
+        self.states = {}
+        self.calls = Counter()
+        self.on_service_call = None
+        self.on_set_state = None
+        self._subscribers = []
+        self._runner = None
+
+    # server --------------------------
+
+    def application(self):
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/api/websocket", self._websocket),
+                web.get("/api/", self._api_running),
+                web.get("/api/config", self._get_config),
+                web.get("/api/services", self._get_services),
+                web.get("/api/states", self._get_states),
+                web.get("/api/states/{entity_id}", self._get_entity_state),
+                web.post("/api/states/{entity_id}", self._post_state),
+                web.post("/api/services/{domain}/{service}", self._post_service),
+                web.post("/api/events/{event_type}", self._post_event),
+            ]
+        )
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Serves on `host:port` (any free port for 0); returns the base URL."""
+        self._runner = web.AppRunner(self.application(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        for ws, _ in list(self._subscribers):
+            await ws.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # entity store --------------------
+
+    async def set_state(self, entity_id, state, attributes=None):
+        """Changes an entity, e.g. a sensor reading, and streams the change."""
+        old = self.states.get(entity_id)
+        now = _now_iso()
+        new = {
+            "entity_id": entity_id,
+            "state": str(state),
+            "attributes": (
+                dict(attributes)
+                if attributes is not None
+                else dict(old["attributes"]) if old else {}
+            ),
+            "last_changed": now,
+            "last_updated": now,
+            "context": {"id": uuid.uuid4().hex, "parent_id": None, "user_id": None},
+        }
+        if old is not None and old["state"] == new["state"]:
+            new["last_changed"] = old["last_changed"]
+        self.states[entity_id] = new
+        await self.fire_event(
+            "state_changed",
+            {"entity_id": entity_id, "old_state": old, "new_state": new},
+        )
+        return new
+
+    async def fire_event(self, event_type, data):
+        event = {
+            "event_type": event_type,
+            "data": data,
+            "origin": "LOCAL",
+            "time_fired": _now_iso(),
+            "context": {"id": uuid.uuid4().hex, "parent_id": None, "user_id": None},
+        }
+        for ws, subscription in list(self._subscribers):
+            message = {"id": subscription, "type": "event", "event": event}
+            try:
+                await ws.send_str(json.dumps(message))
+            except ConnectionError:
+                self._subscribers.remove((ws, subscription))
+
+    async def call_service(self, domain, service, data):
+        """Applies a service call; returns the states it changed."""
+        entities = data.get("entity_id") or []
+        if isinstance(entities, str):
+            entities = [entities]
+        changed = []
+        for entity_id in entities:
+            old = self.states.get(entity_id)
+            attributes = dict(old["attributes"]) if old else {}
+            if service == "turn_on":
+                state = "on"
+            elif service == "turn_off":
+                state = "off"
+            elif service == "toggle":
+                state = "off" if old and old["state"] == "on" else "on"
+            elif service == "set_percentage":
+                attributes["percentage"] = int(data.get("percentage", 0))
+                state = "on" if attributes["percentage"] else "off"
+            else:
+                continue
+            if old and old["state"] == state and old["attributes"] == attributes:
+                continue
+            changed.append(await self.set_state(entity_id, state, attributes))
+        return changed
+
+    # REST ----------------------------
+
+    def _authorized(self, request):
+        return request.headers.get("Authorization") == f"Bearer {self.token}"
+
+    def _check(self, request, kind):
+        if not self._authorized(request):
+            raise web.HTTPUnauthorized()
+        self.calls[kind] += 1
+
+    async def _api_running(self, request):
+        self._check(request, "api")
+        return web.json_response({"message": "API running."})
+
+    async def _get_config(self, request):
+        self._check(request, "get_config")
+        return web.json_response(self.config)
+
+    async def _get_services(self, request):
+        self._check(request, "get_services")
+        return web.json_response(
+            [
+                {"domain": domain, "services": {service: {} for service in services}}
+                for domain, services in self.services.items()
+            ]
+        )
+
+    async def _get_states(self, request):
+        self._check(request, "get_states")
+        return web.json_response(list(self.states.values()))
+
+    async def _get_entity_state(self, request):
+        self._check(request, "get_state")
+        state = self.states.get(request.match_info["entity_id"])
+        if state is None:
+            raise web.HTTPNotFound()
+        return web.json_response(state)
+
+    async def _post_state(self, request):
+        self._check(request, "set_state")
+        entity_id = request.match_info["entity_id"]
+        body = await request.json()
+        if "state" not in body:
+            raise web.HTTPBadRequest(text="No state specified.")
+        if self.on_set_state is not None:
+            self.on_set_state(entity_id, body["state"])
+        existed = entity_id in self.states
+        state = await self.set_state(entity_id, body["state"], body.get("attributes"))
+        return web.json_response(state, status=200 if existed else 201)
+
+    async def _post_service(self, request):
+        self._check(request, "call_service")
+        domain = request.match_info["domain"]
+        service = request.match_info["service"]
+        if service not in self.services.get(domain, ()):
+            raise web.HTTPBadRequest(text=f"Service {domain}.{service} not found.")
+        data = await request.json() if request.can_read_body else {}
+        if self.on_service_call is not None:
+            self.on_service_call(domain, service, data)
+        return web.json_response(await self.call_service(domain, service, data))
+
+    async def _post_event(self, request):
+        self._check(request, "fire_event")
+        event_type = request.match_info["event_type"]
+        data = await request.json() if request.can_read_body else {}
+        await self.fire_event(event_type, data)
+        return web.json_response({"message": f"Event {event_type} fired."})
+
+    # websocket -----------------------
+
+    async def _websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"type": "auth_required", "ha_version": HA_VERSION})
+
+        message = await ws.receive_json()
+        if message.get("type") != "auth" or message.get("access_token") != self.token:
+            await ws.send_json({"type": "auth_invalid", "message": "Invalid access"})
+            await ws.close()
+            return ws
+        await ws.send_json({"type": "auth_ok", "ha_version": HA_VERSION})
+
+        subscriptions = []
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    break
+                command = json.loads(message.data)
+                self.calls[f"ws_{command.get('type')}"] += 1
+                await self._websocket_command(ws, command, subscriptions)
+        finally:
+            for subscription in subscriptions:
+                self._subscribers.remove(subscription)
+        return ws
+
+    async def _websocket_command(self, ws, command, subscriptions):
+        kind = command.get("type")
+        result = None
+        if kind == "subscribe_events":
+            subscription = (ws, command["id"])
+            subscriptions.append(subscription)
+            self._subscribers.append(subscription)
+        elif kind == "get_states":
+            result = list(self.states.values())
+        elif kind == "get_config":
+            result = self.config
+        elif kind == "call_service":
+            result = await self.call_service(
+                command["domain"],
+                command["service"],
+                {**command.get("service_data", {}), **command.get("target", {})},
+            )
+        elif kind == "ping":
+            await ws.send_json({"id": command["id"], "type": "pong"})
+            return
+        else:
+            await ws.send_json(
+                {
+                    "id": command.get("id"),
+                    "type": "result",
+                    "success": False,
+                    "error": {"code": "unknown_command", "message": kind},
+                }
+            )
+            return
+        await ws.send_json(
+            {"id": command["id"], "type": "result", "success": True, "result": result}
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--token", default="fake-token")
+    parser.add_argument(
+        "--state",
+        action="append",
+        default=[],
+        metavar="ENTITY=STATE",
+        help="initial state, e.g. fan.bathroom=off",
+    )
+    options = parser.parse_args()
+
+    async def serve():
+        home_assistant = FakeHomeAssistant(token=options.token)
+        for setting in options.state:
+            entity_id, _, state = setting.partition("=")
+            await home_assistant.set_state(entity_id, state)
+        url = await home_assistant.start(options.host, options.port)
+        print(f"Fake Home Assistant on {url}, token {options.token}", flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await home_assistant.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
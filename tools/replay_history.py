@@ -0,0 +1,254 @@
+"""Replays Home Assistant recorder history through ShowerFan offline.
+
+Reads entity states from a recorder SQLite database (the `states` table) or a
+CSV export with `entity_id,state,last_changed` columns, streams them in time
+order through a ShowerFan app on the offline simulation, and writes one JSON
+line per transition and per fan-on interval, followed by a summary line.
+
+    python tools/replay_history.py --sqlite home-assistant_v2.db \\
+        --app-config apps.yaml --app master_bathroom_fan \\
+        --set humidity_relative_high=25
+
+Rows are streamed rather than loaded, so months of history fit in constant
+memory. Timeouts run on the simulated clock. The fan's own history is left out
+by default because it reflects the old configuration's commands; pass
+--fan-history to replay it as manual switching.
+"""
+
+import argparse
+import csv
+import heapq
+import json
+import sqlite3
+import sys
+from datetime import datetime, timezone
+
+sys.path.append("tools")
+
+from simulation import Simulation  # noqa: E402
+from shower_fan import (  # noqa: E402
+    ShowerFan,
+    CONFIG_FAN,
+    CONFIG_HUMIDITY_SENSOR,
+    CONFIG_QUIET_SWITCH,
+    CONFIG_REFERENCE_HUMIDITY_SENSOR,
+    CONFIG_REFERENCE_TEMPERATURE_SENSOR,
+    CONFIG_TEMPERATURE_SENSOR,
+    CONFIG_TRIGGER_ENTITIES,
+)
+
+INPUT_ENTITIES = (
+    CONFIG_HUMIDITY_SENSOR,
+    CONFIG_REFERENCE_HUMIDITY_SENSOR,
+    CONFIG_TEMPERATURE_SENSOR,
+    CONFIG_REFERENCE_TEMPERATURE_SENSOR,
+    CONFIG_TRIGGER_ENTITIES,
+    CONFIG_QUIET_SWITCH,
+)
+
+
+def parse_timestamp(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    moment = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        # the recorder stores naive UTC
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def sqlite_rows(path, entities, start=None, end=None):
+    """Yields (timestamp, entity_id, state) from a recorder database in time order."""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(states)")}
+        placeholders = ",".join("?" * len(entities))
+        if "metadata_id" in columns and "last_updated_ts" in columns:
+            query = (
+                "SELECT states.last_updated_ts, states_meta.entity_id, states.state "
+                "FROM states JOIN states_meta "
+                "ON states.metadata_id = states_meta.metadata_id "
+                f"WHERE states_meta.entity_id IN ({placeholders}) "
+                "ORDER BY states.last_updated_ts"
+            )
+        else:
+            query = (
+                "SELECT last_updated, entity_id, state FROM states "
+                f"WHERE entity_id IN ({placeholders}) ORDER BY last_updated"
+            )
+        for timestamp, entity_id, state in connection.execute(query, list(entities)):
+            timestamp = parse_timestamp(timestamp)
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                break
+            yield timestamp, entity_id, state
+    finally:
+        connection.close()
+
+
+def csv_rows(path, entities, start=None, end=None):
+    """Yields (timestamp, entity_id, state) from a history CSV in time order.
+
+    Exports are often grouped by entity, so each entity is read by its own pass
+    over the file and the passes are merged; each entity's rows must be in order.
+    """
+
+    def entity_rows(entity):
+        with open(path, newline="") as file:
+            for row in csv.DictReader(file):
+                if row["entity_id"] != entity:
+                    continue
+                timestamp = parse_timestamp(
+                    row.get("last_changed") or row["last_updated"]
+                )
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    break
+                yield timestamp, entity, row["state"]
+
+    return heapq.merge(*(entity_rows(entity) for entity in entities))
+
+
+class ReplayShowerFan(ShowerFan):
+    """ShowerFan reporting its transitions to the replay."""
+
+    on_transition = None
+
+    def trigger(self, input):
+        previous_state = self.current_state
+        super().trigger(input)
+        if (previous_state, input) in ShowerFan.TRANSITIONS and self.on_transition:
+            self.on_transition(previous_state, input, self.current_state)
+
+
+def replay(rows, args, write, name="replay", start=None, include_fan=False):
+    """Runs `rows` through a ShowerFan configured with `args`, calling `write`
+    with a dict per transition and per fan-on interval; returns the summary."""
+    simulation = Simulation(start=start or 0)
+    fan = args[CONFIG_FAN]
+    summary = {"rows": 0, "transitions": 0, "fan_on_intervals": 0, "fan_on_seconds": 0}
+    fan_on_since = None
+
+    def on_transition(previous_state, input, state):
+        summary["transitions"] += 1
+        write(
+            {
+                "type": "transition",
+                "time": simulation.now,
+                "from": previous_state,
+                "input": input,
+                "to": state,
+            }
+        )
+
+    def on_fan_state(entity, attribute, old, new, kwargs):
+        nonlocal fan_on_since
+        if new == "on" and fan_on_since is None:
+            fan_on_since = simulation.now
+        elif new != "on" and fan_on_since is not None:
+            end_fan_interval()
+
+    def end_fan_interval(truncated=False):
+        nonlocal fan_on_since
+        duration = simulation.now - fan_on_since
+        summary["fan_on_intervals"] += 1
+        summary["fan_on_seconds"] += duration
+        write(
+            {
+                "type": "fan_on",
+                "start": fan_on_since,
+                "end": simulation.now,
+                "seconds": duration,
+                "truncated": truncated,
+            }
+        )
+        fan_on_since = None
+
+    simulation.listen_state(on_fan_state, fan)
+    started = False
+    for timestamp, entity_id, state in rows:
+        if not started:
+            simulation.advance(timestamp)
+            app = simulation.create_app(ReplayShowerFan, name, args)
+            app.on_transition = on_transition
+            started = True
+        if entity_id == fan and not include_fan:
+            continue
+        summary["rows"] += 1
+        simulation.set_state(entity_id, state, at=timestamp)
+
+    if fan_on_since is not None:
+        # still on when the history ends
+        end_fan_interval(truncated=True)
+    summary["calls"] = dict(simulation.calls)
+    return summary
+
+
+def load_app_args(path, app):
+    import yaml
+
+    with open(path) as file:
+        return dict(yaml.safe_load(file)[app])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--sqlite", help="Home Assistant recorder database")
+    source.add_argument("--csv", help="history export: entity_id,state,last_changed")
+    parser.add_argument("--app-config", help="AppDaemon apps.yaml")
+    parser.add_argument("--app", help="app name in --app-config")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="override an app argument, e.g. humidity_relative_high=25",
+    )
+    parser.add_argument("--start", help="ISO time to start from")
+    parser.add_argument("--end", help="ISO time to stop at")
+    parser.add_argument("--fan-history", action="store_true")
+    options = parser.parse_args()
+
+    args = {}
+    if options.app_config:
+        args.update(load_app_args(options.app_config, options.app))
+    for setting in options.set:
+        key, _, value = setting.partition("=")
+        args[key] = value
+    if CONFIG_FAN not in args:
+        parser.error("the app needs a fan: use --app-config or --set fan=...")
+
+    entities = []
+    for key in INPUT_ENTITIES:
+        value = args.get(key)
+        if value:
+            # the reference may be a list of sensors
+            entities.extend([value] if isinstance(value, str) else value)
+    if options.fan_history:
+        entities.append(args[CONFIG_FAN])
+    start = parse_timestamp(options.start) if options.start else None
+    end = parse_timestamp(options.end) if options.end else None
+    if options.sqlite:
+        rows = sqlite_rows(options.sqlite, entities, start, end)
+    else:
+        rows = csv_rows(options.csv, entities, start, end)
+
+    def write(record):
+        sys.stdout.write(json.dumps(record) + "\n")
+
+    summary = replay(
+        rows,
+        args,
+        write,
+        name=options.app or "replay",
+        start=start,
+        include_fan=options.fan_history,
+    )
+    write({"type": "summary", **summary})
+
+
+if __name__ == "__main__":
+    main()
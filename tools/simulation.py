@@ -0,0 +1,231 @@
+"""Offline stand-in for AppDaemon and Home Assistant.
+
+Runs ShowerFan apps in-process against an in-memory entity store and a
+simulated clock, so the benchmarks and replay tools need neither a live
+AppDaemon nor Home Assistant.
+
+    simulation = Simulation(start=1_700_000_000)
+    app = simulation.create_app(ShowerFan, "bathroom", {"fan": "fan.bathroom", ...})
+    simulation.set_state("sensor.bathroom_humidity", "75", at=1_700_000_060)
+    simulation.advance(1_700_003_600)
+"""
+
+import heapq
+import logging
+import sys
+from collections import Counter, deque
+from datetime import datetime
+from itertools import count
+
+sys.path.append("apps/shower_fan")
+
+SERVICE_STATES = {
+    "homeassistant/turn_on": "on",
+    "homeassistant/turn_off": "off",
+}
+
+
+class SimulatedApp:
+    """Mixed in ahead of an app class to route its AppDaemon calls to a Simulation.
+
+    Apps are created without running `hass.Hass.__init__`; `clock` and
+    `datetime` are replaced with the simulated ones.
+    """
+
+    def __init__(self, simulation, name, args):
+        self.simulation = simulation
+        self.name = name
+        self.args = args
+
+    def get_state(self, entity_id=None, **kwargs):
+        return self.simulation.get_state(entity_id)
+
+    def set_state(self, entity_id, **kwargs):
+        return self.simulation.set_app_state(entity_id, **kwargs)
+
+    def call_service(self, service, **kwargs):
+        return self.simulation.call_service(service, **kwargs)
+
+    def listen_state(self, callback, entity=None, **kwargs):
+        return self.simulation.listen_state(callback, entity)
+
+    def listen_event(self, callback, event=None, **kwargs):
+        return self.simulation.listen_event(callback, event)
+
+    def run_in(self, callback, delay, **kwargs):
+        return self.simulation.schedule(callback, self.simulation.now + delay, kwargs)
+
+    def run_at(self, callback, start, **kwargs):
+        return self.simulation.schedule(callback, _timestamp(start), kwargs)
+
+    def run_every(self, callback, start, interval, **kwargs):
+        return self.simulation.schedule(
+            callback, self.simulation.timestamp(start), kwargs, interval
+        )
+
+    def cancel_timer(self, handle):
+        self.simulation.cancel(handle)
+
+    def log(self, msg, *args, level="INFO", **kwargs):
+        self.simulation.log(f"{self.name}: {msg}", *args, level=level)
+
+    def get_main_log(self):
+        return self.simulation.logger
+
+    def clock(self):
+        return self.simulation.now
+
+    def datetime(self, aware=False):
+        return datetime.fromtimestamp(self.simulation.now)
+
+
+def _timestamp(start):
+    if isinstance(start, datetime):
+        return start.timestamp()
+    return float(start)
+
+
+class Simulation:
+    """Entity store, event delivery and scheduler driven by a simulated clock.
+
+    State changes caused by the apps themselves (service calls) are queued and
+    delivered after the current callback returns, as AppDaemon would.
+    `calls` counts AppDaemon API calls by name, `callbacks` the callbacks run.
+    """
+
+    def __init__(self, start=0.0, logger=None):
+        self.now = float(start)
+        self.states = {}
+        self.listeners = {}
+        self.event_listeners = {}
+        self.apps = []
+        self.calls = Counter()
+        self.callbacks = 0
+        if logger is None:
+            # records are still built at WARNING and above, but go nowhere
+            logger = logging.getLogger("shower_fan.simulation")
+            if not logger.handlers:
+                logger.addHandler(logging.NullHandler())
+            logger.propagate = False
+        self.logger = logger
+        self._pending = deque()
+        self._timers = []
+        self._scheduled = {}
+        self._handles = count(1)
+        self._app_classes = {}
+
+    def create_app(self, app_class, name, args):
+        simulated_class = self._app_classes.get(app_class)
+        if simulated_class is None:
+            simulated_class = type(
+                f"Simulated{app_class.__name__}", (SimulatedApp, app_class), {}
+            )
+            self._app_classes[app_class] = simulated_class
+        app = simulated_class(self, name, dict(args))
+        app.initialize()
+        self._drain()
+        self.apps.append(app)
+        return app
+
+    # Home Assistant ------------------
+
+    def get_state(self, entity_id):
+        self.calls["get_state"] += 1
+        return self.states.get(entity_id)
+
+    def set_app_state(self, entity_id, state=None, attributes=None, **kwargs):
+        self.calls["set_state"] += 1
+        self._change(entity_id, state)
+
+    def call_service(self, service, entity_id=None, **kwargs):
+        self.calls["call_service"] += 1
+        state = SERVICE_STATES.get(service)
+        entities = entity_id if isinstance(entity_id, list) else [entity_id]
+        for entity in entities:
+            if state is not None:
+                self._change(entity, state)
+            elif service == "fan/set_percentage":
+                percentage = kwargs.get("percentage", 0)
+                self._change(entity, "on" if percentage else "off")
+
+    def listen_state(self, callback, entity):
+        self.calls["listen_state"] += 1
+        self.listeners.setdefault(entity, []).append(callback)
+
+    def listen_event(self, callback, event):
+        self.calls["listen_event"] += 1
+        self.event_listeners.setdefault(event, []).append(callback)
+
+    def fire_event(self, event, **data):
+        for callback in self.event_listeners.get(event, ()):
+            self.callbacks += 1
+            callback(event, data, {})
+        self._drain()
+
+    def set_state(self, entity_id, state, at=None):
+        """An external state change, e.g. a sensor reading, at simulated time `at`."""
+        if at is not None:
+            self.advance(at)
+        self._change(entity_id, state)
+        self._drain()
+
+    def _change(self, entity_id, state):
+        old = self.states.get(entity_id)
+        if old == state:
+            return
+        self.states[entity_id] = state
+        for callback in self.listeners.get(entity_id, ()):
+            self._pending.append((callback, entity_id, old, state))
+
+    def _drain(self):
+        pending = self._pending
+        while pending:
+            callback, entity_id, old, new = pending.popleft()
+            self.callbacks += 1
+            callback(entity_id, "state", old, new, {})
+
+    # AppDaemon scheduler -------------
+
+    def timestamp(self, start):
+        if isinstance(start, str) and start.startswith("now"):
+            _, _, offset = start.partition("+")
+            return self.now + float(offset or 0)
+        return _timestamp(start)
+
+    def schedule(self, callback, when, kwargs, interval=None):
+        self.calls["schedule"] += 1
+        handle = next(self._handles)
+        self._scheduled[handle] = (callback, kwargs, interval)
+        heapq.heappush(self._timers, (when, handle))
+        return handle
+
+    def cancel(self, handle):
+        self.calls["cancel_timer"] += 1
+        self._scheduled.pop(handle, None)
+
+    def advance(self, until):
+        """Moves the clock to `until`, running every timer due on the way."""
+        timers = self._timers
+        while timers and timers[0][0] <= until:
+            when, handle = heapq.heappop(timers)
+            entry = self._scheduled.get(handle)
+            if entry is None:
+                continue
+            callback, kwargs, interval = entry
+            if interval:
+                heapq.heappush(timers, (when + interval, handle))
+            else:
+                del self._scheduled[handle]
+            self.now = max(self.now, when)
+            self.callbacks += 1
+            callback(kwargs)
+            self._drain()
+        self.now = max(self.now, until)
+
+    # logging -------------------------
+
+    def log(self, msg, *args, level="INFO"):
+        self.calls["log"] += 1
+        level = logging.getLevelName(level)
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, *args)
@@ -0,0 +1,234 @@
+"""Sweeps humidity thresholds and fan off delay over recorded history.
+
+Loads the bathroom and reference humidity (and optionally manual fan switching)
+once into NumPy arrays on a regular time grid, then steps every combination of
+`humidity_relative_high`, `humidity_relative_low` and `fan_off_delay_minutes`
+through the state machine at once: each time step is a handful of array
+operations across all combinations, instead of one Python replay per
+combination. Prints one CSV row per combination with fan runtime, time above
+the high threshold and number of fan on/off cycles.
+
+    python tools/sweep_thresholds.py --sqlite home-assistant_v2.db \\
+        --app-config apps.yaml --app master_bathroom_fan \\
+        --high 10:40:1 --low 2:20:1 --delay 1:30:1 --sort fan_runtime_hours
+
+The model follows OFF, EXTRACTION and DRYING with their timeouts; quiet mode
+is not modelled. Use tools/replay_history.py to check a chosen combination
+event by event.
+"""
+
+import argparse
+import csv
+import sys
+from array import array
+
+import numpy as np
+
+sys.path.append("tools")
+
+from replay_history import (  # noqa: E402
+    csv_rows,
+    load_app_args,
+    parse_timestamp,
+    sqlite_rows,
+)
+from shower_fan import (  # noqa: E402
+    CONFIG_FAN,
+    CONFIG_HUMIDITY_SENSOR,
+    CONFIG_REFERENCE_HUMIDITY_SENSOR,
+    DRYING_TIMEOUT_SECONDS,
+)
+
+METRICS = ("fan_runtime_hours", "above_threshold_hours", "fan_cycles")
+
+
+class History:
+    """Humidity, reference humidity and manual fan-on events on a regular grid."""
+
+    def __init__(self, times, humidity, reference, manual_on):
+        self.times = times
+        self.humidity = humidity
+        self.reference = reference
+        self.manual_on = manual_on
+
+    @classmethod
+    def from_rows(cls, rows, humidity_sensor, reference_sensor, fan=None, step=60):
+        series = {
+            humidity_sensor: (array("d"), array("d")),
+            reference_sensor: (array("d"), array("d")),
+        }
+        fan_on_times = array("d")
+        last_fan_state = None
+        for timestamp, entity_id, state in rows:
+            if entity_id == fan:
+                if state == "on" and last_fan_state != "on":
+                    fan_on_times.append(timestamp)
+                last_fan_state = state
+                continue
+            try:
+                value = float(state)
+            except (TypeError, ValueError):
+                # unavailable/unknown: hold the last good value
+                continue
+            times, values = series[entity_id]
+            times.append(timestamp)
+            values.append(value)
+
+        first = min(series[entity][0][0] for entity in series if series[entity][0])
+        last = max(series[entity][0][-1] for entity in series if series[entity][0])
+        grid = np.arange(first, last + step, step)
+
+        def resample(entity):
+            times = np.frombuffer(series[entity][0])
+            values = np.frombuffer(series[entity][1])
+            index = np.searchsorted(times, grid, side="right") - 1
+            resampled = values[np.maximum(index, 0)]
+            resampled[index < 0] = np.nan
+            return resampled
+
+        manual_on = np.zeros(len(grid), dtype=bool)
+        if fan_on_times:
+            index = np.searchsorted(grid, np.frombuffer(fan_on_times), side="left")
+            manual_on[index[index < len(grid)]] = True
+
+        return cls(
+            grid, resample(humidity_sensor), resample(reference_sensor), manual_on
+        )
+
+
+def sweep(history, high, low, delay_minutes):
+    """Evaluates every (high, low, delay) combination, given as equal-length arrays.
+
+    Returns a dict of metric name -> array with one value per combination.
+    """
+    high = np.asarray(high, dtype=float)
+    low = np.asarray(low, dtype=float)
+    delay = np.asarray(delay_minutes, dtype=float) * 60
+    size = len(high)
+
+    drying = np.zeros(size, dtype=bool)
+    extraction = np.zeros(size, dtype=bool)
+    deadline = np.zeros(size)
+    fan_on = np.zeros(size, dtype=bool)
+    runtime = np.zeros(size)
+    above = np.zeros(size)
+    cycles = np.zeros(size, dtype=np.int64)
+
+    times = history.times
+    step = times[1] - times[0] if len(times) > 1 else 0.0
+    excess = history.humidity - history.reference
+    for k in range(len(times)):
+        now = times[k]
+
+        # timeouts due before this step's readings
+        expired = (drying | extraction) & (now >= deadline)
+        drying &= ~expired
+        extraction &= ~expired
+
+        if history.manual_on[k]:
+            start = ~(drying | extraction)
+            extraction |= start
+            deadline[start] = now + delay[start]
+
+        e = excess[k]
+        if e == e:  # not NaN: both readings known
+            is_high = e > high
+            above += is_high * step
+            start = is_high & ~drying
+            drying |= start
+            extraction &= ~start
+            deadline[start] = now + DRYING_TIMEOUT_SECONDS
+            drying &= ~(e < low)
+
+        now_on = drying | extraction
+        cycles += now_on & ~fan_on
+        fan_on = now_on
+        runtime += fan_on * step
+
+    return {
+        "fan_runtime_hours": runtime / 3600,
+        "above_threshold_hours": above / 3600,
+        "fan_cycles": cycles,
+    }
+
+
+def parameter_grid(high, low, delay):
+    """All combinations with low < high, as three flat arrays."""
+    grid_high, grid_low, grid_delay = (
+        axis.ravel() for axis in np.meshgrid(high, low, delay, indexing="ij")
+    )
+    valid = grid_low < grid_high
+    return grid_high[valid], grid_low[valid], grid_delay[valid]
+
+
+def value_range(text):
+    """`start:stop:step` (stop inclusive) or a comma-separated list."""
+    if ":" in text:
+        start, stop, step = (float(part) for part in text.split(":"))
+        return np.arange(start, stop + step / 2, step)
+    return np.array([float(part) for part in text.split(",")])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--sqlite", help="Home Assistant recorder database")
+    source.add_argument("--csv", help="history export: entity_id,state,last_changed")
+    parser.add_argument("--app-config", help="AppDaemon apps.yaml")
+    parser.add_argument("--app", help="app name in --app-config")
+    parser.add_argument("--humidity-sensor")
+    parser.add_argument("--reference-humidity-sensor")
+    parser.add_argument("--fan", help="replay this fan's 'on' history as manual use")
+    parser.add_argument("--start", help="ISO time to start from")
+    parser.add_argument("--end", help="ISO time to stop at")
+    parser.add_argument("--step", type=float, default=60, help="grid step in seconds")
+    parser.add_argument("--high", type=value_range, default=value_range("10:40:1"))
+    parser.add_argument("--low", type=value_range, default=value_range("2:20:1"))
+    parser.add_argument("--delay", type=value_range, default=value_range("1:30:1"))
+    parser.add_argument("--sort", choices=METRICS)
+    options = parser.parse_args()
+
+    args = {}
+    if options.app_config:
+        args.update(load_app_args(options.app_config, options.app))
+    humidity_sensor = options.humidity_sensor or args.get(CONFIG_HUMIDITY_SENSOR)
+    reference_sensor = options.reference_humidity_sensor or args.get(
+        CONFIG_REFERENCE_HUMIDITY_SENSOR
+    )
+    if not humidity_sensor or not reference_sensor:
+        parser.error("both a humidity and a reference humidity sensor are needed")
+    if not isinstance(reference_sensor, str):
+        parser.error("the sweep models a single reference humidity sensor")
+    fan = options.fan or (args.get(CONFIG_FAN) if options.app_config else None)
+
+    entities = [humidity_sensor, reference_sensor] + ([fan] if fan else [])
+    start = parse_timestamp(options.start) if options.start else None
+    end = parse_timestamp(options.end) if options.end else None
+    if options.sqlite:
+        rows = sqlite_rows(options.sqlite, entities, start, end)
+    else:
+        rows = csv_rows(options.csv, entities, start, end)
+    history = History.from_rows(
+        rows, humidity_sensor, reference_sensor, fan, step=options.step
+    )
+
+    high, low, delay = parameter_grid(options.high, options.low, options.delay)
+    results = sweep(history, high, low, delay)
+
+    order = np.arange(len(high))
+    if options.sort:
+        order = np.argsort(results[options.sort], kind="stable")
+    writer = csv.writer(sys.stdout)
+    writer.writerow(
+        ("humidity_relative_high", "humidity_relative_low", "fan_off_delay_minutes")
+        + METRICS
+    )
+    for i in order:
+        writer.writerow(
+            [f"{high[i]:g}", f"{low[i]:g}", f"{delay[i]:g}"]
+            + [f"{results[metric][i]:.6g}" for metric in METRICS]
+        )
+
+
+if __name__ == "__main__":
+    main()